@@ -64,26 +64,19 @@ from gi.repository import GObject
 from gi.repository import Gio
 import dbus
 import dbus.service
-from dbus import PROPERTIES_IFACE
-from telepathy.server import DBusProperties
-from telepathy.interfaces import CHANNEL, \
-    CHANNEL_TYPE_TEXT, \
-    CLIENT, \
-    CLIENT_HANDLER
-from telepathy.constants import CONNECTION_HANDLE_TYPE_CONTACT
-from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
 
 from sugar3 import util
-from sugar3 import power
-from sugar3.presence import presenceservice
 from sugar3.activity.activityservice import ActivityService
+from sugar3.activity import startuptrace
 from sugar3.graphics import style
 from sugar3.graphics.window import Window
-from sugar3.graphics.alert import Alert
-from sugar3.graphics.icon import Icon
-from sugar3.datastore import datastore
 from sugar3.bundle.activitybundle import ActivityBundle
-from gi.repository import SugarExt
+
+# Not every activity shares, saves or closes with a dialog, so these are
+# only imported when first used, see tests/test_import_time.py
+power = util.LazyModule('sugar3.power')
+presenceservice = util.LazyModule('sugar3.presence.presenceservice')
+datastore = util.LazyModule('sugar3.datastore.datastore')
 
 _ = lambda msg: gettext.dgettext('sugar-toolkit-gtk3', msg)
 
@@ -114,6 +107,7 @@ class _ActivitySession(GObject.GObject):
     def __init__(self):
         GObject.GObject.__init__(self)
 
+        from gi.repository import SugarExt
         self._xsmp_client = SugarExt.ClientXSMP()
         self._xsmp_client.connect('quit-requested',
                                   self.__sm_quit_requested_cb)
@@ -126,6 +120,9 @@ class _ActivitySession(GObject.GObject):
     def register(self, activity):
         self._activities.append(activity)
 
+    def has_activities(self):
+        return len(self._activities) > 0
+
     def unregister(self, activity):
         self._activities.remove(activity)
 
@@ -349,13 +346,15 @@ class Activity(Window, Gtk.Container):
         self.sugar_accel_group = accel_group
         self.add_accel_group(accel_group)
 
-        self._bus = ActivityService(self)
+        with startuptrace.phase('ActivityService', 'dbus'):
+            self._bus = ActivityService(self)
         self._owns_file = False
 
         share_scope = SCOPE_PRIVATE
 
         if handle.object_id:
-            self._jobject = datastore.get(handle.object_id)
+            with startuptrace.phase('datastore.get', 'dbus'):
+                self._jobject = datastore.get(handle.object_id)
 
             if 'share-scope' in self._jobject.metadata:
                 share_scope = self._jobject.metadata['share-scope']
@@ -372,11 +371,13 @@ class Activity(Window, Gtk.Container):
 
         if handle.object_id is None and create_jobject:
             logging.debug('Creating a jobject.')
-            self._jobject = self._initialize_journal_object()
+            with startuptrace.phase('_initialize_journal_object'):
+                self._jobject = self._initialize_journal_object()
 
         if handle.invited:
+            from sugar3.activity.clienthandler import ClientHandler
             wait_loop = GObject.MainLoop()
-            self._client_handler = _ClientHandler(
+            self._client_handler = ClientHandler(
                 self.get_bundle_id(),
                 partial(self.__got_channel_cb, wait_loop))
             # FIXME: The current API requires that self.shared_activity is set
@@ -384,10 +385,12 @@ class Activity(Window, Gtk.Container):
             # shared activity. http://bugs.sugarlabs.org/ticket/2168
             wait_loop.run()
         else:
-            pservice = presenceservice.get_instance()
-            mesh_instance = pservice.get_activity(self._activity_id,
-                                                  warn_if_none=False)
-            self._set_up_sharing(mesh_instance, share_scope)
+            with startuptrace.phase('presenceservice.get_activity', 'dbus'):
+                pservice = presenceservice.get_instance()
+                mesh_instance = pservice.get_activity(self._activity_id,
+                                                      warn_if_none=False)
+            with startuptrace.phase('_set_up_sharing'):
+                self._set_up_sharing(mesh_instance, share_scope)
 
         if not create_jobject:
             self.set_title(get_bundle_name())
@@ -425,7 +428,8 @@ class Activity(Window, Gtk.Container):
         # FIXME: We should be able to get an ID synchronously from the DS,
         # then call async the actual create.
         # http://bugs.sugarlabs.org/ticket/2169
-        datastore.write(jobject)
+        with startuptrace.phase('datastore.write', 'dbus'):
+            datastore.write(jobject)
 
         return jobject
 
@@ -465,6 +469,9 @@ class Activity(Window, Gtk.Container):
 
     def __got_channel_cb(self, wait_loop, connection_path, channel_path,
                          handle_type):
+        from telepathy.interfaces import CHANNEL
+        from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
+
         logging.debug('Activity.__got_channel_cb')
         pservice = presenceservice.get_instance()
 
@@ -568,7 +575,8 @@ class Activity(Window, Gtk.Container):
         logging.debug('Activity.__canvas_map_cb')
         if self._jobject and self._jobject.file_path and \
                 not self._read_file_called:
-            self.read_file(self._jobject.file_path)
+            with startuptrace.phase('read_file'):
+                self.read_file(self._jobject.file_path)
             self._read_file_called = True
         canvas.disconnect_by_func(self.__canvas_map_cb)
 
@@ -925,6 +933,9 @@ class Activity(Window, Gtk.Container):
         pservice.share_activity(self, private=private)
 
     def _show_keep_failed_dialog(self):
+        from sugar3.graphics.alert import Alert
+        from sugar3.graphics.icon import Icon
+
         alert = Alert()
         alert.props.title = _('Keep error')
         alert.props.msg = _('Keep error: all changes will be lost')
@@ -982,7 +993,9 @@ class Activity(Window, Gtk.Container):
         dbus.service.Object.remove_from_connection(self._bus)
 
         self._session.unregister(self)
-        power.get_power_manager().shutdown()
+        if not self._session.has_activities():
+            # other instances can share the process, see activityhost
+            power.get_power_manager().shutdown()
 
     def close(self, skip_save=False):
         """Request that the activity be stopped and saved to the Journal
@@ -1005,6 +1018,8 @@ class Activity(Window, Gtk.Container):
             self._complete_close()
 
     def __realize_cb(self, window):
+        from gi.repository import SugarExt
+
         xid = window.get_window().get_xid()
         SugarExt.wm_set_bundle_id(xid, self.get_bundle_id())
         SugarExt.wm_set_activity_id(xid, str(self._activity_id))
@@ -1039,53 +1054,6 @@ class Activity(Window, Gtk.Container):
         async_err_cb(NotImplementedError())
 
 
-class _ClientHandler(dbus.service.Object, DBusProperties):
-    def __init__(self, bundle_id, got_channel_cb):
-        self._interfaces = set([CLIENT, CLIENT_HANDLER, PROPERTIES_IFACE])
-        self._got_channel_cb = got_channel_cb
-
-        bus = dbus.Bus()
-        name = CLIENT + '.' + bundle_id
-        bus_name = dbus.service.BusName(name, bus=bus)
-
-        path = '/' + name.replace('.', '/')
-        dbus.service.Object.__init__(self, bus_name, path)
-        DBusProperties.__init__(self)
-
-        self._implement_property_get(CLIENT, {
-            'Interfaces': lambda: list(self._interfaces),
-        })
-        self._implement_property_get(CLIENT_HANDLER, {
-            'HandlerChannelFilter': self.__get_filters_cb,
-        })
-
-    def __get_filters_cb(self):
-        logging.debug('__get_filters_cb')
-        filters = {
-            CHANNEL + '.ChannelType': CHANNEL_TYPE_TEXT,
-            CHANNEL + '.TargetHandleType': CONNECTION_HANDLE_TYPE_CONTACT,
-        }
-        filter_dict = dbus.Dictionary(filters, signature='sv')
-        logging.debug('__get_filters_cb %r' % dbus.Array([filter_dict],
-                      signature='a{sv}'))
-        return dbus.Array([filter_dict], signature='a{sv}')
-
-    @dbus.service.method(dbus_interface=CLIENT_HANDLER,
-                         in_signature='ooa(oa{sv})aota{sv}', out_signature='')
-    def HandleChannels(self, account, connection, channels, requests_satisfied,
-                       user_action_time, handler_info):
-        logging.debug('HandleChannels\n\t%r\n\t%r\n\t%r\n\t%r\n\t%r\n\t%r' %
-                      (account, connection, channels, requests_satisfied,
-                          user_action_time, handler_info))
-        try:
-            for object_path, properties in channels:
-                channel_type = properties[CHANNEL + '.ChannelType']
-                handle_type = properties[CHANNEL + '.TargetHandleType']
-                if channel_type == CHANNEL_TYPE_TEXT:
-                    self._got_channel_cb(connection, object_path, handle_type)
-        except Exception, e:
-            logging.exception(e)
-
 _session = None
 
 
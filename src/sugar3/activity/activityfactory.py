@@ -28,13 +28,19 @@ import dbus
 from gi.repository import GObject
 
 from sugar3.activity.activityhandle import ActivityHandle
+from sugar3.activity import activityhost
+from sugar3.activity import zygote
 from sugar3 import util
 from sugar3 import env
+from sugar3 import logger
 from sugar3.datastore import datastore
 
 from errno import EEXIST, ENOSPC
 
 import os
+import sys
+import fcntl
+import socket
 import tempfile
 import subprocess
 import pwd
@@ -45,6 +51,18 @@ _SHELL_IFACE = 'org.laptop.Shell'
 
 _ACTIVITY_FACTORY_INTERFACE = 'org.laptop.ActivityFactory'
 
+_zygote_process = None
+
+# seconds between the checks of the activities whose zygote went away
+_ORPHAN_POLL_INTERVAL = 2
+
+# bundle id -> activity root, for the bundles whose activity root was
+# already created
+_activity_roots = {}
+
+# bundle id -> index of the next log file
+_log_indexes = {}
+
 # helper method to close all filedescriptors
 # borrowed from subprocess.py
 try:
@@ -52,11 +70,45 @@ try:
 except ValueError:
     MAXFD = 256
 
+_CLOSE_RANGE_SYSCALL = 436
+_CLOSE_RANGE_CLOEXEC = 4
+
+try:
+    import ctypes
+    _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+except (ImportError, OSError):
+    _libc = None
+
+
+def _get_open_fds():
+    try:
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return xrange(MAXFD)
+
 
 def _close_fds():
-    for i in xrange(3, MAXFD):
+    """Close the file descriptors the child must not inherit
+
+    Run in the child process before executing the activity. Only the
+    open descriptors are visited, so that a high limit of open files
+    does not make every launch do millions of close() calls.
+    """
+    # let the kernel mark them all as close on exec, Linux >= 5.11
+    if _libc is not None and \
+            _libc.syscall(ctypes.c_long(_CLOSE_RANGE_SYSCALL),
+                          ctypes.c_long(3), ctypes.c_long(0xffffffff),
+                          ctypes.c_long(_CLOSE_RANGE_CLOEXEC)) == 0:
+        return
+
+    for fd in _get_open_fds():
+        if fd < 3:
+            continue
         try:
-            os.close(i)
+            # subprocess reports exec errors through a close on exec pipe
+            if fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                continue
+            os.close(fd)
         # pylint: disable=W0704
         except Exception:
             pass
@@ -67,26 +119,32 @@ def create_activity_id():
     return util.unique_id()
 
 
-def get_environment(activity):
-    environ = os.environ.copy()
+def _create_activity_root(bundle_id):
+    activity_root = _activity_roots.get(bundle_id)
+    # the profile is deleted when the bundle is uninstalled
+    if activity_root is not None and os.path.isdir(activity_root):
+        return activity_root
 
-    bin_path = os.path.join(activity.get_path(), 'bin')
+    activity_root = env.get_profile_path(bundle_id)
+    for path in [activity_root] + [os.path.join(activity_root, name)
+                                   for name in ('instance', 'data', 'tmp')]:
+        try:
+            os.mkdir(path)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
 
-    activity_root = env.get_profile_path(activity.get_bundle_id())
-    if not os.path.exists(activity_root):
-        os.mkdir(activity_root)
+    _activity_roots[bundle_id] = activity_root
+    return activity_root
 
-    data_dir = os.path.join(activity_root, 'instance')
-    if not os.path.exists(data_dir):
-        os.mkdir(data_dir)
 
-    data_dir = os.path.join(activity_root, 'data')
-    if not os.path.exists(data_dir):
-        os.mkdir(data_dir)
+@logger.trace_calls()
+def get_environment(activity):
+    environ = os.environ.copy()
 
-    tmp_dir = os.path.join(activity_root, 'tmp')
-    if not os.path.exists(tmp_dir):
-        os.mkdir(tmp_dir)
+    bin_path = os.path.join(activity.get_path(), 'bin')
+
+    activity_root = _create_activity_root(activity.get_bundle_id())
 
     environ['SUGAR_BUNDLE_PATH'] = activity.get_path()
     environ['SUGAR_BUNDLE_ID'] = activity.get_bundle_id()
@@ -100,6 +158,7 @@ def get_environment(activity):
     return environ
 
 
+@logger.trace_calls()
 def get_command(activity, activity_id=None, object_id=None, uri=None,
                 activity_invite=False):
     if not activity_id:
@@ -115,6 +174,9 @@ def get_command(activity, activity_id=None, object_id=None, uri=None,
         command.extend(['-u', uri])
     if activity_invite:
         command.append('-i')
+    if activityhost.is_enabled() and activityhost.can_host(command) and \
+            '-s' not in command and '--single-process' not in command:
+        command.append('-s')
 
     # if the command is in $BUNDLE_ROOT/bin, execute the absolute path so there
     # is no need to mangle with the shell's PATH
@@ -129,17 +191,47 @@ def get_command(activity, activity_id=None, object_id=None, uri=None,
     return command
 
 
+def _get_log_path(bundle_id, index):
+    return env.get_logs_path('%s-%s.log' % (bundle_id, index))
+
+
+def _find_log_index(bundle_id, index):
+    """Return an index, from index, with no log file after it
+
+    The indexes are used in order, the last one used is found by
+    doubling the step, then bisecting, rather than trying each.
+    """
+    if not os.path.exists(_get_log_path(bundle_id, index)):
+        return index
+
+    used, step = index, 1
+    while os.path.exists(_get_log_path(bundle_id, used + step)):
+        used += step
+        step *= 2
+    free = used + step
+    while free - used > 1:
+        middle = (used + free) / 2
+        if os.path.exists(_get_log_path(bundle_id, middle)):
+            used = middle
+        else:
+            free = middle
+    return free
+
+
+@logger.trace_calls()
 def open_log_file(activity):
-    i = 1
+    bundle_id = activity.get_bundle_id()
+    i = _find_log_index(bundle_id, _log_indexes.get(bundle_id, 1))
     while True:
-        path = env.get_logs_path('%s-%s.log' % (activity.get_bundle_id(), i))
+        path = _get_log_path(bundle_id, i)
         try:
             fd = os.open(path, os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0644)
             f = os.fdopen(fd, 'w', 0)
+            _log_indexes[bundle_id] = i + 1
             return (path, f)
         except OSError, e:
             if e.errno == EEXIST:
-                i += 1
+                i = _find_log_index(bundle_id, i + 1)
             elif e.errno == ENOSPC:
                 # not the end of the world; let's try to keep going.
                 return ('/dev/null', open('/dev/null', 'w'))
@@ -208,6 +300,7 @@ class ActivityCreationHandler(GObject.GObject):
         else:
             self._create_activity()
 
+    @logger.trace_calls(skip_args=[0])
     def _create_activity(self):
         if self._handle.activity_id is None:
             self._handle.activity_id = create_activity_id()
@@ -219,6 +312,9 @@ class ActivityCreationHandler(GObject.GObject):
 
         environ = get_environment(self._bundle)
         (log_path, log_file) = open_log_file(self._bundle)
+        if log_path != '/dev/null':
+            # the activity rotates its log, see logger.start()
+            environ['SUGAR_LOG_FILE'] = log_path
         command = get_command(self._bundle, self._handle.activity_id,
                               self._handle.object_id, self._handle.uri,
                               self._handle.invited)
@@ -247,11 +343,28 @@ class ActivityCreationHandler(GObject.GObject):
 
             log_file.write(' '.join(command) + '\n\n')
 
+        if environment_dir is None and zygote.is_enabled() and \
+                zygote.can_launch(command):
+            try:
+                zygote_socket, pid = zygote.send_request(
+                    [str(s) for s in command], environ,
+                    str(self._bundle.get_path()), log_path)
+            except socket.error, e:
+                logging.debug('Cannot use the activity zygote: %s', e)
+                _start_zygote()
+            else:
+                GObject.io_add_watch(zygote_socket,
+                                     GObject.IO_IN | GObject.IO_HUP,
+                                     _zygote_watch_cb,
+                                     (pid, (environment_dir, log_file,
+                                            self._handle.activity_id)))
+                return
+
         dev_null = file('/dev/null', 'r')
         child = subprocess.Popen([str(s) for s in command],
                                  env=environ,
                                  cwd=str(self._bundle.get_path()),
-                                 close_fds=True,
+                                 preexec_fn=_close_fds,
                                  stdin=dev_null.fileno(),
                                  stdout=log_file.fileno(),
                                  stderr=log_file.fileno())
@@ -319,14 +432,115 @@ def create_with_object_id(bundle, object_id):
     return ActivityCreationHandler(bundle, activity_handle)
 
 
+def _start_zygote():
+    global _zygote_process
+
+    if _zygote_process is not None:
+        return
+
+    log_file = open(env.get_logs_path('activity-zygote.log'), 'a')
+    dev_null = file('/dev/null', 'r')
+    _zygote_process = subprocess.Popen(
+        [sys.executable, '-m', 'sugar3.activity.zygote'],
+        preexec_fn=_close_fds,
+        stdin=dev_null.fileno(),
+        stdout=log_file.fileno(),
+        stderr=log_file.fileno())
+    dev_null.close()
+    log_file.close()
+
+    GObject.child_watch_add(_zygote_process.pid, _zygote_child_watch_cb,
+                            None)
+
+
+def _zygote_child_watch_cb(pid, condition, user_data):
+    global _zygote_process
+
+    logging.debug('Activity zygote exited')
+    _zygote_process = None
+
+
+def _zygote_watch_cb(zygote_socket, condition, user_data):
+    pid, child_data = user_data
+
+    try:
+        reply = zygote.read_message(zygote_socket)
+    except (socket.error, ValueError):
+        reply = None
+    zygote_socket.close()
+
+    if reply is not None and 'status' in reply:
+        _activity_exited(pid, reply['status'], child_data)
+        return False
+
+    # The activity is in its own session, it outlives the zygote. It is
+    # not a child of the shell, wait for it to go away.
+    logging.error('Lost the activity zygote, watching %s', pid)
+    start_time = _get_start_time(pid)
+    if start_time is None:
+        _activity_exited(pid, None, child_data)
+    else:
+        GObject.timeout_add_seconds(_ORPHAN_POLL_INTERVAL,
+                                    _orphan_watch_cb,
+                                    (pid, start_time, child_data))
+    return False
+
+
+def _get_start_time(pid):
+    """Start time of a process, None if it does not exist"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # the command name may contain spaces, the fields follow the last )
+    fields = stat[stat.rfind(')') + 2:].split()
+    if fields[0] == 'Z':
+        return None
+    return fields[19]
+
+
+def _orphan_watch_cb(user_data):
+    pid, start_time, child_data = user_data
+    # the pid may have been reused by another process
+    if _get_start_time(pid) == start_time:
+        return True
+
+    _activity_exited(pid, None, child_data)
+    return False
+
+
 def _child_watch_cb(pid, condition, user_data):
     # FIXME we use standalone method here instead of ActivityCreationHandler's
     # member to have workaround code, see #1123
+
+    # try to reap zombies in case SIGCHLD has not been set to SIG_IGN
+    try:
+        os.waitpid(pid, 0)
+    except OSError:
+        # SIGCHLD = SIG_IGN, no zombies
+        pass
+
+    _activity_exited(pid, condition, user_data)
+
+
+def _activity_exited(pid, condition, user_data):
+    """Report the end of an activity, condition is None when unknown
+
+    The activities launched by the zygote are not children of the
+    shell, they must not be reaped: their pid could have been reused by
+    a child of the shell.
+    """
     environment_dir, log_file, activity_id = user_data
     if environment_dir is not None:
         subprocess.call(['/bin/rm', '-rf', environment_dir])
 
-    if os.WIFEXITED(condition):
+    if condition is None:
+        # the activity was launched by a zygote which went away
+        status = None
+        signum = None
+        message = 'Exited with unknown status'
+    elif os.WIFEXITED(condition):
         status = os.WEXITSTATUS(condition)
         signum = None
         message = 'Exited with status %s' % status
@@ -344,13 +558,6 @@ def _child_watch_cb(pid, condition, user_data):
     finally:
         log_file.close()
 
-    # try to reap zombies in case SIGCHLD has not been set to SIG_IGN
-    try:
-        os.waitpid(pid, 0)
-    except OSError:
-        # SIGCHLD = SIG_IGN, no zombies
-        pass
-
     if status or signum:
         # XXX have to recreate dbus object since we can't reuse
         # ActivityCreationHandler's one, see
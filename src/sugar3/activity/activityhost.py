@@ -0,0 +1,184 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Shared activity host
+
+Several instances of one bundle can run in a single process, sharing
+the interpreter and the GTK context, which saves the memory of a Python
+process per instance. The first instance started with --single-process
+becomes the host, the following ones ask it to create their instance
+over D-Bus and exit. The shell runs every sugar-activity bundle this
+way when SUGAR_ACTIVITY_SHARED_HOST=1 is set in its environment.
+
+UNSTABLE.
+"""
+
+import logging
+import os
+import resource
+
+import dbus
+import dbus.service
+from gi.repository import Gtk
+
+from sugar3.activity import activityhandle
+
+_HOST_INTERFACE = 'org.laptop.SingleProcess'
+
+_SUGAR_ACTIVITY = 'sugar-activity'
+
+
+def is_enabled():
+    return os.environ.get('SUGAR_ACTIVITY_SHARED_HOST') == '1'
+
+
+def can_host(command):
+    """Whether the activity command can run in a shared host"""
+    return os.path.basename(command[0]) == _SUGAR_ACTIVITY
+
+
+def get_host_name(bundle_id):
+    return bundle_id
+
+
+def get_host_path(bundle_id):
+    return '/' + bundle_id.replace('.', '/')
+
+
+def get_rss():
+    """Return the resident set size of the process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return 0
+    return resident_pages * resource.getpagesize()
+
+
+class ActivityHostError(dbus.DBusException):
+    _dbus_error_name = 'org.laptop.SingleProcess.Error'
+
+
+class _HostedInstance(object):
+
+    def __init__(self, activity, rss):
+        self.activity = activity
+        self.rss = rss
+
+
+class ActivityHost(dbus.service.Object):
+    """Creates and tracks the instances of a bundle in this process
+
+    Keyword arguments:
+    bundle_id -- identifier of the bundle, the host owns the bus name
+                 returned by get_host_name() for it
+    create_cb -- callable creating and showing an activity instance
+                 from an ActivityHandle, and returning it
+
+    """
+
+    def __init__(self, bundle_id, create_cb):
+        self._bundle_id = bundle_id
+        self._create_cb = create_cb
+        self._instances = {}
+
+        bus = dbus.SessionBus()
+        self._bus_name = dbus.service.BusName(get_host_name(bundle_id),
+                                              bus=bus)
+        dbus.service.Object.__init__(self, self._bus_name,
+                                     get_host_path(bundle_id))
+
+    @dbus.service.method(_HOST_INTERFACE, in_signature='a{sv}')
+    def create(self, handle_dict):
+        self.create_instance(activityhandle.create_from_dict(handle_dict))
+
+    def create_instance(self, handle):
+        """Create an activity instance in this process and return it.
+
+        Raises ActivityHostError if it cannot be created, the windows it
+        left behind are closed so that it does not affect the others.
+        """
+        if self._bus_name is None:
+            raise ActivityHostError('The host of %s is exiting' %
+                                    self._bundle_id)
+
+        if handle.activity_id in self._instances:
+            raise ActivityHostError('Activity %s is already running' %
+                                    handle.activity_id)
+
+        toplevels = set(Gtk.Window.list_toplevels())
+        rss_before = get_rss()
+        try:
+            activity = self._create_cb(handle)
+        except Exception, e:
+            logging.exception('Cannot create activity %s',
+                              handle.activity_id)
+            self._discard_windows(toplevels)
+            raise ActivityHostError('Cannot create activity %s: %s' %
+                                    (handle.activity_id, e))
+
+        rss = max(get_rss() - rss_before, 0)
+        self._instances[handle.activity_id] = _HostedInstance(activity, rss)
+        activity.connect('destroy', self.__activity_destroy_cb,
+                         handle.activity_id)
+
+        logging.debug('Created activity %s in the host of %s, %d kB',
+                      handle.activity_id, self._bundle_id, rss / 1024)
+        return activity
+
+    @dbus.service.method(_HOST_INTERFACE, in_signature='',
+                         out_signature='a{st}')
+    def GetMemoryUsage(self):
+        """Return the resident memory of each instance, in bytes.
+
+        The memory allocated while creating an instance is attributed to
+        it, the rest of the process memory (the interpreter, the toolkit
+        and what the instances allocated since) is shared evenly.
+        """
+        if not self._instances:
+            return {}
+
+        owned = sum(instance.rss for instance in self._instances.values())
+        shared = max(get_rss() - owned, 0) / len(self._instances)
+
+        return dict((activity_id, instance.rss + shared)
+                    for activity_id, instance in self._instances.items())
+
+    def _discard_windows(self, toplevels):
+        # the instance failed half way, do not let its windows keep the
+        # process running once the other instances are closed
+        for window in set(Gtk.Window.list_toplevels()) - toplevels:
+            try:
+                if hasattr(window, '_complete_close'):
+                    window._complete_close()
+                else:
+                    window.destroy()
+            except Exception:
+                logging.exception('Cannot discard window %r', window)
+
+    def __activity_destroy_cb(self, activity, activity_id):
+        instance = self._instances.get(activity_id)
+        if instance is None or instance.activity is not activity:
+            return
+        del self._instances[activity_id]
+
+        if not self._instances and self._bus_name is not None:
+            # the process is quitting, let the next launch start a new host
+            self.remove_from_connection()
+            self._bus_name.get_bus().release_name(
+                get_host_name(self._bundle_id))
+            self._bus_name = None
@@ -20,6 +20,8 @@ STABLE.
 """
 
 import argparse
+import hashlib
+import json
 import operator
 import os
 import sys
@@ -32,12 +34,17 @@ import re
 import gettext
 import logging
 from fnmatch import fnmatch
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from sugar3 import env
 from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle import bundledelta
 
 
-IGNORE_DIRS = ['dist', '.git']
+GENPOT_CACHE_DIR = '.genpot-cache'
+
+IGNORE_DIRS = ['dist', '.git', GENPOT_CACHE_DIR]
 IGNORE_FILES = ['.gitignore', 'MANIFEST', '*.pyc', '*~', '*.bak', 'pseudo.po']
 
 
@@ -120,6 +127,7 @@ class Builder(object):
         if os.path.exists(self.locale_dir):
             shutil.rmtree(self.locale_dir)
 
+        linfo_index = {}
         for f in os.listdir(po_dir):
             if not f.endswith('.po') or f == 'pseudo.po':
                 continue
@@ -147,6 +155,17 @@ class Builder(object):
             f.write('summary = %s\n' % translated_summary)
             f.close()
 
+            linfo_index[lang] = {'name': translated_name,
+                                 'summary': translated_summary}
+
+        # All the translated names and summaries in a single file, so
+        # that they can be loaded without probing the locale directories
+        if linfo_index:
+            index_path = os.path.join(self.locale_dir,
+                                      ActivityBundle.LINFO_INDEX_FILE)
+            with open(index_path, 'w') as f:
+                json.dump(linfo_index, f, sort_keys=True)
+
     def get_locale_files(self):
         return list_files(self.locale_dir, IGNORE_DIRS, IGNORE_FILES)
 
@@ -330,6 +349,22 @@ def cmd_dist_xo(config, options):
     packager.package()
 
 
+def cmd_dist_delta(config, options):
+    """Create a delta updating a previous xo bundle to this version"""
+
+    packager = XOPackager(Builder(config))
+    packager.package()
+
+    old_version = ActivityBundle(options.old_bundle,
+                                 translated=False).get_activity_version()
+    delta_path = os.path.join(config.dist_dir, '%s-%s-%s.xod' % (
+        config.bundle_name, old_version, config.version))
+    changed = bundledelta.create_delta(options.old_bundle,
+                                       packager.package_path, delta_path)
+    print '%s: %d files changed since version %s' % (delta_path, changed,
+                                                     old_version)
+
+
 def cmd_fix_manifest(config, options):
     '''Add missing files to the manifest (OBSOLETE)'''
 
@@ -352,6 +387,41 @@ def cmd_install(config, options):
     installer.install(options.prefix)
 
 
+def _get_genpot_cache_path(cache_dir, file_path):
+    """Return the path of the cached template for a python file.
+
+    The cache key covers both the relative path, which xgettext writes
+    into the source references, and the file contents, so a file is
+    only parsed again when it is modified or moved.
+    """
+    sha_hash = hashlib.sha1()
+    sha_hash.update(file_path)
+    sha_hash.update('\0')
+    with open(file_path, 'rb') as f:
+        sha_hash.update(f.read())
+    return os.path.join(cache_dir, '%s.pot' % sha_hash.hexdigest())
+
+
+def _extract_strings(file_path, cached_pot):
+    """Run xgettext on a single python file, storing the result in the
+    cache. Returns the xgettext return code."""
+    temp_pot = cached_pot + '.tmp'
+    args = ['xgettext', '--language=Python', '--keyword=_',
+            '--add-comments=TRANS:', '--omit-header',
+            '--output=%s' % temp_pot, file_path]
+    retcode = subprocess.call(args)
+    if retcode:
+        if os.path.exists(temp_pot):
+            os.remove(temp_pot)
+        return retcode
+
+    # xgettext does not write anything if there are no strings
+    if not os.path.exists(temp_pot):
+        open(temp_pot, 'w').close()
+    os.rename(temp_pot, cached_pot)
+    return 0
+
+
 def cmd_genpot(config, options):
     """Generate the gettext pot file"""
 
@@ -361,13 +431,56 @@ def cmd_genpot(config, options):
     if not os.path.isdir(po_path):
         os.mkdir(po_path)
 
+    cache_dir = os.path.join(config.build_dir, GENPOT_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        os.mkdir(cache_dir)
+
     python_files = []
-    for root, dirs_dummy, files in os.walk(config.source_dir):
+    for root, dirs, files in os.walk(config.source_dir):
+        if root == config.source_dir:
+            for ignore in IGNORE_DIRS:
+                if ignore in dirs:
+                    dirs.remove(ignore)
+
         for file_name in files:
             if file_name.endswith('.py'):
                 file_path = os.path.relpath(os.path.join(root, file_name),
                                             config.source_dir)
                 python_files.append(file_path)
+    python_files.sort()
+
+    # Only the files which changed since the last run are handed to
+    # xgettext, the others are merged from the cache.
+    cached_pots = []
+    to_extract = []
+    for file_path in python_files:
+        cached_pot = _get_genpot_cache_path(cache_dir, file_path)
+        cached_pots.append(cached_pot)
+        if not os.path.exists(cached_pot):
+            to_extract.append((file_path, cached_pot))
+
+    if to_extract:
+        jobs = options.jobs or cpu_count()
+        pool = ThreadPool(min(jobs, len(to_extract)))
+        try:
+            results = pool.map(lambda args: _extract_strings(*args),
+                               to_extract)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (file_path, cached_pot), retcode in zip(to_extract, results):
+            if retcode:
+                print 'ERROR - xgettext failed on %s with return code %i.' % \
+                    (file_path, retcode)
+                return
+
+    # Drop the cached templates of files which were changed or removed
+    in_use = set(cached_pots)
+    for file_name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, file_name)
+        if path not in in_use:
+            os.remove(path)
 
     # First write out a stub .pot file containing just the translated
     # activity name, then have xgettext merge the rest of the
@@ -387,10 +500,12 @@ def cmd_genpot(config, options):
         f.write('msgstr ""\n')
     f.close()
 
-    args = ['xgettext', '--join-existing', '--language=Python',
-            '--keyword=_', '--add-comments=TRANS:', '--output=%s' % pot_file]
+    # The cached templates are in PO format, xgettext keeps their
+    # source references and translator comments when merging them.
+    args = ['xgettext', '--join-existing', '--add-comments=TRANS:',
+            '--output=%s' % pot_file]
 
-    args += python_files
+    args += cached_pots
     retcode = subprocess.call(args)
     if retcode:
         print 'ERROR - xgettext failed with return code %i.' % retcode
@@ -425,11 +540,19 @@ def start():
                               help="verbosity for the unit tests")
 
     subparsers.add_parser("dist_xo", help="Create a xo bundle package")
+    dist_delta_parser = subparsers.add_parser(
+        "dist_delta", help="Create a delta from a previous xo bundle")
+    dist_delta_parser.add_argument(
+        "old_bundle", help="xo bundle of the previous version")
     subparsers.add_parser("dist_source", help="Create a tar source package")
     subparsers.add_parser("build", help="Build generated files")
     subparsers.add_parser(
         "fix_manifest", help="Add missing files to the manifest (OBSOLETE)")
-    subparsers.add_parser("genpot", help="Generate the gettext pot file")
+    genpot_parser = subparsers.add_parser(
+        "genpot", help="Generate the gettext pot file")
+    genpot_parser.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, default=None,
+        help="number of files to extract strings from in parallel")
     subparsers.add_parser("dev", help="Setup for development")
 
     options = parser.parse_args()
@@ -0,0 +1,84 @@
+# Copyright (C) 2010 Collabora Ltd. <http://www.collabora.co.uk/>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Telepathy client handling the channels of invited activities
+
+Only imported by sugar3.activity.activity when the activity is launched
+to handle an invite, so that other activities don't load telepathy.
+
+UNSTABLE.
+"""
+
+import logging
+
+import dbus
+import dbus.service
+from dbus import PROPERTIES_IFACE
+from telepathy.server import DBusProperties
+from telepathy.interfaces import CHANNEL, \
+    CHANNEL_TYPE_TEXT, \
+    CLIENT, \
+    CLIENT_HANDLER
+from telepathy.constants import CONNECTION_HANDLE_TYPE_CONTACT
+
+
+class ClientHandler(dbus.service.Object, DBusProperties):
+    def __init__(self, bundle_id, got_channel_cb):
+        self._interfaces = set([CLIENT, CLIENT_HANDLER, PROPERTIES_IFACE])
+        self._got_channel_cb = got_channel_cb
+
+        bus = dbus.Bus()
+        name = CLIENT + '.' + bundle_id
+        bus_name = dbus.service.BusName(name, bus=bus)
+
+        path = '/' + name.replace('.', '/')
+        dbus.service.Object.__init__(self, bus_name, path)
+        DBusProperties.__init__(self)
+
+        self._implement_property_get(CLIENT, {
+            'Interfaces': lambda: list(self._interfaces),
+        })
+        self._implement_property_get(CLIENT_HANDLER, {
+            'HandlerChannelFilter': self.__get_filters_cb,
+        })
+
+    def __get_filters_cb(self):
+        logging.debug('__get_filters_cb')
+        filters = {
+            CHANNEL + '.ChannelType': CHANNEL_TYPE_TEXT,
+            CHANNEL + '.TargetHandleType': CONNECTION_HANDLE_TYPE_CONTACT,
+        }
+        filter_dict = dbus.Dictionary(filters, signature='sv')
+        logging.debug('__get_filters_cb %r' % dbus.Array([filter_dict],
+                      signature='a{sv}'))
+        return dbus.Array([filter_dict], signature='a{sv}')
+
+    @dbus.service.method(dbus_interface=CLIENT_HANDLER,
+                         in_signature='ooa(oa{sv})aota{sv}', out_signature='')
+    def HandleChannels(self, account, connection, channels, requests_satisfied,
+                       user_action_time, handler_info):
+        logging.debug('HandleChannels\n\t%r\n\t%r\n\t%r\n\t%r\n\t%r\n\t%r' %
+                      (account, connection, channels, requests_satisfied,
+                          user_action_time, handler_info))
+        try:
+            for object_path, properties in channels:
+                channel_type = properties[CHANNEL + '.ChannelType']
+                handle_type = properties[CHANNEL + '.TargetHandleType']
+                if channel_type == CHANNEL_TYPE_TEXT:
+                    self._got_channel_cb(connection, object_path, handle_type)
+        except Exception, e:
+            logging.exception(e)
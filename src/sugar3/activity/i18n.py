@@ -17,7 +17,9 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-from gettext import gettext
+import gettext
+import mmap
+import os
 import struct
 
 import dateutil.parser
@@ -26,55 +28,64 @@ import time
 _MO_BIG_ENDIAN = 0xde120495
 _MO_LITTLE_ENDIAN = 0x950412de
 
+# Parsed MO headers and catalogs, indexed by path. Each entry stores the
+# modification time of the file, so that it is parsed again if it changes.
+_headers = {}
+_catalogs = {}
 
-def _read_bin(handle, format_string, byte_count):
-    read_bytes = handle.read(byte_count)
-    return_value = struct.unpack(format_string, read_bytes)
-    if len(return_value) == 1:
-        return return_value[0]
-    else:
-        return return_value
+# Paths of the MO files found for a text domain, see _find_mo_files()
+_mo_files = {}
 
 
-def _extract_header(file_path):
-    header = ''
+def _read_header(file_path):
     handle = open(file_path, 'rb')
-    magic_number = _read_bin(handle, '<I', 4)
-
-    if magic_number == _MO_BIG_ENDIAN:
-        format_string = '>II'
-    elif magic_number == _MO_LITTLE_ENDIAN:
-        format_string = '<II'
-    else:
+    try:
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # mmap refuses empty files
         raise IOError('File does not seem to be a valid MO file')
+    finally:
+        handle.close()
 
-    version_, num_of_strings = _read_bin(handle, format_string, 8)
-
-    msgids_hash_offset, msgstrs_hash_offset = _read_bin(handle,
-                                                        format_string, 8)
-    handle.seek(msgids_hash_offset)
-
-    msgids_index = []
-    for i in range(num_of_strings):
-        msgids_index.append(_read_bin(handle, format_string, 8))
-    handle.seek(msgstrs_hash_offset)
-
-    msgstrs_index = []
-    for i in range(num_of_strings):
-        msgstrs_index.append(_read_bin(handle, format_string, 8))
-
-    for i in range(num_of_strings):
-        handle.seek(msgids_index[i][1])
-        msgid = handle.read(msgids_index[i][0])
-        if msgid == '':
-            handle.seek(msgstrs_index[i][1])
-            msgstr = handle.read(msgstrs_index[i][0])
-            header = msgstr
-            break
+    try:
+        magic_number = struct.unpack_from('<I', data)[0]
+
+        if magic_number == _MO_BIG_ENDIAN:
+            format_string = '>II'
+        elif magic_number == _MO_LITTLE_ENDIAN:
+            format_string = '<II'
         else:
-            continue
+            raise IOError('File does not seem to be a valid MO file')
+
+        num_of_strings = struct.unpack_from(format_string, data, 4)[1]
+        msgids_hash_offset, msgstrs_hash_offset = \
+            struct.unpack_from(format_string, data, 12)
+
+        # The messages are sorted, so the header, whose msgid is the
+        # empty string, is the first entry of well formed files.
+        for i in range(num_of_strings):
+            length, offset_ = struct.unpack_from(
+                format_string, data, msgids_hash_offset + i * 8)
+            if length == 0:
+                length, offset = struct.unpack_from(
+                    format_string, data, msgstrs_hash_offset + i * 8)
+                return data[offset:offset + length]
+    except struct.error:
+        raise IOError('File does not seem to be a valid MO file')
+    finally:
+        data.close()
+
+    return ''
 
-    handle.close()
+
+def _extract_header(file_path):
+    mtime = os.stat(file_path).st_mtime
+    cached = _headers.get(file_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    header = _read_header(file_path)
+    _headers[file_path] = (mtime, header)
     return header
 
 
@@ -90,6 +101,30 @@ def _extract_modification_time(file_path):
     raise ValueError('Could not find a revision date')
 
 
+def _get_catalog(file_path):
+    """Return the GNUTranslations for a MO file, shared by all the
+    callers in the process."""
+    mtime = os.stat(file_path).st_mtime
+    cached = _catalogs.get(file_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(file_path, 'rb') as handle:
+        catalog = gettext.GNUTranslations(handle)
+    _catalogs[file_path] = (mtime, catalog)
+    return catalog
+
+
+def _find_mo_files(domain):
+    localedir = gettext.bindtextdomain(domain)
+    languages = tuple(os.environ.get(envar) for envar in
+                      ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'))
+    key = (domain, localedir, languages)
+    if key not in _mo_files:
+        _mo_files[key] = gettext.find(domain, localedir, all=True)
+    return _mo_files[key]
+
+
 # We ship our own version of pgettext() because Python 2.x will never contain
 # it: http://bugs.python.org/issue2504#msg122482
 def pgettext(context, message):
@@ -101,7 +136,12 @@ def pgettext(context, message):
     messages that are the same in the source language (usually english),
     but might be different in one or more of the target languages.
     """
-    translation = gettext('\x04'.join([context, message]))
-    if '\x04' in translation:
-        return message
-    return translation
+    key = '\x04'.join([context, message])
+    for file_path in _find_mo_files(gettext.textdomain()):
+        try:
+            translation = _get_catalog(file_path).gettext(key)
+        except EnvironmentError:
+            continue
+        if '\x04' not in translation:
+            return translation
+    return message
@@ -0,0 +1,187 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Activity start up tracing
+
+Set SUGAR_ACTIVITY_TRACE=1 in the environment to record how long each
+phase of the activity start up takes, from the execution of the
+process to the first draw of the activity window. The trace is written
+next to the activity log, in the Chrome trace event format, so that it
+can be loaded in chrome://tracing or processed by scripts.
+
+UNSTABLE.
+"""
+
+import atexit
+import json
+import logging
+import os
+import time
+
+from sugar3 import env
+
+_enabled = os.environ.get('SUGAR_ACTIVITY_TRACE') == '1'
+_events = []
+
+
+def is_enabled():
+    return _enabled
+
+
+def _timestamp(seconds=None):
+    if seconds is None:
+        seconds = time.time()
+    return int(seconds * 1000000)
+
+
+def _get_exec_time():
+    """Return the time at which the process was started."""
+    try:
+        with open('/proc/self/stat') as f:
+            # the process name can contain spaces, the start time is
+            # the 20th field after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        start_ticks = int(fields[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return None
+
+    return time.time() - uptime + start_ticks / \
+        float(os.sysconf('SC_CLK_TCK'))
+
+
+def _add_event(name, phase, category, timestamp, **kwargs):
+    event = {'name': name,
+             'cat': category,
+             'ph': phase,
+             'ts': timestamp,
+             'pid': os.getpid(),
+             'tid': 0}
+    event.update(kwargs)
+    _events.append(event)
+
+
+class _Phase(object):
+
+    def __init__(self, name, category):
+        self._name = name
+        self._category = category
+        self._start = None
+
+    def __enter__(self):
+        self._start = _timestamp()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if _enabled:
+            _add_event(self._name, 'X', self._category, self._start,
+                       dur=_timestamp() - self._start)
+        return False
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+def phase(name, category='startup'):
+    """Return a context manager recording the time spent in its block.
+
+    Keyword arguments:
+    name -- name of the phase
+    category -- 'startup' for the phases of the start up or 'dbus'
+                for D-Bus round trips (default 'startup')
+
+    """
+    if not _enabled:
+        return _null_phase
+    return _Phase(name, category)
+
+
+def mark(name, category='startup'):
+    """Record that the start up reached the given point."""
+    if _enabled:
+        _add_event(name, 'i', category, _timestamp(), s='p')
+
+
+def watch_first_draw(widget):
+    """Write the trace once the widget is drawn for the first time."""
+    if not _enabled:
+        return
+
+    def __draw_cb(widget, cr):
+        widget.disconnect(handler_id)
+        mark('first draw')
+        write()
+        return False
+
+    handler_id = widget.connect('draw', __draw_cb)
+
+
+def get_trace_path():
+    try:
+        log_path = os.readlink('/proc/self/fd/2')
+    except OSError:
+        log_path = None
+
+    if log_path is not None and log_path.endswith('.log'):
+        return log_path[:-len('.log')] + '.trace.json'
+
+    bundle_id = os.environ.get('SUGAR_BUNDLE_ID', 'activity')
+    return env.get_logs_path('%s-%s.trace.json' % (bundle_id, os.getpid()))
+
+
+def write():
+    """Write the recorded events and stop recording."""
+    global _enabled
+
+    if not _enabled:
+        return
+    _enabled = False
+
+    exec_time = _get_exec_time()
+    if exec_time is not None:
+        start = _timestamp(exec_time)
+        _add_event('process exec', 'i', 'startup', start, s='p')
+        _add_event('activity start up', 'X', 'startup', start,
+                   dur=_timestamp() - start)
+
+    trace_path = get_trace_path()
+    try:
+        with open(trace_path, 'w') as f:
+            json.dump({'traceEvents': _events,
+                       'displayTimeUnit': 'ms'}, f)
+    except IOError, e:
+        logging.error('Cannot write the start up trace %s: %s',
+                      trace_path, e)
+    else:
+        logging.debug('Start up trace written to %s', trace_path)
+
+    del _events[:]
+
+
+if _enabled:
+    mark('startuptrace imported')
+    # the activity can fail before its window is drawn
+    atexit.register(write)
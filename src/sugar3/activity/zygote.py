@@ -0,0 +1,300 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Pre-forked activity launcher
+
+The zygote is a process which has the toolkit modules already loaded
+and forks a child for every activity launch, saving most of the Python
+start up time. It is enabled by setting SUGAR_ACTIVITY_ZYGOTE=1 in the
+environment of the shell, see activityfactory.
+
+Nothing which opens a display or a D-Bus connection, or starts a
+thread, can be done before forking: the libraries of the GTK stack are
+only linked, they are initialized in each child.
+
+UNSTABLE.
+"""
+
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+from distutils.spawn import find_executable
+
+from sugar3 import env
+
+# Python modules which are safe to import before forking
+_PRELOAD_MODULES = [
+    'dbus',
+    'dbus.service',
+    'dbus.mainloop.glib',
+    'cairo',
+    'telepathy',
+    'telepathy.client',
+    'telepathy.server',
+    'sugar3.util',
+    'sugar3.logger',
+    'sugar3.profile',
+    'sugar3.activity.activityhandle',
+    'sugar3.activity.i18n',
+    'sugar3.bundle.activitybundle',
+]
+
+# Typelibs (and their shared libraries) loaded without importing the
+# python overrides, which would initialize them
+_PRELOAD_TYPELIBS = [
+    ('GLib', '2.0'),
+    ('GObject', '2.0'),
+    ('Gio', '2.0'),
+    ('Pango', '1.0'),
+    ('GdkPixbuf', '2.0'),
+    ('Gdk', '3.0'),
+    ('Gtk', '3.0'),
+    ('SugarExt', '1.0'),
+]
+
+_SUGAR_ACTIVITY = 'sugar-activity'
+
+
+def is_enabled():
+    return os.environ.get('SUGAR_ACTIVITY_ZYGOTE') == '1'
+
+
+def get_socket_path():
+    return env.get_profile_path('activity-zygote')
+
+
+def can_launch(command):
+    """Whether the activity command can be run by the zygote"""
+    return os.path.basename(command[0]) == _SUGAR_ACTIVITY
+
+
+def send_request(command, environ, cwd, log_path):
+    """Ask the zygote to launch an activity.
+
+    Returns a connected socket, on which the zygote writes the exit
+    status of the activity once it terminates, and the activity pid.
+    Raises socket.error if the zygote is not running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_path())
+        request = {'command': command,
+                   'environ': environ,
+                   'cwd': cwd,
+                   'log_path': log_path}
+        sock.sendall(json.dumps(request) + '\n')
+        reply = read_message(sock)
+    except (socket.error, ValueError):
+        sock.close()
+        raise socket.error('Activity zygote is not available')
+
+    if reply is None or 'pid' not in reply:
+        sock.close()
+        raise socket.error('Activity zygote refused the request')
+
+    return sock, reply['pid']
+
+
+def read_message(sock):
+    """Read one newline terminated JSON message, None on end of file."""
+    data = ''
+    while not data.endswith('\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data)
+
+
+def preload():
+    for name in _PRELOAD_MODULES:
+        try:
+            __import__(name)
+        except ImportError, e:
+            logging.debug('Cannot preload %s: %s', name, e)
+
+    try:
+        from gi.repository import GIRepository
+    except ImportError:
+        return
+
+    repository = GIRepository.Repository.get_default()
+    for namespace, version in _PRELOAD_TYPELIBS:
+        try:
+            repository.require(namespace, version, 0)
+        except Exception, e:
+            logging.debug('Cannot preload %s-%s: %s', namespace, version, e)
+
+
+class Zygote(object):
+
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+        self._script_path = find_executable(_SUGAR_ACTIVITY)
+        self._clients = {}
+        self._parent_pid = os.getppid()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(socket_path)
+        self._socket.listen(5)
+
+    def run(self):
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        # The zygote belongs to the shell which started it
+        while os.getppid() == self._parent_pid:
+            try:
+                readable = select.select([self._socket], [], [], 5)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            if readable:
+                self._accept()
+
+            self._reap_children()
+
+    def _accept(self):
+        try:
+            connection = self._socket.accept()[0]
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        try:
+            request = read_message(connection)
+        except (socket.error, ValueError), e:
+            logging.error('Invalid activity launch request: %s', e)
+            request = None
+
+        if request is None or self._script_path is None or \
+                not can_launch(request['command']):
+            connection.close()
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            self._socket.close()
+            for client in self._clients.values():
+                client.close()
+            _run_child(connection, request, self._script_path)
+
+        try:
+            connection.sendall(json.dumps({'pid': pid}) + '\n')
+        except socket.error:
+            logging.warning('Launcher of activity %s went away', pid)
+        self._clients[pid] = connection
+
+    def _reap_children(self):
+        while self._clients:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if pid == 0:
+                return
+
+            connection = self._clients.pop(pid, None)
+            if connection is None:
+                continue
+            try:
+                connection.sendall(json.dumps({'status': status}) + '\n')
+            except socket.error:
+                pass
+            connection.close()
+
+
+def _run_child(connection, request, script_path):
+    status = 0
+    try:
+        connection.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.setsid()
+
+        os.environ.clear()
+        for key, value in request['environ'].items():
+            os.environ[key.encode('utf-8')] = value.encode('utf-8')
+        os.chdir(request['cwd'].encode('utf-8'))
+
+        dev_null = os.open('/dev/null', os.O_RDONLY)
+        os.dup2(dev_null, 0)
+        os.close(dev_null)
+
+        log_fd = os.open(request['log_path'].encode('utf-8'),
+                         os.O_WRONLY | os.O_APPEND)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        os.close(log_fd)
+
+        command = [arg.encode('utf-8') for arg in request['command']]
+        sys.argv = [script_path] + command[1:]
+
+        import runpy
+        runpy.run_path(script_path, run_name='__main__')
+    except SystemExit, e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            print >> sys.stderr, e.code
+            status = 1
+    except BaseException:
+        # the child must never unwind into the zygote code
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            # os._exit() skips the exit handlers, flush the logs
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def main():
+    socket_path = get_socket_path()
+
+    # Only the children need these, the zygote must not get them from
+    # the shell which started it.
+    for name in ('DISPLAY', 'DBUS_SESSION_BUS_ADDRESS'):
+        os.environ.pop(name, None)
+
+    preload()
+
+    zygote = Zygote(socket_path)
+    try:
+        zygote.run()
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+if __name__ == '__main__':
+    main()
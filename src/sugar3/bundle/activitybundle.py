@@ -22,12 +22,19 @@ UNSTABLE.
 
 from ConfigParser import ConfigParser
 from locale import normalize
+import json
 import os
 import shutil
 import tempfile
 import logging
+import time
+import zipfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from sugar3 import env
+from sugar3.bundle import blobstore
+from sugar3.bundle import bundledelta
 from sugar3.bundle.bundle import Bundle, \
     MalformedBundleException, NotInstalledException
 from sugar3.bundle.bundleversion import NormalizedVersion
@@ -83,6 +90,33 @@ def _expand_lang(locale):
     return ret
 
 
+_languages_cache = {}
+
+
+def _get_languages():
+    """Get the normalized and expanded languages from the environment,
+    in order of preference."""
+    # Using method from gettext.py, first find languages from environ
+    languages = []
+    for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
+        val = os.environ.get(envar)
+        if val:
+            languages = val.split(':')
+            break
+
+    key = tuple(languages)
+    if key not in _languages_cache:
+        # Next, normalize and expand the languages
+        nelangs = []
+        for lang in languages:
+            for nelang in _expand_lang(lang):
+                if nelang not in nelangs:
+                    nelangs.append(nelang)
+        _languages_cache[key] = nelangs
+
+    return _languages_cache[key]
+
+
 class ActivityBundle(Bundle):
     """A Sugar activity bundle
 
@@ -91,6 +125,10 @@ class ActivityBundle(Bundle):
 
     MIME_TYPE = 'application/vnd.olpc-sugar'
 
+    # Translated names and summaries for all the languages, written by
+    # bundlebuilder next to the per language activity.linfo files
+    LINFO_INDEX_FILE = 'linfo.json'
+
     _zipped_extension = '.xo'
     _unzipped_extension = '.activity'
     _infodir = 'activity'
@@ -116,9 +154,7 @@ class ActivityBundle(Bundle):
         self._parse_info(info_file)
 
         if translated:
-            linfo_file = self._get_linfo_file()
-            if linfo_file:
-                self._parse_linfo(linfo_file)
+            self._load_translations()
 
     def _parse_info(self, info_file):
         cp = ConfigParser()
@@ -187,24 +223,42 @@ class ActivityBundle(Bundle):
             if cp.get(section, 'single_instance') == 'yes':
                 self._single_instance = True
 
-    def _get_linfo_file(self):
-        # Using method from gettext.py, first find languages from environ
-        languages = []
-        for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
-            val = os.environ.get(envar)
-            if val:
-                languages = val.split(':')
-                break
+    def _load_translations(self):
+        languages = _get_languages()
+        if not languages:
+            return
 
-        # Next, normalize and expand the languages
-        nelangs = []
+        index_path = os.path.join('locale', self.LINFO_INDEX_FILE)
+        index_file = self.get_file(index_path)
+        if index_file is not None:
+            try:
+                linfo_index = json.load(index_file)
+            except ValueError:
+                logging.error('Malformed %s in bundle %s', index_path,
+                              self._path)
+            else:
+                for lang in languages:
+                    if lang in linfo_index:
+                        self._set_linfo(linfo_index[lang])
+                        break
+                return
+            finally:
+                index_file.close()
+
+        linfo_file = self._get_linfo_file(languages)
+        if linfo_file:
+            self._parse_linfo(linfo_file)
+
+    def _set_linfo(self, linfo):
+        # Keep the same string type as the values read by ConfigParser
+        if linfo.get('name'):
+            self._name = linfo['name'].encode('utf-8')
+
+        if linfo.get('summary'):
+            self._summary = linfo['summary'].encode('utf-8')
+
+    def _get_linfo_file(self, languages):
         for lang in languages:
-            for nelang in _expand_lang(lang):
-                if nelang not in nelangs:
-                    nelangs.append(nelang)
-
-        # Finally, select a language
-        for lang in nelangs:
             linfo_path = os.path.join('locale', lang, 'activity.linfo')
             linfo_file = self.get_file(linfo_path)
             if linfo_file is not None:
@@ -295,33 +349,113 @@ class ActivityBundle(Bundle):
         """Get whether there should be a visible launcher for the activity"""
         return self._show_launcher
 
-    def install(self):
+    def install(self, update_database=True, deduplicate=None):
+        """Install the bundle in the user activities directory
+
+        Keyword arguments:
+        update_database -- update the mime database if the bundle has
+                           mime types (default True)
+        deduplicate -- store the files of the bundle in the blob store
+                       shared by the installed bundles, see blobstore
+                       (default blobstore.is_enabled())
+
+        """
         install_dir = env.get_user_activities_path()
 
         self._unzip(install_dir)
 
         install_path = os.path.join(install_dir, self._zip_root_dir)
-        self.install_mime_type(install_path)
+        if deduplicate or deduplicate is None and blobstore.is_enabled():
+            blobstore.deduplicate(install_path,
+                                  blobstore.get_store_path(install_dir))
+        self.install_mime_type(install_path, update_database)
+
+        return install_path
+
+    def apply_delta(self, delta_path, full_bundle=None):
+        """Update the installed bundle in place from a delta
+
+        The bundle is updated atomically: if the delta is not for the
+        installed version, cannot be read or a checksum does not match,
+        the installed bundle is left untouched and, when given, the full
+        bundle of the new version is installed instead. The
+        ActivityBundle objects of the old version must not be used after
+        the update.
+
+        Keyword arguments:
+        delta_path -- the delta created by "setup.py dist_delta"
+        full_bundle -- path of the xo bundle of the new version, or a
+                       callable returning it, as a fallback (default None)
 
+        Returns the install path of the new version.
+        """
+        try:
+            bundledelta.apply_delta(self._path, delta_path, self._bundle_id,
+                                    self._activity_version)
+        except (bundledelta.DeltaMismatchException, MalformedBundleException,
+                zipfile.BadZipfile, IOError, OSError), e:
+            if full_bundle is None:
+                raise
+            logging.warning('Cannot apply %s, installing the full bundle: '
+                            '%s', delta_path, e)
+            if callable(full_bundle):
+                full_bundle = full_bundle()
+            return self._replace(ActivityBundle(full_bundle))
+
+        # the mime types and their icons might have changed, they are
+        # read from the new activity.info
+        ActivityBundle(self._path).install_mime_type(self._path)
+        return self._path
+
+    def _replace(self, bundle):
+        """Install the xo bundle of another version in place of this one
+
+        The new version is extracted next to the installed one, which is
+        only removed once the new version is in place.
+        """
+        install_dir = os.path.dirname(self._path)
+        install_path = os.path.join(install_dir, bundle._zip_root_dir)
+        store_path = blobstore.get_store_path(install_dir)
+
+        staging_dir = tempfile.mkdtemp(prefix='.delta-full-', dir=install_dir)
+        try:
+            bundle._unzip(staging_dir)
+            staging_path = os.path.join(staging_dir, bundle._zip_root_dir)
+            if blobstore.is_enabled():
+                blobstore.deduplicate(staging_path, store_path)
+
+            if install_path == os.path.normpath(self._path):
+                shutil.rmtree(bundledelta.replace_tree(install_path,
+                                                       staging_path))
+            else:
+                os.rename(staging_path, install_path)
+                self.uninstall()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        if os.path.isdir(store_path):
+            blobstore.collect_garbage(store_path)
+        bundle.install_mime_type(install_path)
         return install_path
 
-    def install_mime_type(self, install_path):
+    def install_mime_type(self, install_path, update_database=True):
         """ Update the mime type database and install the mime type icon
+
+        Returns True if the bundle has mime types to add to the database,
+        when update_database is False update_mime_database() must then be
+        called.
         """
-        xdg_data_home = os.getenv('XDG_DATA_HOME',
-                                  os.path.expanduser('~/.local/share'))
+        xdg_data_home = _get_xdg_data_home()
 
         mime_path = os.path.join(install_path, 'activity', 'mimetypes.xml')
-        if os.path.isfile(mime_path):
-            mime_dir = os.path.join(xdg_data_home, 'mime')
-            mime_pkg_dir = os.path.join(mime_dir, 'packages')
+        has_mime_types = os.path.isfile(mime_path)
+        if has_mime_types:
+            mime_pkg_dir = os.path.dirname(self._get_installed_mime_path())
             if not os.path.isdir(mime_pkg_dir):
                 os.makedirs(mime_pkg_dir)
-            installed_mime_path = os.path.join(mime_pkg_dir,
-                                               '%s.xml' % self._bundle_id)
-            self._symlink(mime_path, installed_mime_path)
-            os.spawnlp(os.P_WAIT, 'update-mime-database',
-                       'update-mime-database', mime_dir)
+            self._symlink(mime_path, self._get_installed_mime_path())
+            if update_database:
+                update_mime_database()
 
         mime_types = self.get_mime_types()
         if mime_types is not None:
@@ -343,6 +477,12 @@ class ActivityBundle(Bundle):
                               os.path.join(installed_icons_dir,
                                            os.path.basename(info_file)))
 
+        return has_mime_types
+
+    def _get_installed_mime_path(self):
+        return os.path.join(_get_xdg_data_home(), 'mime', 'packages',
+                            '%s.xml' % self._bundle_id)
+
     def _symlink(self, src, dst):
         if not os.path.isfile(src):
             return
@@ -355,25 +495,30 @@ class ActivityBundle(Bundle):
             os.unlink(dst)
         os.symlink(src, dst)
 
-    def uninstall(self, force=False, delete_profile=False):
+    def uninstall(self, force=False, delete_profile=False,
+                  update_database=True):
+        """Uninstall the bundle
+
+        Returns True if mime types were removed from the mime database,
+        when update_database is False update_mime_database() must then be
+        called.
+        """
         install_path = self.get_path()
 
         if os.path.islink(install_path):
             # Don't remove the actual activity dir if it's a symbolic link
             # because we may be removing user data.
             os.unlink(install_path)
-            return
+            return False
 
-        xdg_data_home = os.getenv('XDG_DATA_HOME',
-                                  os.path.expanduser('~/.local/share'))
+        xdg_data_home = _get_xdg_data_home()
 
-        mime_dir = os.path.join(xdg_data_home, 'mime')
-        installed_mime_path = os.path.join(mime_dir, 'packages',
-                                           '%s.xml' % self._bundle_id)
-        if os.path.exists(installed_mime_path):
+        installed_mime_path = self._get_installed_mime_path()
+        has_mime_types = os.path.exists(installed_mime_path)
+        if has_mime_types:
             os.remove(installed_mime_path)
-            os.spawnlp(os.P_WAIT, 'update-mime-database',
-                       'update-mime-database', mime_dir)
+            if update_database:
+                update_mime_database()
 
         mime_types = self.get_mime_types()
         if mime_types is not None:
@@ -395,5 +540,163 @@ class ActivityBundle(Bundle):
 
         self._uninstall(install_path)
 
+        return has_mime_types
+
     def is_user_activity(self):
         return self.get_path().startswith(env.get_user_activities_path())
+
+
+def _get_xdg_data_home():
+    return os.getenv('XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+
+
+def update_mime_database():
+    """Rebuild the user mime database from the installed mime types"""
+    os.spawnlp(os.P_WAIT, 'update-mime-database', 'update-mime-database',
+               os.path.join(_get_xdg_data_home(), 'mime'))
+
+
+class BundleResult(object):
+    """Outcome of the installation or uninstallation of a bundle
+
+    Attributes:
+    bundle -- the ActivityBundle
+    install_path -- where the bundle was installed, for installations
+    error -- the exception raised if it failed, None otherwise
+    duration -- seconds spent on this bundle, excluding the mime
+                database update shared by all the bundles
+
+    """
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.install_path = None
+        self.error = None
+        self.duration = 0
+        self._update_database = False
+
+
+def _extract_bundle(args):
+    result, install_dir, deduplicate = args
+    start = time.time()
+    try:
+        result.bundle._unzip(install_dir)
+        result.install_path = os.path.join(install_dir,
+                                           result.bundle._zip_root_dir)
+        if deduplicate:
+            blobstore.deduplicate(result.install_path,
+                                  blobstore.get_store_path(install_dir))
+    except Exception, e:
+        result.error = e
+    result.duration = time.time() - start
+    return result
+
+
+def install_bundles(bundles, jobs=None, progress_cb=None,
+                    deduplicate=None):
+    """Install several activity bundles at once
+
+    The bundles are extracted in parallel. Their mime types and icons are
+    registered as each extraction completes, and the mime database is
+    updated once at the end. A bundle which fails to install does not
+    stop the others.
+
+    Keyword arguments:
+    bundles -- the ActivityBundle objects to install, from archives
+               which extract to different directories
+    jobs -- number of bundles extracted at the same time (default: the
+            number of CPUs)
+    progress_cb -- called with the BundleResult of each bundle once it is
+                   installed or failed to
+    deduplicate -- see ActivityBundle.install()
+
+    Returns the list of BundleResult, in the order of bundles.
+    """
+    results = [BundleResult(bundle) for bundle in bundles]
+    if not results:
+        return results
+
+    if deduplicate is None:
+        deduplicate = blobstore.is_enabled()
+
+    install_dir = env.get_user_activities_path()
+    if not os.path.isdir(install_dir):
+        os.mkdir(install_dir, 0775)
+
+    pool = ThreadPool(min(jobs or cpu_count(), len(results)))
+    try:
+        for result in pool.imap_unordered(
+                _extract_bundle,
+                [(result, install_dir, deduplicate) for result in results]):
+            if result.error is None:
+                start = time.time()
+                try:
+                    result._update_database = \
+                        result.bundle.install_mime_type(result.install_path,
+                                                        False)
+                except Exception, e:
+                    result.error = e
+                result.duration += time.time() - start
+
+            if result.error is not None:
+                logging.error('Cannot install %s: %s',
+                              result.bundle.get_path(), result.error)
+            if progress_cb is not None:
+                progress_cb(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    if any(result._update_database for result in results):
+        start = time.time()
+        update_mime_database()
+        logging.debug('Updated the mime database in %.2fs',
+                      time.time() - start)
+
+    return results
+
+
+def _uninstall_bundle(args):
+    result, delete_profile = args
+    start = time.time()
+    try:
+        result._update_database = result.bundle.uninstall(
+            delete_profile=delete_profile, update_database=False)
+    except Exception, e:
+        result.error = e
+    result.duration = time.time() - start
+    return result
+
+
+def uninstall_bundles(bundles, delete_profile=False, jobs=None,
+                      progress_cb=None):
+    """Uninstall several activity bundles at once
+
+    Like install_bundles(), the bundles are removed in parallel and the
+    mime database is updated once at the end. A bundle which fails to
+    uninstall does not stop the others.
+
+    Returns the list of BundleResult, in the order of bundles.
+    """
+    results = [BundleResult(bundle) for bundle in bundles]
+    if not results:
+        return results
+
+    pool = ThreadPool(min(jobs or cpu_count(), len(results)))
+    try:
+        for result in pool.imap_unordered(
+                _uninstall_bundle,
+                [(result, delete_profile) for result in results]):
+            if result.error is not None:
+                logging.error('Cannot uninstall %s: %s',
+                              result.bundle.get_path(), result.error)
+            if progress_cb is not None:
+                progress_cb(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    if any(result._update_database for result in results):
+        update_mime_database()
+
+    return results
@@ -0,0 +1,141 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Content addressed store of the installed bundle files
+
+Bundles often ship identical copies of libraries, fonts and icons. When
+installed with deduplication, every file of a bundle is replaced by a
+hard link to a blob named after the hash of its contents, so identical
+files are stored once. The store is a directory next to the installed
+bundles, hard links cannot cross file systems. Blobs are read only, as
+they are shared between bundles.
+
+UNSTABLE.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import stat
+
+STORE_DIR = '.blobs'
+
+_CHUNK_SIZE = 65536
+
+
+def is_enabled():
+    """Whether bundles are deduplicated by default when installed"""
+    return os.environ.get('SUGAR_BUNDLE_DEDUPLICATE') == '1'
+
+
+def get_store_path(install_dir):
+    return os.path.join(install_dir, STORE_DIR)
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_blob_path(store_path, file_path, file_stat):
+    name = _hash_file(file_path)
+    # links share the permissions, executables cannot share a blob with
+    # data files
+    if file_stat.st_mode & stat.S_IXUSR:
+        name += '.x'
+    return os.path.join(store_path, name[:2], name[2:])
+
+
+def _link_to_blob(store_path, file_path, file_stat):
+    blob_path = _get_blob_path(store_path, file_path, file_stat)
+
+    blob_dir = os.path.dirname(blob_path)
+    try:
+        os.makedirs(blob_dir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    try:
+        os.link(file_path, blob_path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        # first copy of these contents, it becomes the blob
+        os.chmod(blob_path, stat.S_IMODE(file_stat.st_mode) & 0555)
+        return 0
+
+    tmp_path = file_path + '.blob-tmp'
+    os.link(blob_path, tmp_path)
+    os.rename(tmp_path, file_path)
+    return file_stat.st_size
+
+
+def deduplicate(path, store_path):
+    """Replace the files of an installed bundle by links to blobs
+
+    Keyword arguments:
+    path -- directory of the installed bundle
+    store_path -- the blob store, on the same file system
+
+    Returns the number of bytes saved.
+    """
+    saved = 0
+    for root, dirs_, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            file_stat = os.lstat(file_path)
+            if not stat.S_ISREG(file_stat.st_mode) or \
+                    file_stat.st_size == 0:
+                continue
+
+            try:
+                saved += _link_to_blob(store_path, file_path, file_stat)
+            except (IOError, OSError), e:
+                # keep the plain file, it works as well
+                logging.warning('Cannot deduplicate %s: %s', file_path, e)
+
+    logging.debug('Deduplicated %s, %d kB saved', path, saved / 1024)
+    return saved
+
+
+def collect_garbage(store_path):
+    """Remove the blobs which are not linked by any bundle any more
+
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    for root, dirs, files in os.walk(store_path, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            file_stat = os.lstat(path)
+            if file_stat.st_nlink == 1:
+                os.remove(path)
+                freed += file_stat.st_size
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:
+                # still has blobs
+                pass
+
+    return freed
@@ -26,6 +26,8 @@ import shutil
 import StringIO
 import zipfile
 
+from sugar3.bundle import blobstore
+
 
 class AlreadyInstalledException(Exception):
     pass
@@ -199,9 +201,13 @@ class Bundle(object):
             if ext != self._unzipped_extension:
                 raise InvalidPathException
 
+        has_blobs = False
         for root, dirs, files in os.walk(install_path, topdown=False):
             for name in files:
-                os.remove(os.path.join(root, name))
+                path = os.path.join(root, name)
+                if not has_blobs and os.lstat(path).st_nlink > 1:
+                    has_blobs = True
+                os.remove(path)
             for name in dirs:
                 path = os.path.join(root, name)
                 if os.path.islink(path):
@@ -209,3 +215,8 @@ class Bundle(object):
                 else:
                     os.rmdir(path)
         os.rmdir(install_path)
+
+        store_path = blobstore.get_store_path(
+            os.path.dirname(os.path.normpath(install_path)))
+        if has_blobs and os.path.isdir(store_path):
+            blobstore.collect_garbage(store_path)
@@ -0,0 +1,294 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Delta updates between two versions of an activity bundle
+
+A delta is a zip file holding a delta.json manifest, with the checksum
+of every file of the new version and the list of files removed since
+the old one, and the new and changed files under files/. It is created
+by "setup.py dist_delta" and applied with ActivityBundle.apply_delta().
+
+UNSTABLE.
+"""
+
+import ctypes
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import zipfile
+
+from sugar3.bundle import blobstore
+from sugar3.bundle.bundle import MalformedBundleException
+from sugar3.bundle.bundleversion import NormalizedVersion
+from sugar3.bundle.bundleversion import InvalidVersionError
+
+MANIFEST = 'delta.json'
+FORMAT_VERSION = 1
+
+_FILES_DIR = 'files/'
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+try:
+    _renameat2 = ctypes.CDLL('libc.so.6', use_errno=True).renameat2
+    _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                           ctypes.c_char_p, ctypes.c_uint]
+except (OSError, AttributeError):
+    # renameat2() is in glibc >= 2.28
+    _renameat2 = None
+
+
+class DeltaMismatchException(Exception):
+    """The delta does not apply to the installed bundle"""
+    pass
+
+
+def _check_path(path):
+    if os.path.isabs(path) or os.pardir in path.split('/'):
+        raise MalformedBundleException('Invalid path in delta: %s' % path)
+    return path
+
+
+def _hash_data(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_bundle(bundle_zip):
+    """Return {path in the bundle: (checksum, mode, ZipInfo)}"""
+    entries = {}
+    for info in bundle_zip.infolist():
+        if info.filename == 'mimetype' or info.filename.endswith('/'):
+            continue
+        path = info.filename.split('/', 1)[1]
+        entries[path] = (_hash_data(bundle_zip.read(info)),
+                         (info.external_attr >> 16) & 07777, info)
+    return entries
+
+
+def create_delta(old_bundle_path, new_bundle_path, delta_path):
+    """Create the delta updating one xo bundle to another
+
+    Returns the number of changed files.
+    """
+    from sugar3.bundle.activitybundle import ActivityBundle
+
+    old_bundle = ActivityBundle(old_bundle_path, translated=False)
+    new_bundle = ActivityBundle(new_bundle_path, translated=False)
+    if old_bundle.get_bundle_id() != new_bundle.get_bundle_id():
+        raise MalformedBundleException('%s and %s are different activities'
+                                       % (old_bundle_path, new_bundle_path))
+
+    with zipfile.ZipFile(old_bundle_path) as old_zip:
+        old_entries = _read_bundle(old_zip)
+
+    new_zip = zipfile.ZipFile(new_bundle_path)
+    delta_zip = zipfile.ZipFile(delta_path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        new_entries = _read_bundle(new_zip)
+
+        changed = [path for path, entry in new_entries.items()
+                   if old_entries.get(path, (None, None))[:2] != entry[:2]]
+        manifest = {
+            'format': FORMAT_VERSION,
+            'bundle_id': new_bundle.get_bundle_id(),
+            'old_version': old_bundle.get_activity_version(),
+            'new_version': new_bundle.get_activity_version(),
+            'files': dict((path, entry[0])
+                          for path, entry in new_entries.items()),
+            'removed': sorted(set(old_entries) - set(new_entries)),
+        }
+        delta_zip.writestr(MANIFEST, json.dumps(manifest, indent=1))
+
+        for path in sorted(changed):
+            new_info = new_entries[path][2]
+            info = zipfile.ZipInfo(_FILES_DIR + path, new_info.date_time)
+            info.external_attr = new_info.external_attr
+            info.compress_type = zipfile.ZIP_DEFLATED
+            delta_zip.writestr(info, new_zip.read(new_info))
+    finally:
+        delta_zip.close()
+        new_zip.close()
+
+    return len(changed)
+
+
+def _link_tree(src, dst):
+    """Copy a directory, hard linking the files where possible"""
+    os.mkdir(dst)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.islink(src_path):
+            os.symlink(os.readlink(src_path), dst_path)
+        elif os.path.isdir(src_path):
+            _link_tree(src_path, dst_path)
+        else:
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copy2(src_path, dst_path)
+
+
+def _apply(delta_zip, manifest, path):
+    for removed in manifest['removed']:
+        removed_path = os.path.join(path, _check_path(removed))
+        if os.path.lexists(removed_path):
+            os.remove(removed_path)
+
+    for info in delta_zip.infolist():
+        if not info.filename.startswith(_FILES_DIR):
+            continue
+        file_path = os.path.join(
+            path, _check_path(info.filename[len(_FILES_DIR):]))
+
+        # never write through a link, it is shared with the installed
+        # version or with other bundles
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        elif not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+
+        with open(file_path, 'wb') as f:
+            f.write(delta_zip.read(info))
+        mode = (info.external_attr >> 16) & 07777
+        if mode:
+            os.chmod(file_path, mode)
+
+    for file_path, checksum in manifest['files'].items():
+        try:
+            matches = _hash_file(os.path.join(path, _check_path(file_path))) \
+                == checksum
+        except IOError:
+            matches = False
+        if not matches:
+            raise DeltaMismatchException('Checksum mismatch for %s' %
+                                         file_path)
+
+
+def _exchange(path, other_path):
+    """Atomically swap two directories, False if not supported"""
+    if _renameat2 is None:
+        return False
+    if _renameat2(_AT_FDCWD, path, _AT_FDCWD, other_path,
+                  _RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL):
+        # old kernel or file system without support
+        return False
+    raise OSError(error, os.strerror(error), path)
+
+
+def replace_tree(install_path, staging_path):
+    """Replace an installed bundle by a new version in staging_path
+
+    Both directories must be on the same file system. Where supported
+    they are exchanged atomically, otherwise the installed version is
+    moved aside first. If the new version cannot be moved in place, the
+    previous one is left next to install_path and an error is logged.
+
+    Returns the path of the previous version, to be removed.
+    """
+    if _exchange(staging_path, install_path):
+        return staging_path
+
+    parent_dir, name = os.path.split(install_path)
+    backup_path = os.path.join(parent_dir, '.%s.delta-old' % name)
+    if os.path.exists(backup_path):
+        shutil.rmtree(backup_path)
+    os.rename(install_path, backup_path)
+    try:
+        os.rename(staging_path, install_path)
+    except OSError:
+        logging.error('Cannot move %s to %s, the previous version is '
+                      'kept in %s', staging_path, install_path, backup_path)
+        raise
+    return backup_path
+
+
+def apply_delta(install_path, delta_path, bundle_id, version):
+    """Update an installed bundle from a delta
+
+    The new version is prepared next to the installed one, its
+    checksums are verified, then it replaces the installed directory.
+    Raises DeltaMismatchException, leaving the installed bundle
+    untouched, if the delta is for another bundle or version or if a
+    checksum does not match.
+
+    Keyword arguments:
+    install_path -- directory of the installed bundle
+    delta_path -- the delta file
+    bundle_id -- identifier of the installed bundle
+    version -- version of the installed bundle
+
+    """
+    install_path = os.path.normpath(install_path)
+    parent_dir, name = os.path.split(install_path)
+    staging_path = os.path.join(parent_dir, '.%s.delta-new' % name)
+
+    with zipfile.ZipFile(delta_path) as delta_zip:
+        try:
+            manifest = json.loads(delta_zip.read(MANIFEST))
+        except (KeyError, ValueError), e:
+            raise MalformedBundleException('Invalid delta %s: %s' %
+                                           (delta_path, e))
+
+        if manifest.get('format') != FORMAT_VERSION:
+            raise DeltaMismatchException('Unsupported delta format %s' %
+                                         manifest.get('format'))
+        if manifest['bundle_id'] != bundle_id:
+            raise DeltaMismatchException('The delta is for %s' %
+                                         manifest['bundle_id'])
+        try:
+            old_version = NormalizedVersion(str(manifest['old_version']))
+        except InvalidVersionError, e:
+            raise MalformedBundleException('Invalid delta %s: %s' %
+                                           (delta_path, e))
+        if old_version != NormalizedVersion(version):
+            raise DeltaMismatchException(
+                'The delta updates version %s, %s is installed' %
+                (manifest['old_version'], version))
+
+        if os.path.exists(staging_path):
+            shutil.rmtree(staging_path)
+        try:
+            _link_tree(install_path, staging_path)
+            _apply(delta_zip, manifest, staging_path)
+        except:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+
+    shutil.rmtree(replace_tree(install_path, staging_path))
+
+    store_path = blobstore.get_store_path(parent_dir)
+    if os.path.isdir(store_path):
+        blobstore.collect_garbage(store_path)
+
+    logging.debug('Updated %s from %s to %s', install_path,
+                  manifest['old_version'], manifest['new_version'])
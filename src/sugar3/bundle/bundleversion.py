@@ -20,21 +20,18 @@
 # numeration schema.
 #
 
-import re
+from string import ascii_letters, digits
 
 
 class InvalidVersionError(Exception):
     """The passed activity version can not be normalized."""
     pass
 
-VERSION_RE = re.compile(r'''
-    ^
-    (?P<version>\d+)               # minimum 'N'
-    (?P<extraversion>(?:\.\d+)*)   # any number of extra '.N' segments
-    (?:
-    (?P<local>\-[a-zA-Z]*)         # ignore any string in the comparison
-    )?
-    $''', re.VERBOSE)
+
+# Interned NormalizedVersion objects, by version string. Catalogues
+# repeat the same few versions many times.
+_versions = {}
+_MAX_VERSIONS = 50000
 
 
 class NormalizedVersion(object):
@@ -51,8 +48,21 @@ class NormalizedVersion(object):
         1.2.           # can't end with '.'
         1.02.5         # can't have a leading zero
 
+    Versions are immutable and interned: creating a version from the
+    same string twice returns the same object. They are hashable, and
+    sort_key can be used as a key to sort them.
+
     """
 
+    sort_key = None
+
+    def __new__(cls, activity_version=None):
+        if cls is NormalizedVersion and type(activity_version) is str:
+            version = _versions.get(activity_version)
+            if version is not None:
+                return version
+        return object.__new__(cls)
+
     def __init__(self, activity_version):
         """Create a NormalizedVersion instance from a version string.
 
@@ -60,6 +70,10 @@ class NormalizedVersion(object):
         activity_version -- The version string
 
         """
+        if self.sort_key is not None:
+            # interned, already parsed
+            return
+
         self._activity_version = activity_version
         self.parts = []
         self._local = None
@@ -67,20 +81,23 @@ class NormalizedVersion(object):
         if not isinstance(self._activity_version, str):
             raise InvalidVersionError(self._activity_version)
 
-        match = VERSION_RE.search(self._activity_version)
-        if not match:
-            raise InvalidVersionError(self._activity_version)
-
-        groups = match.groupdict()
+        version, separator, local = activity_version.partition('-')
+        if separator:
+            if local.translate(None, ascii_letters):
+                raise InvalidVersionError(self._activity_version)
+            self._local = separator + local
 
-        version = self._parse_version(groups['version'])
-        self.parts.append(version)
+        segments = version.split('.')
+        self.parts.append(self._parse_version(segments[0]))
+        if len(segments) > 1:
+            self.parts.extend(self._parse_extraversions(segments[1:]))
 
-        if groups['extraversion'] not in ('', None):
-            versions = self._parse_extraversions(groups['extraversion'][1:])
-            self.parts.extend(versions)
+        self.sort_key = tuple(self.parts)
 
-        self._local = groups['local']
+        if type(self) is NormalizedVersion:
+            if len(_versions) >= _MAX_VERSIONS:
+                _versions.clear()
+            _versions[activity_version] = self
 
     def _parse_version(self, version_string):
         """Verify that there is no leading zero and convert to integer.
@@ -91,6 +108,9 @@ class NormalizedVersion(object):
         Return: Version
 
         """
+        if not version_string or version_string.translate(None, digits):
+            raise InvalidVersionError(self._activity_version)
+
         if len(version_string) > 1 and version_string[0] == '0':
             raise InvalidVersionError("Can not have leading zero in segment"
                                       " %s in %r" %
@@ -98,23 +118,17 @@ class NormalizedVersion(object):
 
         return int(version_string)
 
-    def _parse_extraversions(self, extraversion_string):
-        """Split into N versions and convert them to integers, verify
-        that there are no leading zeros and drop trailing zeros.
+    def _parse_extraversions(self, extraversions):
+        """Convert the extra versions to integers, verify that there are
+        no leading zeros and drop trailing zeros.
 
         Keyword arguments:
-        extraversion -- 'N.N.N...' sequence to be parsed
+        extraversions -- list of 'N' segments to be parsed
 
         Return: List of extra versions
 
         """
-        nums = []
-        for n in extraversion_string.split("."):
-            if len(n) > 1 and n[0] == '0':
-                raise InvalidVersionError("Can not have leading zero in "
-                                          "segment %s in %r"
-                                          % (n, self._activity_version))
-            nums.append(int(n))
+        nums = [self._parse_version(n) for n in extraversions]
 
         while nums and nums[-1] == 0:
             nums.pop()
@@ -130,6 +144,9 @@ class NormalizedVersion(object):
     def __repr__(self):
         return "%s('%s')" % (self.__class__.__name__, self)
 
+    def __hash__(self):
+        return hash(self.sort_key)
+
     def _cannot_compare(self, other):
         raise TypeError("Can not compare %s and %s"
                         % (type(self).__name__, type(other).__name__))
@@ -137,21 +154,71 @@ class NormalizedVersion(object):
     def __eq__(self, other):
         if not isinstance(other, NormalizedVersion):
             self._cannot_compare(other)
-        return self.parts == other.parts
+        return self.sort_key == other.sort_key
 
     def __lt__(self, other):
         if not isinstance(other, NormalizedVersion):
             self._cannot_compare(other)
-        return self.parts < other.parts
+        return self.sort_key < other.sort_key
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        if not isinstance(other, NormalizedVersion):
+            self._cannot_compare(other)
+        return self.sort_key != other.sort_key
 
     def __gt__(self, other):
-        return not (self.__lt__(other) or self.__eq__(other))
+        if not isinstance(other, NormalizedVersion):
+            self._cannot_compare(other)
+        return self.sort_key > other.sort_key
 
     def __le__(self, other):
-        return self.__eq__(other) or self.__lt__(other)
+        if not isinstance(other, NormalizedVersion):
+            self._cannot_compare(other)
+        return self.sort_key <= other.sort_key
 
     def __ge__(self, other):
-        return self.__eq__(other) or self.__gt__(other)
+        if not isinstance(other, NormalizedVersion):
+            self._cannot_compare(other)
+        return self.sort_key >= other.sort_key
+
+
+def parse_many(version_strings, ignore_invalid=False):
+    """Create the NormalizedVersion objects of many version strings
+
+    Keyword arguments:
+    version_strings -- iterable of version strings
+    ignore_invalid -- return None for the invalid version strings instead
+                      of raising InvalidVersionError (default False)
+
+    Return: List of NormalizedVersion, in the order of version_strings
+
+    """
+    versions = []
+    for version_string in version_strings:
+        version = _versions.get(version_string) \
+            if type(version_string) is str else None
+        if version is None:
+            try:
+                version = NormalizedVersion(version_string)
+            except InvalidVersionError:
+                if not ignore_invalid:
+                    raise
+        versions.append(version)
+    return versions
+
+
+def max_version(version_strings):
+    """Return the greatest version, ignoring the invalid version strings
+
+    Keyword arguments:
+    version_strings -- iterable of version strings
+
+    Return: NormalizedVersion, or None if there is no valid version
+
+    """
+    versions = [version for version in parse_many(set(version_strings),
+                                                  ignore_invalid=True)
+                if version is not None]
+    if not versions:
+        return None
+    return max(versions, key=lambda version: version.sort_key)
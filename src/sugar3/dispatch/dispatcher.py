@@ -1,13 +1,29 @@
+import collections
+import itertools
+import logging
 import weakref
 try:
     set
 except NameError:
     from sets import Set as set  # Python 2.3 fallback
 
+from sugar3 import logger
+from sugar3 import util
 from sugar3.dispatch import saferef
 
+GLib = util.LazyModule('gi.repository.GLib')
+
 WEAKREF_TYPES = (weakref.ReferenceType, saferef.BoundMethodWeakref)
 
+# dispatch modes
+SYNC = 'sync'
+IDLE = 'idle'
+COALESCE = 'coalesce'
+
+THREAD_POOL_SIZE = 4
+
+_thread_pool = None
+
 
 def _make_id(target):
     if hasattr(target, 'im_func'):
@@ -15,24 +31,79 @@ def _make_id(target):
     return id(target)
 
 
+def _get_thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        from multiprocessing.pool import ThreadPool
+        _thread_pool = ThreadPool(THREAD_POOL_SIZE)
+    return _thread_pool
+
+
+def _call_receiver(receiver, signal, sender, named):
+    try:
+        receiver(signal=signal, sender=sender, **named)
+    except Exception:
+        logging.exception('Error in the receiver %r of %r', receiver, signal)
+
+
 class Signal(object):
     """Base class for all signals
 
-    Internal attributes:
-        receivers -- { receriverkey (id) : weakref(receiver) }
+    The receivers are called synchronously by send() in the SYNC mode,
+    the default. In the IDLE mode, the signals are queued and delivered
+    from the GLib mainloop when idle. The COALESCE mode is like IDLE,
+    but only the last signal queued for each sender is delivered. In
+    these two modes, the receivers connected as thread safe are called
+    from a pool of THREAD_POOL_SIZE threads.
+
+    Attributes:
+        receivers -- [((receiverkey (id), senderkey (id)),
+            weakref(receiver)), ...], in the order of connection. It is
+            a copy, the receivers are indexed privately: use connect()
+            and disconnect() to change them.
     """
 
-    def __init__(self, providing_args=None):
+    def __init__(self, providing_args=None, mode=SYNC, coalesce_key=None):
         """providing_args -- A list of the arguments
                        this signal can pass along in
                        a send() call.
+        mode -- SYNC, IDLE or COALESCE
+        coalesce_key -- in the COALESCE mode, a function returning
+            the key of the signals replacing each other, it is called
+            like a receiver, with the sender and the named arguments.
+            By default, the signals of the same sender replace each
+            other.
         """
-        self.receivers = []
+        if mode not in (SYNC, IDLE, COALESCE):
+            raise ValueError('Invalid dispatch mode %r' % mode)
+        self.mode = mode
+        self._coalesce_key = coalesce_key
+        # key -> (sender, named arguments) of the signals to deliver
+        self._pending = collections.OrderedDict()
+        self._pending_order = itertools.count()
+        self._idle_id = 0
+
+        # lookup key -> receiver, in the order of connection
+        self._receivers = collections.OrderedDict()
+        # senderkey -> { lookup key : (connection order, receiver,
+        #                              thread safe) }
+        self._sender_receivers = {}
+        # id(receiver) -> lookup keys, to forget the dead receivers
+        self._receiver_keys = {}
+        # senderkey -> tuple of the receivers for this sender, the
+        # receivers of any sender are cached under the None senderkey
+        self._cache = {}
+        self._order = itertools.count()
         if providing_args is None:
             providing_args = []
         self.providing_args = set(providing_args)
 
-    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+    @property
+    def receivers(self):
+        return self._receivers.items()
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None,
+                thread_safe=False):
         """Connect receiver to sender for signal
 
         receiver -- a function or an instance method which is to
@@ -62,6 +133,9 @@ class Signal(object):
             instance of a receiver. This will usually be a string, though it
             may be anything hashable.
 
+        thread_safe -- whether the receiver can be called from another
+            thread, when the signal is not synchronous.
+
         returns None
         """
         if dispatch_uid:
@@ -73,11 +147,14 @@ class Signal(object):
             receiver = saferef.safeRef(
                 receiver, onDelete=self._remove_receiver)
 
-        for r_key, _ in self.receivers:
-            if r_key == lookup_key:
-                break
-        else:
-            self.receivers.append((lookup_key, receiver))
+        if lookup_key in self._receivers:
+            return
+
+        self._receivers[lookup_key] = receiver
+        self._sender_receivers.setdefault(lookup_key[1], {})[lookup_key] = \
+            (next(self._order), receiver, thread_safe)
+        self._receiver_keys.setdefault(id(receiver), []).append(lookup_key)
+        self._cache.clear()
 
     def disconnect(self, receiver=None, sender=None, weak=True,
                    dispatch_uid=None):
@@ -102,10 +179,10 @@ class Signal(object):
         else:
             lookup_key = (_make_id(receiver), _make_id(sender))
 
-        for idx, (r_key, _) in enumerate(self.receivers):
-            if r_key == lookup_key:
-                del self.receivers[idx]
+        if lookup_key in self._receivers:
+            self._forget(lookup_key)
 
+    @logger.trace_calls(skip_args=[0])
     def send(self, sender, **named):
         """Send signal from sender to all connected receivers.
 
@@ -120,17 +197,24 @@ class Signal(object):
         through send, terminating the dispatch loop, so it is quite
         possible to not have all receivers called if a raises an
         error.
+
+        When the signal is not synchronous, it is queued and an empty
+        list is returned, the errors of the receivers are logged.
         """
 
         responses = []
-        if not self.receivers:
+        if not self._receivers:
+            return responses
+        if self.mode != SYNC:
+            self._queue(sender, named)
             return responses
 
-        for receiver in self._live_receivers(_make_id(sender)):
+        for receiver, thread_safe_ in self._live_receivers(_make_id(sender)):
             response = receiver(signal=self, sender=sender, **named)
             responses.append((receiver, response))
         return responses
 
+    @logger.trace_calls(skip_args=[0])
     def send_robust(self, sender, **named):
         """Send signal from sender to all connected receivers catching errors
 
@@ -148,15 +232,20 @@ class Signal(object):
         if any receiver raises an error (specifically any subclass of
         Exception),
         the error instance is returned as the result for that receiver.
+
+        When the signal is not synchronous, it is queued like with send().
         """
 
         responses = []
-        if not self.receivers:
+        if not self._receivers:
+            return responses
+        if self.mode != SYNC:
+            self._queue(sender, named)
             return responses
 
         # Call each receiver with whatever arguments it can accept.
         # Return a list of tuple pairs [(receiver, response), ... ].
-        for receiver in self._live_receivers(_make_id(sender)):
+        for receiver, thread_safe_ in self._live_receivers(_make_id(sender)):
             try:
                 response = receiver(signal=self, sender=sender, **named)
             except Exception, err:
@@ -170,28 +259,89 @@ class Signal(object):
 
         This checks for weak references
         and resolves them, then returning only live
-        receivers.
+        receivers, with whether they are thread safe.
         """
-        none_senderkey = _make_id(None)
+        if senderkey not in self._sender_receivers:
+            senderkey = _make_id(None)
+
+        receivers = self._cache.get(senderkey)
+        if receivers is None:
+            receivers = self._get_receivers(senderkey)
+            self._cache[senderkey] = receivers
+
+        for receiver, thread_safe in receivers:
+            if isinstance(receiver, WEAKREF_TYPES):
+                # Dereference the weak reference.
+                receiver = receiver()
+                if receiver is not None:
+                    yield receiver, thread_safe
+            else:
+                yield receiver, thread_safe
 
-        for (receiverkey, r_senderkey), receiver in self.receivers:
-            if r_senderkey == none_senderkey or r_senderkey == senderkey:
-                if isinstance(receiver, WEAKREF_TYPES):
-                    # Dereference the weak reference.
-                    receiver = receiver()
-                    if receiver is not None:
-                        yield receiver
+    def _get_receivers(self, senderkey):
+        """Return the (receiver, thread safe) pairs of senderkey, in the
+        order of connection"""
+        none_senderkey = _make_id(None)
+        entries = self._sender_receivers.get(none_senderkey, {}).values()
+        if senderkey != none_senderkey:
+            entries += self._sender_receivers.get(senderkey, {}).values()
+        return tuple((receiver, thread_safe)
+                     for order_, receiver, thread_safe in sorted(entries))
+
+    def _queue(self, sender, named):
+        if self.mode == COALESCE:
+            if self._coalesce_key is not None:
+                key = self._coalesce_key(sender=sender, **named)
+            else:
+                key = _make_id(sender)
+            # keep the place in the queue of the signal replaced
+            self._pending[key] = (sender, named)
+        else:
+            self._pending[next(self._pending_order)] = (sender, named)
+
+        if not self._idle_id:
+            self._idle_id = GLib.idle_add(self.__idle_cb)
+
+    def __idle_cb(self):
+        self._idle_id = 0
+        self.flush()
+        return False
+
+    @logger.trace_calls(skip_args=[0])
+    def flush(self):
+        """Deliver the queued signals now"""
+        if self._idle_id:
+            GLib.source_remove(self._idle_id)
+            self._idle_id = 0
+
+        pending = self._pending.values()
+        self._pending.clear()
+        for sender, named in pending:
+            for receiver, thread_safe in \
+                    self._live_receivers(_make_id(sender)):
+                if thread_safe:
+                    _get_thread_pool().apply_async(
+                        _call_receiver, (receiver, self, sender, named))
                 else:
-                    yield receiver
+                    _call_receiver(receiver, self, sender, named)
+
+    def _forget(self, lookup_key):
+        receiver = self._receivers.pop(lookup_key)
+
+        sender_receivers = self._sender_receivers[lookup_key[1]]
+        del sender_receivers[lookup_key]
+        if not sender_receivers:
+            del self._sender_receivers[lookup_key[1]]
+
+        keys = self._receiver_keys[id(receiver)]
+        keys.remove(lookup_key)
+        if not keys:
+            del self._receiver_keys[id(receiver)]
+
+        self._cache.clear()
 
     def _remove_receiver(self, receiver):
         """Remove dead receivers from connections."""
 
-        to_remove = []
-        for key, connected_receiver in self.receivers:
-            if connected_receiver == receiver:
-                to_remove.append(key)
-        for key in to_remove:
-            for idx, (r_key, _) in enumerate(self.receivers):
-                if r_key == key:
-                    del self.receivers[idx]
+        for key in list(self._receiver_keys.get(id(receiver), [])):
+            self._forget(key)
@@ -26,7 +26,6 @@ from gi.repository import Gdk
 from gi.repository import GdkX11
 from gi.repository import Gtk
 
-from sugar3.graphics.icon import Icon
 from sugar3.graphics import palettegroup
 
 
@@ -57,6 +56,9 @@ class UnfullscreenButton(Gtk.Window):
         self._button = Gtk.Button()
         self._button.set_relief(Gtk.ReliefStyle.NONE)
 
+        # only needed when the window is made fullscreen
+        from sugar3.graphics.icon import Icon
+
         self._icon = Icon(icon_name='view-return',
                           icon_size=Gtk.IconSize.LARGE_TOOLBAR)
         self._icon.show()
@@ -23,11 +23,18 @@ STABLE.
 import array
 import collections
 import errno
+import functools
+import gzip
+import itertools
 import logging
 import sys
 import os
+import re
 import repr as repr_
 import decorator
+import shutil
+import struct
+import threading
 import time
 
 from sugar3 import env
@@ -64,8 +71,19 @@ def set_level(level):
         logging.warning('Invalid log level: %r' % level)
 
 
+def _flush_handlers():
+    for handler in logging.getLogger('').handlers:
+        handler.flush()
+
+
 # pylint: disable-msg=E1101,F0401
 def _except_hook(exctype, value, traceback):
+    # the records logged before the exception come first
+    _flush_handlers()
+    if _trace_buffer:
+        print >> sys.stderr, 'Last traced calls:'
+        _trace_buffer.dump(sys.stderr)
+
     # Attempt to provide verbose IPython tracebacks.
     # Importing IPython is slow, so we import it lazily.
     try:
@@ -82,6 +100,7 @@ def cleanup():
     """Clean up the log directory, moving old logs into a numbered backup
     directory.  We only keep `_MAX_BACKUP_DIRS` of these backup directories
     around; the rest are removed."""
+    _flush_handlers()
     logs_dir = get_logs_dir()
 
     if not os.path.isdir(logs_dir):
@@ -117,7 +136,248 @@ def cleanup():
             os.rename(source_path, dest_path)
 
 
+class AsyncLogHandler(logging.Handler):
+    """Log handler writing to a stream from a background thread
+
+    The records are formatted by the thread logging them, then written
+    by the background thread, in batches of up to MAX_BATCH_SIZE bytes,
+    so that a slow storage does not block the thread logging. When more
+    than MAX_PENDING_SIZE bytes wait to be written, the new records are
+    dropped and their number is logged. flush() waits until the
+    records logged before are written.
+    """
+
+    MAX_BATCH_SIZE = 64 * 1024
+    MAX_PENDING_SIZE = 1024 * 1024
+    FLUSH_TIMEOUT = 5
+
+    def __init__(self, stream):
+        logging.Handler.__init__(self)
+        self._stream = stream
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._dropped = 0
+        self._writing = False
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+
+        self._thread = threading.Thread(target=self._write_records,
+                                        name='sugar3.logger')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + '\n'
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self._condition:
+            if self._closed:
+                return
+            if self._pending_size + len(message) > self.MAX_PENDING_SIZE:
+                self._dropped += 1
+                return
+            self._pending.append(message)
+            self._pending_size += len(message)
+            self._condition.notify_all()
+
+    def _get_batch(self):
+        if self._dropped:
+            self._pending.appendleft('%f WARNING logger: %d records dropped'
+                                     '\n' % (time.time(), self._dropped))
+            self._dropped = 0
+
+        batch = []
+        size = 0
+        while self._pending and (not batch or size + len(self._pending[0]) <=
+                                 self.MAX_BATCH_SIZE):
+            message = self._pending.popleft()
+            batch.append(message)
+            size += len(message)
+        self._pending_size = max(self._pending_size - size, 0)
+        return ''.join(batch)
+
+    def _write_records(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._dropped and \
+                        not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._pending:
+                    return
+                data = self._get_batch()
+                self._writing = True
+
+            try:
+                self._stream.write(data)
+                self._stream.flush()
+            except Exception, e:
+                # the thread logging is not there to get it
+                print >> sys.__stderr__, 'Cannot write the log: %s' % e
+
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def flush(self):
+        deadline = time.time() + self.FLUSH_TIMEOUT
+        with self._condition:
+            while (self._pending or self._writing) and \
+                    self._thread.is_alive() and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(self.FLUSH_TIMEOUT)
+        logging.Handler.close(self)
+
+
+class _LogRotation(object):
+    """Rotates the log file which stdout and stderr are redirected to
+
+    When the log is bigger than max_size, it is renamed with a number
+    suffix and compressed, and a new log is opened on stdout and
+    stderr. The oldest rotated logs of the same activity are removed
+    when all its logs take more than budget bytes.
+    """
+
+    # bytes written before checking the size of the log
+    CHECK_INTERVAL = 64 * 1024
+
+    def __init__(self, path, max_size, budget):
+        self._path = path
+        self._max_size = max_size
+        self._budget = budget
+        self._written = 0
+        self._rotations = 0
+        self._lock = threading.Lock()
+
+        # <bundle id>-<N>.log, or <name>.log for the services
+        match = re.match(r'(.*?)(-\d+)?\.log$', os.path.basename(path))
+        prefix = match.group(1) if match else os.path.basename(path)
+        self._logs_re = re.compile(re.escape(prefix) +
+                                   r'(-\d+)?\.log(\.\d+(\.gz)?)?$')
+
+    def written(self, size):
+        self._written += size
+        if self._written < self.CHECK_INTERVAL:
+            return
+        self._written = 0
+
+        if not self._lock.acquire(False):
+            # another thread is rotating it
+            return
+        try:
+            if os.fstat(sys.__stderr__.fileno()).st_size >= self._max_size:
+                self._rotate()
+        except (IOError, OSError), e:
+            # keep the current log, we may be out of space
+            print >> sys.__stderr__, 'Cannot rotate the log: %s' % e
+        finally:
+            self._lock.release()
+
+    def _rotate(self):
+        for stream in sys.__stdout__, sys.__stderr__:
+            stream.flush()
+
+        if not self._rotations:
+            # a service may have rotated its log in a previous run
+            name = os.path.basename(self._path)
+            for other_name in os.listdir(os.path.dirname(self._path)):
+                match = re.match(re.escape(name) + r'\.(\d+)(\.gz)?$',
+                                 other_name)
+                if match:
+                    self._rotations = max(self._rotations,
+                                          int(match.group(1)))
+
+        self._rotations += 1
+        rotated_path = '%s.%d' % (self._path, self._rotations)
+        os.rename(self._path, rotated_path)
+        fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                     0644)
+        os.dup2(fd, sys.__stdout__.fileno())
+        os.dup2(fd, sys.__stderr__.fileno())
+        os.close(fd)
+
+        # not a daemon thread, the exit waits for the compression
+        thread = threading.Thread(target=self._compress,
+                                  args=(rotated_path,))
+        thread.start()
+
+    def _compress(self, path):
+        try:
+            with open(path, 'rb') as source:
+                with gzip.open(path + '.gz', 'wb') as destination:
+                    shutil.copyfileobj(source, destination)
+            os.remove(path)
+        except (IOError, OSError), e:
+            print >> sys.__stderr__, 'Cannot compress %s: %s' % (path, e)
+            if os.path.exists(path) and os.path.exists(path + '.gz'):
+                os.remove(path + '.gz')
+
+        if self._budget:
+            self._apply_budget()
+
+    def _apply_budget(self):
+        logs_dir = os.path.dirname(self._path)
+        logs = []
+        for name in os.listdir(logs_dir):
+            if self._logs_re.match(name):
+                path = os.path.join(logs_dir, name)
+                try:
+                    logs.append((os.stat(path), path))
+                except OSError:
+                    # removed meanwhile
+                    pass
+
+        total = sum([log_stat.st_size for log_stat, path_ in logs])
+        # the logs being written are kept
+        rotated = sorted([(rotated_stat.st_mtime, rotated_stat.st_size,
+                           log_path)
+                          for rotated_stat, log_path in logs
+                          if not log_path.endswith('.log')])
+        for mtime_, size, rotated_path in rotated:
+            if total <= self._budget:
+                break
+            try:
+                os.remove(rotated_path)
+                total -= size
+            except OSError:
+                pass
+
+
+def _get_size_setting(name, default, errors):
+    """Read a size from the environment
+
+    The logging is not set up yet, the error messages are appended to
+    errors, to be logged afterwards.
+    """
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        errors.append('Invalid %s: %r' % (name, os.environ[name]))
+        return default
+
+
 def start(log_filename=None):
+    """Log to stderr, and redirect stdout and stderr to log_filename in
+    the logs directory if given.
+
+    The records are written from a background thread, with an
+    AsyncLogHandler, when SUGAR_LOGGER_ASYNC is 1. They are lost if the
+    process crashes before they are written.
+
+    The log file, log_filename or the file given by SUGAR_LOG_FILE, is
+    rotated when bigger than SUGAR_LOGGER_MAX_SIZE bytes, 4 MiB by
+    default, and the rotated logs are compressed. The oldest rotated
+    logs are removed when the logs of the activity take more than
+    SUGAR_LOGGER_BUDGET bytes, 16 MiB by default. 0 disables either.
+    """
     logs_path = env.get_logs_path()
 
     try:
@@ -134,12 +394,15 @@ def start(log_filename=None):
         """Small file-like wrapper to gracefully handle ENOSPC errors when
         logging."""
 
-        def __init__(self, stream):
+        def __init__(self, stream, rotation=None):
             self._stream = stream
+            self._rotation = rotation
 
         def write(self, s):
             try:
                 self._stream.write(s)
+                if self._rotation is not None:
+                    self._rotation.written(len(s))
             except IOError, e:
                 # gracefully deal w/ disk full
                 if e.errno != errno.ENOSPC:
@@ -153,25 +416,45 @@ def start(log_filename=None):
                 if e.errno != errno.ENOSPC:
                     raise e
 
-    logging.basicConfig(
-        level=logging.WARNING,
-        format="%(created)f %(levelname)s %(name)s: %(message)s",
-        stream=SafeLogWrapper(sys.stderr))
+    # set by activityfactory for the activity only, not its children
+    log_path = os.environ.pop('SUGAR_LOG_FILE', None)
+    if log_filename:
+        log_path = os.path.join(logs_path, log_filename + '.log')
+
+    rotation = None
+    errors = []
+    max_size = _get_size_setting('SUGAR_LOGGER_MAX_SIZE', 4 * 1024 * 1024,
+                                 errors)
+    if log_path and max_size > 0:
+        rotation = _LogRotation(
+            log_path, max_size,
+            _get_size_setting('SUGAR_LOGGER_BUDGET', 16 * 1024 * 1024,
+                              errors))
+
+    log_format = "%(created)f %(levelname)s %(name)s: %(message)s"
+    if os.environ.get('SUGAR_LOGGER_ASYNC') == '1':
+        handler = AsyncLogHandler(SafeLogWrapper(sys.stderr, rotation))
+        handler.setFormatter(logging.Formatter(log_format))
+        root_logger.addHandler(handler)
+        root_logger.setLevel(logging.WARNING)
+    else:
+        logging.basicConfig(
+            level=logging.WARNING,
+            format=log_format,
+            stream=SafeLogWrapper(sys.stderr, rotation))
 
     if 'SUGAR_LOGGER_LEVEL' in os.environ:
         set_level(os.environ['SUGAR_LOGGER_LEVEL'])
 
     if log_filename:
         try:
-            log_path = os.path.join(logs_path, log_filename + '.log')
-
             log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT)
             os.dup2(log_fd, sys.stdout.fileno())
             os.dup2(log_fd, sys.stderr.fileno())
             os.close(log_fd)
 
-            sys.stdout = SafeLogWrapper(sys.stdout)
-            sys.stderr = SafeLogWrapper(sys.stderr)
+            sys.stdout = SafeLogWrapper(sys.stdout, rotation)
+            sys.stderr = SafeLogWrapper(sys.stderr, rotation)
         except OSError, e:
             # if we're out of space, just continue
             if e.errno != errno.ENOSPC:
@@ -179,6 +462,9 @@ def start(log_filename=None):
 
     sys.excepthook = _except_hook
 
+    for message in errors:
+        logging.warning(message)
+
 
 class TraceRepr(repr_.Repr):
 
@@ -244,3 +530,184 @@ def trace(logger=None, logger_name=None, skip_args=None, skip_kwargs=None,
         return res
 
     return decorator.decorator(_trace)
+
+
+class TraceBuffer(object):
+    """Fixed size ring buffer of the calls of the functions decorated
+    with trace_calls()
+
+    Each call is recorded in RECORD.size bytes: its start time, its
+    duration, the function, whether it raised an exception and a
+    summary of its first two arguments, their value if they are
+    numbers, their length if they have one.
+    """
+
+    # time, duration, function, flags, argument types, arguments
+    RECORD = struct.Struct('<dfHBB2q')
+
+    _FAILED = 1
+    _ARGUMENT_TYPES = [(bool, 'bool'), ((int, long), 'int'),
+                       (float, 'float'), ((basestring, list, tuple, dict,
+                                           set, frozenset), 'len')]
+    _NONE = 0
+    _LEN = 4
+    _OTHER = len(_ARGUMENT_TYPES) + 1
+    _MIN = -2 ** 63
+    _MAX = 2 ** 63 - 1
+    # exact type -> argument type code
+    _codes = {bool: 1, int: 2, long: 2, float: 3, str: _LEN, unicode: _LEN,
+              list: _LEN, tuple: _LEN, dict: _LEN, set: _LEN,
+              frozenset: _LEN, type(None): _OTHER}
+
+    def __init__(self, size):
+        self._size = size
+        self._data = bytearray(size * self.RECORD.size)
+        # next() is atomic, the threads never write the same record
+        self._counter = itertools.count()
+        self._count = 0
+        self._names = []
+
+    def __len__(self):
+        return min(self._count, self._size)
+
+    def add_function(self, name):
+        """Register a function, return its index for record()"""
+        self._names.append(name)
+        return len(self._names) - 1
+
+    def _summarize(self, argument):
+        code = self._codes.get(type(argument))
+        if code is None:
+            # a subclass
+            for code, (types, kind_) in enumerate(self._ARGUMENT_TYPES, 1):
+                if isinstance(argument, types):
+                    break
+            else:
+                return self._OTHER, 0
+        if code == self._OTHER:
+            return code, 0
+
+        try:
+            if code == self._LEN:
+                value = len(argument)
+            else:
+                value = int(argument)
+        except (OverflowError, TypeError, ValueError):
+            # infinite or not a number
+            return code, 0
+        if not self._MIN <= value <= self._MAX:
+            value = self._MAX if value > 0 else self._MIN
+        return code, value
+
+    def record(self, function, start, duration, failed, args):
+        types = value_0 = value_1 = 0
+        if args:
+            types, value_0 = self._summarize(args[0])
+            if len(args) > 1:
+                type_1, value_1 = self._summarize(args[1])
+                types |= type_1 << 4
+
+        index = next(self._counter)
+        self._count = index + 1
+        self.RECORD.pack_into(self._data,
+                              (index % self._size) * self.RECORD.size,
+                              start, duration, function,
+                              self._FAILED if failed else 0, types,
+                              value_0, value_1)
+
+    def get_records(self):
+        """Return the recorded calls, the oldest first, as tuples of
+        (start time, duration, function name, failed, arguments)"""
+        count = self._count
+        records = []
+        for index in range(max(count - self._size, 0), count):
+            start, duration, function, flags, types, value_0, value_1 = \
+                self.RECORD.unpack_from(
+                    self._data, (index % self._size) * self.RECORD.size)
+
+            arguments = []
+            for i, value in enumerate([value_0, value_1]):
+                code = (types >> (4 * i)) & 0xf
+                if code == self._NONE:
+                    break
+                elif code == self._OTHER:
+                    arguments.append('?')
+                else:
+                    arguments.append('%s=%d' % (
+                        self._ARGUMENT_TYPES[code - 1][1], value))
+
+            records.append((start, duration, self._names[function],
+                            bool(flags & self._FAILED), arguments))
+        return records
+
+    def dump(self, stream):
+        for start, duration, name, failed, arguments in self.get_records():
+            stream.write('%f %9.3fms %s(%s)%s\n' % (
+                start, duration * 1000, name, ', '.join(arguments),
+                ' raised' if failed else ''))
+
+
+_trace_buffer = None
+
+
+def get_trace_buffer():
+    """Return the TraceBuffer of the process, or None when tracing is
+    disabled. It records the last SUGAR_TRACE_BUFFER calls."""
+    global _trace_buffer
+    if _trace_buffer is None:
+        try:
+            size = int(os.environ.get('SUGAR_TRACE_BUFFER', 0))
+        except ValueError:
+            size = 0
+        if size > 0:
+            _trace_buffer = TraceBuffer(size)
+    return _trace_buffer
+
+
+def dump_trace(stream=None):
+    """Write the last traced calls to stream, stderr by default"""
+    trace_buffer = get_trace_buffer()
+    if trace_buffer is not None:
+        trace_buffer.dump(stream or sys.stderr)
+
+
+def trace_calls(skip_args=None):
+    """Decorator recording the calls of a function in the TraceBuffer
+
+    Unlike trace(), it is meant to stay on hot paths. When tracing is
+    disabled, SUGAR_TRACE_BUFFER not set when the function is
+    decorated, the function is returned as is, without any cost.
+
+    Keyword arguments:
+    skip_args -- indexes of the positional arguments not summarized,
+        e.g. [0] for the self of the methods
+
+    """
+    def decorate(function):
+        trace_buffer = get_trace_buffer()
+        if trace_buffer is None:
+            return function
+
+        index = trace_buffer.add_function(
+            '%s.%s' % (function.__module__, function.__name__))
+        skipped = set(skip_args or [])
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                if skipped:
+                    summarized = [argument for i, argument in enumerate(args)
+                                  if i not in skipped]
+                else:
+                    summarized = args
+                trace_buffer.record(index, start, time.time() - start,
+                                    failed, summarized)
+
+        return wrapper
+    return decorate
@@ -24,6 +24,7 @@ STABLE.
 import os
 import logging
 import gettext
+from collections import deque
 
 from gi.repository import GLib
 from gi.repository import GdkPixbuf
@@ -46,10 +47,11 @@ def _get_supported_image_mime_types():
     return mime_types
 
 
-_extensions = {}
-_globs_timestamps = []
-_subclasses = {}
-_subclasses_timestamps = []
+# The extensions and subclasses indexes are built on first use, and
+# dropped when one of the mime database files we read them from changes.
+_extensions = None
+_subclasses = None
+_file_monitors = []
 
 _generic_types = [{
     'id': GENERIC_TYPE_TEXT,
@@ -94,6 +96,13 @@ _generic_types = [{
 }]
 
 
+_generic_type_by_mime = {}
+for _generic_type in _generic_types:
+    for _mime_type in _generic_type['types']:
+        _generic_type_by_mime.setdefault(_mime_type, _generic_type)
+del _generic_type, _mime_type
+
+
 class ObjectType(object):
 
     def __init__(self, type_id, name, icon, mime_types):
@@ -135,6 +144,163 @@ def get_for_file(file_name):
     return mime_type
 
 
+class _MimeTypesLookup(object):
+    """Looks up the mime types of many files, one directory at a time,
+    using a Gio.FileEnumerator so that a single asynchronous request
+    returns the content types of a whole chunk of files.
+    """
+
+    def __init__(self, paths, chunk_cb, finished_cb, fast, chunk_size):
+        self._chunk_cb = chunk_cb
+        self._finished_cb = finished_cb
+        self._chunk_size = chunk_size
+        self.cancellable = Gio.Cancellable()
+
+        if fast:
+            self._content_type_attribute = \
+                Gio.FILE_ATTRIBUTE_STANDARD_FAST_CONTENT_TYPE
+        else:
+            self._content_type_attribute = \
+                Gio.FILE_ATTRIBUTE_STANDARD_CONTENT_TYPE
+        self._attributes = ','.join([Gio.FILE_ATTRIBUTE_STANDARD_NAME,
+                                     Gio.FILE_ATTRIBUTE_STANDARD_TYPE,
+                                     self._content_type_attribute])
+
+        # Queue of (directory path, set of file names) tuples, the set of
+        # names is None when all the files in the directory are wanted.
+        self._pending = deque()
+        self._dir_path = None
+        self._names = None
+
+        names_by_dir = {}
+        for path in paths:
+            if path.startswith('file://'):
+                path = path[7:]
+            dir_path, name = os.path.split(os.path.abspath(path))
+            if not name:
+                self._pending.append((dir_path, None))
+            elif dir_path in names_by_dir:
+                names_by_dir[dir_path].add(name)
+            else:
+                names_by_dir[dir_path] = set([name])
+                self._pending.append((dir_path, names_by_dir[dir_path]))
+
+    def start(self):
+        GLib.idle_add(self._next_directory)
+
+    def _next_directory(self):
+        if self.cancellable.is_cancelled():
+            return
+
+        if not self._pending:
+            if self._finished_cb is not None:
+                self._finished_cb()
+            return
+
+        self._dir_path, self._names = self._pending.popleft()
+        directory = Gio.File.new_for_path(self._dir_path)
+        directory.enumerate_children_async(
+            self._attributes, Gio.FileQueryInfoFlags.NONE,
+            GLib.PRIORITY_DEFAULT, self.cancellable,
+            self.__enumerate_children_cb, None)
+
+    def __enumerate_children_cb(self, directory, result, user_data=None):
+        try:
+            enumerator = directory.enumerate_children_finish(result)
+        except GLib.GError, e:
+            if self.cancellable.is_cancelled():
+                return
+            logging.warning('Cannot list %s: %s', self._dir_path, e)
+            self._guess_remaining()
+            self._next_directory()
+            return
+
+        enumerator.next_files_async(self._chunk_size, GLib.PRIORITY_DEFAULT,
+                                    self.cancellable, self.__next_files_cb,
+                                    None)
+
+    def __next_files_cb(self, enumerator, result, user_data=None):
+        try:
+            infos = enumerator.next_files_finish(result)
+        except GLib.GError, e:
+            if self.cancellable.is_cancelled():
+                return
+            logging.warning('Cannot list %s: %s', self._dir_path, e)
+            infos = []
+
+        chunk = []
+        for info in infos:
+            name = info.get_name()
+            if self._names is not None:
+                if name not in self._names:
+                    continue
+                self._names.remove(name)
+
+            path = os.path.join(self._dir_path, name)
+            if info.get_file_type() == Gio.FileType.DIRECTORY:
+                self._pending.append((path, None))
+            else:
+                mime_type = info.get_attribute_string(
+                    self._content_type_attribute)
+                chunk.append((path, mime_type))
+
+        if chunk:
+            self._chunk_cb(chunk)
+
+        if not infos or self._names is not None and not self._names:
+            enumerator.close(None)
+            self._guess_remaining()
+            self._next_directory()
+        else:
+            enumerator.next_files_async(self._chunk_size,
+                                        GLib.PRIORITY_DEFAULT,
+                                        self.cancellable,
+                                        self.__next_files_cb, None)
+
+    def _guess_remaining(self):
+        """Guess from their names the type of the wanted files which
+        were not found in the directory listing."""
+        if not self._names:
+            return
+
+        chunk = []
+        for name in sorted(self._names):
+            path = os.path.join(self._dir_path, name)
+            chunk.append((path, Gio.content_type_guess(path, None)[0]))
+            if len(chunk) == self._chunk_size:
+                self._chunk_cb(chunk)
+                chunk = []
+        if chunk:
+            self._chunk_cb(chunk)
+        self._names = None
+
+
+def get_for_files(paths, chunk_cb, finished_cb=None, fast=False,
+                  chunk_size=100):
+    """Asynchronously get the mime types of many files.
+
+    Files in the same directory are looked up together, which is much
+    cheaper than calling get_for_file() for each of them.
+
+    Keyword arguments:
+    paths -- list of file paths or file:// uris. A directory stands for
+             all the files it contains, recursively
+    chunk_cb -- called from the main loop with a list of
+                (path, mime_type) tuples as the results become available
+    finished_cb -- called without arguments after the last chunk
+                   (default None)
+    fast -- only guess the mime types from the file names, without
+            reading the file contents (default False)
+    chunk_size -- maximum number of files in each chunk (default 100)
+
+    Return: a Gio.Cancellable which can be used to stop the lookup
+
+    """
+    lookup = _MimeTypesLookup(paths, chunk_cb, finished_cb, fast, chunk_size)
+    lookup.start()
+    return lookup.cancellable
+
+
 def get_from_file_name(file_name):
     """
     DEPRECATED: 0.102 (removed in 4 releases)
@@ -160,39 +326,10 @@ def get_mime_description(mime_type):
 
 
 def get_mime_parents(mime_type):
-    global _subclasses
-    global _subclasses_timestamps
+    if _subclasses is None:
+        _load_mime_database()
 
-    dirs = _get_mime_data_directories()
-
-    timestamps = []
-    subclasses_path_list = []
-    for f in dirs:
-        subclasses_path = os.path.join(f, 'mime', 'subclasses')
-        try:
-            mtime = os.stat(subclasses_path).st_mtime
-            timestamps.append([subclasses_path, mtime])
-            subclasses_path_list.append(subclasses_path)
-        except OSError:
-            pass
-
-    if timestamps != _subclasses_timestamps:
-        _subclasses = {}
-        for subclasses_path in subclasses_path_list:
-            with open(subclasses_path) as parents_file:
-                for line in parents_file:
-                    subclass, parent = line.split()
-                    if subclass not in _subclasses.keys():
-                        _subclasses[subclass] = [parent]
-                    else:
-                        _subclasses[subclass].append(parent)
-
-        _subclasses_timestamps = timestamps
-
-    if mime_type in _subclasses.keys():
-        return _subclasses[mime_type]
-    else:
-        return []
+    return list(_subclasses.get(mime_type, []))
 
 
 def _get_mime_data_directories():
@@ -210,44 +347,86 @@ def _get_mime_data_directories():
     return dirs
 
 
-def get_primary_extension(mime_type):
+def _mime_database_changed_cb(monitor, changed_file, other_file, event_type):
     global _extensions
-    global _globs_timestamps
+    global _subclasses
 
-    dirs = _get_mime_data_directories()
+    if event_type in (Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                      Gio.FileMonitorEvent.CREATED,
+                      Gio.FileMonitorEvent.DELETED):
+        logging.debug('Mime database %s changed.', changed_file.get_path())
+        _extensions = None
+        _subclasses = None
 
-    timestamps = []
-    globs_path_list = []
-    for f in dirs:
-        globs_path = os.path.join(f, 'mime', 'globs')
-        if os.path.exists(globs_path):
-            mtime = os.stat(globs_path).st_mtime
-            timestamps.append([globs_path, mtime])
-            globs_path_list.append(globs_path)
 
-    if timestamps != _globs_timestamps:
-        # Clear the old extensions list
-        _extensions = {}
+def _watch_mime_database(paths):
+    if _file_monitors:
+        return
 
-        # FIXME Properly support these types in the system. (#4855)
-        _extensions['audio/ogg'] = 'ogg'
-        _extensions['video/ogg'] = 'ogg'
+    for path in paths:
+        try:
+            monitor = Gio.File.new_for_path(path).monitor_file(
+                Gio.FileMonitorFlags.NONE, None)
+        except GLib.GError:
+            logging.warning('Cannot monitor mime database file %s', path)
+            continue
+        monitor.connect('changed', _mime_database_changed_cb)
+        _file_monitors.append(monitor)
 
-        for globs_path in globs_path_list:
+
+def _load_mime_database():
+    global _extensions
+    global _subclasses
+
+    globs_paths = []
+    subclasses_paths = []
+    for f in _get_mime_data_directories():
+        globs_paths.append(os.path.join(f, 'mime', 'globs'))
+        subclasses_paths.append(os.path.join(f, 'mime', 'subclasses'))
+
+    # Monitor the files before reading them, so that we don't miss
+    # changes happening while we are loading.
+    _watch_mime_database(globs_paths + subclasses_paths)
+
+    extensions = {}
+
+    # FIXME Properly support these types in the system. (#4855)
+    extensions['audio/ogg'] = 'ogg'
+    extensions['video/ogg'] = 'ogg'
+
+    for globs_path in globs_paths:
+        try:
             globs_file = open(globs_path)
-            for line in globs_file.readlines():
+        except IOError:
+            continue
+        with globs_file:
+            for line in globs_file:
                 line = line.strip()
-                if not line.startswith('#'):
-                    line_type, glob = line.split(':')
+                if line and not line.startswith('#'):
+                    line_type, glob = line.split(':', 1)
                     if glob.startswith('*.'):
-                        _extensions[line_type] = glob[2:]
+                        extensions[line_type] = glob[2:]
 
-        _globs_timestamps = timestamps
+    subclasses = {}
+    for subclasses_path in subclasses_paths:
+        try:
+            parents_file = open(subclasses_path)
+        except IOError:
+            continue
+        with parents_file:
+            for line in parents_file:
+                subclass, parent = line.split()
+                subclasses.setdefault(subclass, []).append(parent)
 
-    if mime_type in _extensions:
-        return _extensions[mime_type]
-    else:
-        return None
+    _extensions = extensions
+    _subclasses = subclasses
+
+
+def get_primary_extension(mime_type):
+    if _extensions is None:
+        _load_mime_database()
+
+    return _extensions.get(mime_type)
 
 
 _MIME_TYPE_BLACK_LIST = [
@@ -301,7 +480,4 @@ def split_uri_list(uri_list):
 
 
 def _get_generic_type_for_mime(mime_type):
-    for generic_type in _generic_types:
-        if mime_type in generic_type['types']:
-            return generic_type
-    return None
+    return _generic_type_by_mime.get(mime_type)
@@ -20,10 +20,20 @@ STABLE.
 """
 
 import os
+import base64
+import collections
+import errno
+import logging
+import socket
+import stat
 import threading
+import time
 import urllib
-import fcntl
+import urlparse
 import tempfile
+import email.utils
+import mimetools
+import StringIO
 
 from gi.repository import GObject
 import SimpleHTTPServer
@@ -33,6 +43,35 @@ import SocketServer
 __authinfos = {}
 
 
+def _get_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        libc_sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        sent = libc_sendfile(out_fd, in_fd,
+                             ctypes.byref(ctypes.c_int64(offset)), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+
+    return sendfile
+
+
+_sendfile = _get_sendfile()
+
+
 def _add_authinfo(authinfo):
     __authinfos[threading.currentThread()] = authinfo
 
@@ -45,22 +84,125 @@ def _del_authinfo():
     del __authinfos[threading.currentThread()]
 
 
+class _CachedFileReader(object):
+    """Reads a file of the FileCache, like a file opened in binary mode"""
+
+    def __init__(self, data, file_stat):
+        self._data = data
+        self._position = 0
+        self.stat = file_stat
+
+    def read(self, size=-1):
+        end = len(self._data)
+        if size >= 0:
+            end = min(self._position + size, end)
+        # no copy, the data is shared by the readers of the file
+        data = buffer(self._data, self._position,
+                      max(end - self._position, 0))
+        self._position = max(end, self._position)
+        return data
+
+    def seek(self, position):
+        self._position = position
+
+    def close(self):
+        self._data = None
+
+
+class FileCache(object):
+    """Bounded cache of the files served by a GlibTCPServer
+
+    The recently served files are kept in memory, so the requests for
+    the same file share one copy instead of reading it again. A file is
+    checked with stat() on each request, and read again when it
+    changed. The least recently served files are dropped when the
+    cached files exceed max_size.
+
+    The files are copied rather than memory mapped: an activity may
+    truncate or rewrite a shared document in place while it is being
+    sent, and reading past the end of a truncated mapping kills the
+    whole process with SIGBUS. A transfer started before such a change
+    sends the previous contents.
+
+    Keyword arguments:
+    max_size -- total size of the cached files, in bytes
+    max_file_size -- larger files are not cached
+
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024,
+                 max_file_size=16 * 1024 * 1024):
+        self._max_size = max_size
+        self._max_file_size = min(max_file_size, max_size)
+        # path -> (stat key, data, stat), least recently used first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, path):
+        """Return a reader of the file, or None if it cannot be cached"""
+        file_stat = os.stat(path)
+        key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+               file_stat.st_mtime)
+
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            if entry[0] == key:
+                self._entries[path] = entry
+                self.hits += 1
+                return _CachedFileReader(entry[1], entry[2])
+            # changed since it was read
+            self._size -= len(entry[1])
+
+        self.misses += 1
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0 \
+                or file_stat.st_size > self._max_file_size:
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read(self._max_file_size + 1)
+        if len(data) > self._max_file_size:
+            # it grew since stat()
+            return None
+        self._entries[path] = (key, data, file_stat)
+        self._size += len(data)
+
+        while self._size > self._max_size:
+            path_, entry = self._entries.popitem(last=False)
+            # the readers still sending it keep the data alive
+            self._size -= len(entry[1])
+
+        return _CachedFileReader(data, file_stat)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+
 class GlibTCPServer(SocketServer.TCPServer):
     """GlibTCPServer
 
     Integrate socket accept into glib mainloop.
+
+    Keyword arguments:
+    file_cache -- a FileCache for the request handlers, or None
+
     """
 
     allow_reuse_address = True
     request_queue_size = 20
 
-    def __init__(self, server_address, RequestHandlerClass):
+    def __init__(self, server_address, RequestHandlerClass,
+                 file_cache=None):
+        self.file_cache = file_cache
         SocketServer.TCPServer.__init__(self, server_address,
                                         RequestHandlerClass)
         self.socket.setblocking(0)  # Set nonblocking
 
         # Watch the listener socket for data
-        GObject.io_add_watch(self.socket, GObject.IO_IN, self._handle_accept)
+        self._srcid = GObject.io_add_watch(self.socket, GObject.IO_IN,
+                                           self._handle_accept)
 
     def _handle_accept(self, source, condition):
         """Process incoming data on the server's socket by doing an accept()
@@ -70,6 +212,10 @@ class GlibTCPServer(SocketServer.TCPServer):
         self.handle_request()
         return True
 
+    def server_close(self):
+        GObject.source_remove(self._srcid)
+        SocketServer.TCPServer.server_close(self)
+
     def close_request(self, request):
         """Called to clean up an individual request."""
         # let the request be closed by the request handler when its done
@@ -86,43 +232,204 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     """RequestHandler class that integrates with Glib mainloop.  It writes
        the specified file to the client in chunks, returning control to the
        mainloop between chunks.
+
+       Files are sent with sendfile(), without copying them through
+       Python, when USE_SENDFILE is True and the system supports it. The
+       chunks grow from CHUNK_SIZE up to MAX_CHUNK_SIZE while the client
+       keeps up, and shrink to what the socket accepted when it doesn't.
+
+       HTTP/1.1 connections are kept open for the next request, for up
+       to KEEP_ALIVE_TIMEOUT seconds. A single byte range can be
+       requested, to resume a transfer, and conditional requests are
+       answered with 304 Not Modified when the file did not change.
     """
 
     CHUNK_SIZE = 4096
+    MAX_CHUNK_SIZE = 4 * 1024 * 1024
+    USE_SENDFILE = True
+    KEEP_ALIVE_TIMEOUT = 15
+
+    protocol_version = 'HTTP/1.1'
+    # reading the request blocks the mainloop, don't wait forever
+    timeout = 10
 
     def __init__(self, request, client_address, server):
         self._file = None
         self._srcid = 0
+        self._timeout_id = 0
+        self._use_sendfile = False
+        self._range = None
+        self._offset = 0
+        self._size = None
+        self._buffer = ''
+        self._chunk_size = self.CHUNK_SIZE
         SimpleHTTPServer.SimpleHTTPRequestHandler.__init__(
             self, request, client_address, server)
 
     def log_request(self, code='-', size='-'):
         pass
 
+    def handle(self):
+        """Read the requests from the mainloop, once they arrive"""
+        self.close_connection = 0
+        self._wait_for_request()
+
+    def _handle_request(self):
+        self._range = None
+        try:
+            self.handle_one_request()
+        except socket.error, e:
+            logging.debug('Request from %s failed: %s',
+                          self.client_address[0], e)
+            self.close_connection = 1
+
+        if self._file is None:
+            # nothing to transfer: a HEAD request, an error or not modified
+            self._end_request()
+
+    def _end_request(self):
+        if self.close_connection:
+            self._cleanup()
+        else:
+            self._wait_for_request()
+
+    def _wait_for_request(self):
+        self.connection.settimeout(self.timeout)
+        if getattr(self.rfile, '_rbuf', None) and self.rfile._rbuf.tell():
+            # the next request is already buffered, it was pipelined
+            self._srcid = GObject.idle_add(self.__next_request_cb)
+        else:
+            self._srcid = GObject.io_add_watch(self.rfile, GObject.IO_IN |
+                                               GObject.IO_ERR |
+                                               GObject.IO_HUP,
+                                               self.__next_request_cb)
+        self._timeout_id = GObject.timeout_add_seconds(
+            self.KEEP_ALIVE_TIMEOUT, self.__keep_alive_timeout_cb)
+
+    def __next_request_cb(self, *args):
+        self._srcid = 0
+        GObject.source_remove(self._timeout_id)
+        self._timeout_id = 0
+        self._handle_request()
+        return False
+
+    def __keep_alive_timeout_cb(self):
+        self._timeout_id = 0
+        self._cleanup()
+        return False
+
     def do_GET(self):
         """Serve a GET request."""
         self._file = self.send_head()
         if self._file:
-            self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
-                                               GObject.IO_ERR,
-                                               self._send_next_chunk)
+            self._start_transfer()
+
+    def _start_transfer(self):
+        if self._range is None:
+            # a directory listing, sent until its end
+            self._offset = 0
+            self._size = None
         else:
-            self._cleanup()
+            self._offset, self._size = self._range
+            self._file.seek(self._offset)
+        self._buffer = ''
+        self._chunk_size = self.CHUNK_SIZE
+        # the cached files are sent from memory
+        self._use_sendfile = self.USE_SENDFILE and _sendfile is not None \
+            and self._size is not None and hasattr(self._file, 'fileno')
+
+        self.wfile.flush()
+        self.connection.setblocking(0)
+        self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
+                                           GObject.IO_ERR | GObject.IO_HUP,
+                                           self._send_next_chunk)
 
     def _send_next_chunk(self, source, condition):
-        if condition & GObject.IO_ERR:
-            self._cleanup()
-            return False
-        if not (condition & GObject.IO_OUT):
-            self._cleanup()
+        if condition & (GObject.IO_ERR | GObject.IO_HUP) or \
+                not (condition & GObject.IO_OUT):
+            self.close_connection = 1
+            self._finish_transfer()
             return False
-        data = self._file.read(self.CHUNK_SIZE)
-        count = os.write(self.wfile.fileno(), data)
-        if count != len(data) or len(data) != self.CHUNK_SIZE:
-            self._cleanup()
+
+        try:
+            if self._use_sendfile:
+                done = self._send_file_chunk()
+            else:
+                done = self._send_buffer_chunk()
+        except (IOError, OSError), e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            logging.debug('Transfer of %s interrupted: %s', self.path, e)
+            self.close_connection = 1
+            done = True
+
+        if done:
+            self._finish_transfer()
             return False
         return True
 
+    def _send_file_chunk(self):
+        count = min(self._chunk_size, self._size - self._offset)
+        if count <= 0:
+            return True
+
+        try:
+            sent = _sendfile(self.connection.fileno(), self._file.fileno(),
+                             self._offset, count)
+        except OSError, e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            # the file system does not support sendfile()
+            self._use_sendfile = False
+            self._file.seek(self._offset)
+            return self._send_buffer_chunk()
+
+        if sent == 0:
+            # the file was truncated, the client cannot tell where the
+            # response ends
+            self.close_connection = 1
+            return True
+
+        self._offset += sent
+        self._adapt_chunk_size(sent, count)
+        return self._offset >= self._size
+
+    def _send_buffer_chunk(self):
+        if not self._buffer:
+            count = self._chunk_size
+            if self._size is not None:
+                count = min(count, self._size - self._offset)
+            if count > 0:
+                self._buffer = self._file.read(count)
+            if not self._buffer:
+                if self._size is not None and self._offset < self._size:
+                    # truncated, see _send_file_chunk()
+                    self.close_connection = 1
+                return True
+
+        count = len(self._buffer)
+        sent = self.connection.send(self._buffer)
+        self._buffer = self._buffer[sent:]
+        self._offset += sent
+        self._adapt_chunk_size(sent, count)
+        return self._size is not None and self._offset >= self._size
+
+    def _adapt_chunk_size(self, sent, count):
+        if sent == count:
+            self._chunk_size = min(self._chunk_size * 2, self.MAX_CHUNK_SIZE)
+        else:
+            # the socket buffer is full, asking for more is useless
+            self._chunk_size = max(sent, self.CHUNK_SIZE)
+
+    def _finish_transfer(self):
+        if self._srcid > 0:
+            GObject.source_remove(self._srcid)
+            self._srcid = 0
+        self._file.close()
+        self._file = None
+        self._buffer = ''
+        self._end_request()
+
     def _cleanup(self):
         if self._file:
             self._file.close()
@@ -130,10 +437,17 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if self._srcid > 0:
             GObject.source_remove(self._srcid)
             self._srcid = 0
+        if self._timeout_id > 0:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = 0
         if not self.wfile.closed:
-            self.wfile.flush()
+            try:
+                self.wfile.flush()
+            except socket.error:
+                pass
         self.wfile.close()
         self.rfile.close()
+        self.connection.close()
 
     def finish(self):
         """Close the sockets when we're done, not before"""
@@ -167,24 +481,170 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 return self.list_directory(path)
         ctype = self.guess_type(path)
         try:
-            # Always read in binary mode. Opening files in text mode may cause
-            # newline translations, making the actual size of the content
-            # transmitted *less* than the content-length!
-            f = open(path, 'rb')
-        except IOError:
+            f, file_stat = self._open_file(path)
+        except (IOError, OSError):
             self.send_error(404, 'File not found')
             return None
-        self.send_response(200)
+
+        size = file_stat.st_size
+        etag = '"%x-%x-%x"' % (file_stat.st_ino, size,
+                               int(file_stat.st_mtime))
+        last_modified = self.date_time_string(int(file_stat.st_mtime))
+
+        if self._is_not_modified(etag, file_stat.st_mtime):
+            f.close()
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return None
+
+        byte_range = self._get_range(size, etag, last_modified)
+        if byte_range is None:
+            self._range = (0, size)
+            self.send_response(200)
+        elif byte_range[0] >= size:
+            f.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        else:
+            self._range = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (byte_range[0], byte_range[1] - 1, size))
         self.send_header('Content-type', ctype)
-        self.send_header('Content-Length', str(os.fstat(f.fileno())[6]))
+        self.send_header('Content-Length',
+                         str(self._range[1] - self._range[0]))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
         self.send_header('Content-Disposition', 'attachment; filename="%s"' %
                          os.path.basename(path))
         self.end_headers()
         return f
 
+    def _open_file(self, path):
+        """Return the file to send and its stat"""
+        file_cache = getattr(self.server, 'file_cache', None)
+        if file_cache is not None:
+            cached_file = file_cache.open(path)
+            if cached_file is not None:
+                return cached_file, cached_file.stat
+
+        # Always read in binary mode. Opening files in text mode may cause
+        # newline translations, making the actual size of the content
+        # transmitted *less* than the content-length!
+        f = open(path, 'rb')
+        return f, os.fstat(f.fileno())
+
+    def _is_not_modified(self, etag, mtime):
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def _get_range(self, size, etag, last_modified):
+        """Return the requested (start, end) byte range, end excluded, or
+        None to send the whole file. start is not below size when the
+        range cannot be satisfied.
+        """
+        header = self.headers.getheader('Range')
+        if not header:
+            return None
+
+        if_range = self.headers.getheader('If-Range')
+        if if_range and if_range.strip() not in (etag, last_modified):
+            # the file changed since the first part was downloaded
+            return None
+
+        unit, sep_, specs = header.partition('=')
+        if unit.strip().lower() != 'bytes' or ',' in specs:
+            # several ranges are not supported, send the whole file
+            return None
+
+        first, sep, last = specs.strip().partition('-')
+        try:
+            if not sep:
+                return None
+            elif first:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+                if last and int(last) < start:
+                    return None
+            elif last:
+                # the last bytes of the file
+                if int(last) == 0:
+                    return (size, size)
+                start = max(size - int(last), 0)
+                end = size
+            else:
+                return None
+        except ValueError:
+            return None
+        return (start, end)
+
+
+def _get_basic_auth(parts):
+    """The credentials of a split URL, for an Authorization header"""
+    if parts.username is None:
+        return None
+    credentials = urllib.unquote(parts.username)
+    if parts.password is not None:
+        credentials += ':' + urllib.unquote(parts.password)
+    return 'Basic ' + base64.b64encode(credentials)
+
+
+class _Segment(object):
+    """A byte range of a download, fetched over its own connection"""
+
+    def __init__(self, start, end=None):
+        self.start = start
+        # None until the length is known
+        self.end = end
+        self.position = start
+        self.socket = None
+        self.srcid = 0
+        self.data = ''
+        self.headers_received = False
+        self.done = False
+
+    def close(self):
+        if self.srcid > 0:
+            GObject.source_remove(self.srcid)
+            self.srcid = 0
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
 
 class GlibURLDownloader(GObject.GObject):
-    """Grabs a URL in chunks, returning to the mainloop after each chunk"""
+    """Downloads a URL without blocking the mainloop
+
+    http URLs are fetched over non-blocking sockets, the host name being
+    resolved in a thread. When resume is True, a destination file which
+    already has data is completed with a range request, and a failed or
+    canceled download leaves what was received, ready to be resumed.
+    The ranges are requested with If-Range, so that the data of another
+    version of the file is never appended: to resume the download of
+    an interrupted downloader, pass the validator returned by its
+    get_validator().
+    With segments above 1, a large file is fetched in as many byte
+    ranges, over parallel connections. Other URL types are read with
+    urllib in a thread.
+
+    The progress signal is emitted at most every PROGRESS_INTERVAL
+    seconds, with the size of the data downloaded so far.
+    """
 
     __gsignals__ = {
         'finished': (GObject.SignalFlags.RUN_FIRST, None,
@@ -195,23 +655,42 @@ class GlibURLDownloader(GObject.GObject):
                      ([GObject.TYPE_PYOBJECT])),
     }
 
-    CHUNK_SIZE = 4096
+    CHUNK_SIZE = 65536
+    PROGRESS_INTERVAL = 0.5
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    MAX_REDIRECTS = 5
+    MAX_HEADERS_SIZE = 65536
 
-    def __init__(self, url, destdir=None):
+    def __init__(self, url, destdir=None, resume=False, segments=1,
+                 validator=None):
         self._url = url
         if not destdir:
             destdir = tempfile.gettempdir()
         self._destdir = destdir
-        self._srcid = 0
+        self._resume = resume
+        self._segment_count = max(segments, 1)
         self._fname = None
         self._outf = None
         self._suggested_fname = None
-        self._info = None
-        self._written = 0
+        self._headers = None
+        self._segments = []
+        self._offset = 0
+        self._total = None
+        self._validator = validator
+        self._addresses = []
+        self._address_index = 0
+        self._family = None
+        self._address = None
+        self._host = None
+        self._authorization = None
+        self._proxy_authorization = None
+        self._request_path = None
+        self._redirects = 0
+        self._request_id = 0
+        self._last_progress = 0
         GObject.GObject.__init__(self)
 
     def start(self, destfile=None, destfd=None):
-        self._info = urllib.urlopen(self._url)
         self._outf = None
         self._fname = None
         if destfd and not destfile:
@@ -224,11 +703,11 @@ class GlibURLDownloader(GObject.GObject):
                 # Use the user-supplied destination file descriptor
                 self._outf = destfd
             else:
-                self._outf = os.open(self._fname, os.O_RDWR |
-                                     os.O_TRUNC | os.O_CREAT, 0644)
+                flags = os.O_RDWR | os.O_CREAT
+                if not self._resume:
+                    flags |= os.O_TRUNC
+                self._outf = os.open(self._fname, flags, 0644)
         else:
-            fname = self._get_filename_from_headers(self._info.headers)
-            self._suggested_fname = fname
             garbage_, path = urllib.splittype(self._url)
             garbage_, path = urllib.splithost(path or "")
             path, garbage_ = urllib.splitquery(path or "")
@@ -237,15 +716,419 @@ class GlibURLDownloader(GObject.GObject):
             (self._outf, self._fname) = tempfile.mkstemp(suffix=suffix,
                                                          dir=self._destdir)
 
-        fcntl.fcntl(self._info.fp.fileno(), fcntl.F_SETFD, os.O_NDELAY)
-        self._srcid = GObject.io_add_watch(self._info.fp.fileno(),
-                                           GObject.IO_IN | GObject.IO_ERR,
-                                           self._read_next_chunk)
+        self._offset = 0
+        if self._resume:
+            self._offset = os.lseek(self._outf, 0, os.SEEK_END)
+        self._redirects = 0
+        self._open(self._url)
 
     def cancel(self):
-        if self._srcid == 0:
+        if self._outf is None:
             raise RuntimeError('Download already canceled or stopped')
-        self.cleanup(remove=True)
+        self._abort()
+
+    def get_size(self):
+        """Size of the file, once known from the response headers"""
+        return self._total
+
+    def get_validator(self):
+        """ETag or Last-Modified date of the file, once known from the
+        response headers"""
+        return self._validator
+
+    def _open(self, url):
+        self._url = url
+        self._request_id += 1
+        self._total = None
+        self._segments = []
+
+        url_type, rest = urllib.splittype(url)
+        if url_type != 'http':
+            # restart from the beginning, urllib cannot request a range
+            self._offset = 0
+            os.ftruncate(self._outf, 0)
+            self._run_in_thread(self._download_with_urllib, url,
+                                self._request_id)
+            return
+
+        parts = urlparse.urlsplit(url)
+        # without the user name and password
+        self._host = parts.netloc.rpartition('@')[2]
+        self._authorization = _get_basic_auth(parts)
+        self._proxy_authorization = None
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                    ''))
+        proxy = urllib.getproxies().get('http')
+        if proxy and not urllib.proxy_bypass(self._host):
+            self._request_path = 'http://%s%s' % (self._host, path)
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            server = urlparse.urlsplit(proxy)
+            self._proxy_authorization = _get_basic_auth(server)
+        else:
+            self._request_path = path
+            server = parts
+
+        try:
+            port = server.port or 80
+        except ValueError:
+            port = None
+        if not server.hostname or port is None:
+            self._fail('Invalid URL %s' % url)
+            return
+        self._run_in_thread(socket.getaddrinfo, server.hostname, port, 0,
+                            socket.SOCK_STREAM,
+                            callback=self.__resolved_cb)
+
+    def _run_in_thread(self, function, *args, **kwargs):
+        """Call function in a thread, then callback(result, error,
+        request_id) from the mainloop"""
+        callback = kwargs.get('callback')
+        request_id = self._request_id
+
+        def __run():
+            result = error = None
+            try:
+                result = function(*args)
+            except Exception, e:
+                error = e
+            if callback is not None:
+                GObject.idle_add(callback, result, error, request_id)
+
+        GObject.threads_init()
+        thread = threading.Thread(target=__run)
+        thread.daemon = True
+        thread.start()
+
+    def __resolved_cb(self, addresses, error, request_id):
+        if request_id != self._request_id:
+            return False
+        if error is not None:
+            self._fail('Cannot resolve %s: %s' % (self._host, error))
+            return False
+
+        # tried in turn, like socket.create_connection() does
+        self._addresses = [(family, address) for
+                           family, type_, proto, canonname_, address
+                           in addresses]
+        self._address_index = 0
+        self._family, self._address = self._addresses[0]
+        segment = _Segment(self._offset)
+        self._segments.append(segment)
+        self._connect(segment)
+        return False
+
+    def _connect(self, segment):
+        segment.socket = socket.socket(self._family, socket.SOCK_STREAM)
+        segment.socket.setblocking(0)
+        error = segment.socket.connect_ex(self._address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._connect_failed(segment, error)
+            return
+
+        request = ['GET %s HTTP/1.0' % self._request_path,
+                   'Host: %s' % self._host,
+                   'Accept-Encoding: identity']
+        if self._authorization is not None:
+            request.append('Authorization: ' + self._authorization)
+        if self._proxy_authorization is not None:
+            request.append('Proxy-Authorization: ' +
+                           self._proxy_authorization)
+        if segment.end is not None:
+            request.append('Range: bytes=%d-%d' %
+                           (segment.start, segment.end - 1))
+        elif segment.start > 0 or self._segment_count > 1:
+            # an open range, the response tells the size of the file
+            request.append('Range: bytes=%d-' % segment.start)
+        if request[-1].startswith('Range:') and self._validator is not None:
+            # the whole file is sent if it changed
+            request.append('If-Range: %s' % self._validator)
+        segment.data = '\r\n'.join(request) + '\r\n\r\n'
+        segment.srcid = GObject.io_add_watch(segment.socket, GObject.IO_OUT |
+                                             GObject.IO_ERR | GObject.IO_HUP,
+                                             self.__send_request_cb, segment)
+
+    def __send_request_cb(self, source, condition, segment):
+        error = segment.socket.getsockopt(socket.SOL_SOCKET,
+                                          socket.SO_ERROR)
+        if error:
+            # the watch is removed by returning False
+            segment.srcid = 0
+            self._connect_failed(segment, error)
+            return False
+
+        try:
+            sent = segment.socket.send(segment.data)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            self._fail('Error downloading file: %s' % e)
+            return False
+
+        segment.data = segment.data[sent:]
+        if segment.data:
+            return True
+        segment.srcid = GObject.io_add_watch(segment.socket, GObject.IO_IN |
+                                             GObject.IO_ERR | GObject.IO_HUP,
+                                             self.__receive_cb, segment)
+        return False
+
+    def __receive_cb(self, source, condition, segment):
+        try:
+            data = segment.socket.recv(self.CHUNK_SIZE)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            self._fail('Error downloading file: %s' % e)
+            return False
+
+        if not segment.headers_received:
+            if not data:
+                self._fail('Error downloading file: connection closed')
+                return False
+            segment.data += data
+            headers_end = segment.data.find('\r\n\r\n')
+            if headers_end < 0:
+                if len(segment.data) > self.MAX_HEADERS_SIZE:
+                    self._fail('Error downloading file: invalid response')
+                    return False
+                return True
+
+            data = segment.data[headers_end + 4:]
+            headers = segment.data[:headers_end]
+            segment.data = ''
+            segment.headers_received = True
+            if not self._handle_response(segment, headers):
+                return False
+            if not data:
+                return True
+
+        if not data:
+            if segment.end is not None and segment.position < segment.end:
+                self._fail('Error downloading file: connection closed')
+                return False
+            # the length was unknown, the end of the data ends the file
+            self._segment_done(segment)
+            return False
+
+        if segment.end is not None:
+            # the first segment is an open range cut after its end
+            data = data[:segment.end - segment.position]
+        if not self._write(segment, data):
+            return False
+
+        if segment.end is not None and segment.position >= segment.end:
+            self._segment_done(segment)
+            return False
+        return True
+
+    def _connect_failed(self, segment, error):
+        segment.close()
+        if self._address_index + 1 < len(self._addresses):
+            logging.debug('Cannot connect to %s at %s: %s', self._host,
+                          self._address, os.strerror(error))
+            self._address_index += 1
+            self._family, self._address = \
+                self._addresses[self._address_index]
+            self._connect(segment)
+            return
+        self._fail('Cannot connect to %s: %s' %
+                   (self._host, os.strerror(error)))
+
+    def _get_response_validator(self, headers):
+        etag = headers.getheader('ETag')
+        # If-Range requires a strong ETag
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.getheader('Last-Modified')
+
+    def _handle_response(self, segment, headers):
+        status_line, garbage_, headers = headers.partition('\r\n')
+        try:
+            status = int(status_line.split(None, 2)[1])
+        except (IndexError, ValueError):
+            self._fail('Error downloading file: invalid response')
+            return False
+        headers = mimetools.Message(StringIO.StringIO(headers + '\r\n\r\n'))
+        first = segment is self._segments[0]
+
+        if status in (301, 302, 303, 307, 308) and first and \
+                headers.getheader('Location'):
+            self._redirects += 1
+            if self._redirects > self.MAX_REDIRECTS:
+                self._fail('Error downloading file: too many redirects')
+                return False
+            segment.close()
+            self._open(urlparse.urljoin(self._url,
+                                        headers.getheader('Location')))
+            return False
+
+        if status == 416 and first and segment.start > 0:
+            segment.close()
+            content_range = headers.getheader('Content-Range', '')
+            if content_range == 'bytes */%d' % segment.start:
+                # resuming a download which was complete
+                segment.end = segment.start
+                self._total = segment.start
+                self._segment_done(segment)
+            else:
+                self._restart()
+            return False
+
+        validator = self._get_response_validator(headers)
+        if status == 206 and self._validator is not None and \
+                validator is not None and validator != self._validator:
+            # If-Range was ignored, the file changed
+            logging.debug('%s changed, downloading it again', self._url)
+            self._restart()
+            return False
+
+        if status == 200 and segment.start > 0:
+            if not first:
+                # the file changed since the first range was received
+                logging.debug('%s changed, downloading it again', self._url)
+                self._restart()
+                return False
+            # the file changed or the server ignores ranges, start over
+            os.ftruncate(self._outf, 0)
+            self._offset = segment.start = segment.position = 0
+        if status == 200 or status == 206 and self._validator is None:
+            self._validator = validator
+
+        if status == 200:
+            length = headers.getheader('Content-Length')
+            if length is not None and length.isdigit():
+                segment.end = int(length)
+                self._total = segment.end
+        elif status == 206:
+            try:
+                start, end, total = self._parse_content_range(
+                    headers.getheader('Content-Range', ''))
+            except ValueError:
+                self._fail('Error downloading file: invalid response')
+                return False
+            if start != segment.start:
+                self._fail('Error downloading file: invalid range')
+                return False
+            if segment.end is None:
+                segment.end = end
+            self._total = total
+        else:
+            self._fail('Error downloading file: %s' % status_line)
+            return False
+
+        if first:
+            self._headers = headers
+            if self._suggested_fname is None:
+                self._suggested_fname = self._get_filename_from_headers(
+                    headers)
+            if status == 206 and self._total is not None:
+                self._split(segment)
+        return True
+
+    def _parse_content_range(self, content_range):
+        unit, garbage_, content_range = content_range.partition(' ')
+        byte_range, garbage_, total = content_range.partition('/')
+        start, garbage_, end = byte_range.partition('-')
+        if unit != 'bytes':
+            raise ValueError(unit)
+        total = None if total == '*' else int(total)
+        return int(start), int(end) + 1, total
+
+    def _restart(self):
+        for segment in self._segments:
+            segment.close()
+        os.ftruncate(self._outf, 0)
+        self._offset = 0
+        self._validator = None
+        self._segments = [_Segment(0)]
+        self._connect(self._segments[0])
+
+    def _split(self, segment):
+        remaining = self._total - segment.start
+        count = min(self._segment_count, remaining / self.MIN_SEGMENT_SIZE)
+        if count < 2:
+            return
+
+        size = remaining / count
+        segment.end = segment.start + size
+        for i in range(1, count):
+            start = segment.start + i * size
+            end = start + size if i < count - 1 else self._total
+            new_segment = _Segment(start, end)
+            self._segments.append(new_segment)
+            self._connect(new_segment)
+
+    def _write(self, segment, data):
+        try:
+            os.lseek(self._outf, segment.position, os.SEEK_SET)
+            while data:
+                count = os.write(self._outf, data)
+                data = data[count:]
+                segment.position += count
+        except OSError, e:
+            self._fail('Error writing to download file: %s' % e)
+            return False
+
+        self._emit_progress()
+        return True
+
+    def _segment_done(self, segment):
+        segment.close()
+        segment.done = True
+        if [s for s in self._segments if not s.done]:
+            return
+
+        if self._total is not None:
+            os.ftruncate(self._outf, self._total)
+        self._emit_progress(force=True)
+        fname, suggested_fname = self._fname, self._suggested_fname
+        self.cleanup()
+        self.emit('finished', fname, suggested_fname)
+
+    def _get_written(self):
+        return self._offset + sum([segment.position - segment.start
+                                   for segment in self._segments])
+
+    def _emit_progress(self, force=False):
+        now = time.time()
+        if not force and now - self._last_progress < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        self.emit('progress', self._get_written())
+
+    def _download_with_urllib(self, url, request_id):
+        try:
+            response = urllib.urlopen(url)
+            GObject.idle_add(self.__urllib_cb, response.info(), None,
+                             request_id)
+            while request_id == self._request_id:
+                data = response.read(self.CHUNK_SIZE)
+                GObject.idle_add(self.__urllib_cb, None, data, request_id)
+                if not data:
+                    break
+            response.close()
+        except Exception, e:
+            GObject.idle_add(self.__urllib_cb, None, e, request_id)
+
+    def __urllib_cb(self, headers, data, request_id):
+        if request_id != self._request_id:
+            return False
+
+        if headers is not None:
+            self._headers = headers
+            self._segments = [_Segment(0)]
+            self._segments[0].headers_received = True
+            if self._suggested_fname is None:
+                self._suggested_fname = self._get_filename_from_headers(
+                    headers)
+        elif isinstance(data, Exception):
+            self._fail('Error downloading file: %r' % data)
+        elif data:
+            self._write(self._segments[0], data)
+        else:
+            self._segment_done(self._segments[0])
+        return False
 
     def _get_filename_from_headers(self, headers):
         if 'Content-Disposition' not in headers:
@@ -263,46 +1146,34 @@ class GlibURLDownloader(GObject.GObject):
             fname = fname[:len(fname) - 1]
         return fname
 
-    def _read_next_chunk(self, source, condition):
-        if condition & GObject.IO_ERR:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file.')
-            return False
-        elif not (condition & GObject.IO_IN):
-            # shouldn't get here, but...
-            return True
+    def _get_complete_size(self):
+        """Size of the data received without holes, from the start"""
+        for segment in sorted(self._segments, key=lambda s: s.start):
+            if not segment.done:
+                return segment.position
+        if self._segments:
+            return self._segments[-1].position
+        return self._offset
 
-        try:
-            data = self._info.fp.read(self.CHUNK_SIZE)
-            count = os.write(self._outf, data)
-            self._written += len(data)
-
-            # error writing data to file?
-            if count < len(data):
-                self.cleanup(remove=True)
-                self.emit('error', 'Error writing to download file.')
-                return False
-
-            self.emit('progress', self._written)
-
-            # done?
-            if len(data) < self.CHUNK_SIZE:
-                self.cleanup()
-                self.emit('finished', self._fname, self._suggested_fname)
-                return False
-        except Exception, err:
+    def _abort(self):
+        if self._resume and self._outf is not None:
+            # keep what can be resumed
+            os.ftruncate(self._outf, self._get_complete_size())
+            self.cleanup()
+        else:
             self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file: %r' % err)
-            return False
-        return True
+
+    def _fail(self, message):
+        self._abort()
+        self.emit('error', message)
 
     def cleanup(self, remove=False):
-        if self._srcid > 0:
-            GObject.source_remove(self._srcid)
-            self._srcid = 0
-        del self._info
-        self._info = None
-        os.close(self._outf)
-        if remove:
-            os.remove(self._fname)
+        # stale callbacks from the threads will be ignored
+        self._request_id += 1
+        for segment in self._segments:
+            segment.close()
+        if self._outf is not None:
+            os.close(self._outf)
+            if remove:
+                os.remove(self._fname)
         self._outf = None
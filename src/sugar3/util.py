@@ -29,6 +29,7 @@ import gettext
 import tempfile
 import logging
 import atexit
+import importlib
 
 
 _ = lambda msg: gettext.dgettext('sugar-toolkit-gtk3', msg)
@@ -352,3 +353,24 @@ def format_size(size):
         return _('%d MB') % (size / 1024 ** 2)
     else:
         return _('%d GB') % (size / 1024 ** 3)
+
+
+class LazyModule(object):
+    """Stand-in for a module which is only imported when one of its
+    attributes is first used, e.g.
+
+        datastore = LazyModule('sugar3.datastore.datastore')
+    """
+
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def __getattr__(self, attribute):
+        # only called for the attributes which are not set on self
+        if self._lazy_module is None:
+            self._lazy_module = importlib.import_module(self._lazy_name)
+        return getattr(self._lazy_module, attribute)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._lazy_name
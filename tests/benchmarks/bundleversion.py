@@ -0,0 +1,171 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""NormalizedVersion benchmark
+
+Parses, sorts and picks the greatest of many version strings, as done
+with a catalogue of bundles, with NormalizedVersion and with the regex
+based implementation it replaced.
+
+    python tests/benchmarks/bundleversion.py -n 100000
+"""
+
+import argparse
+import random
+import re
+import time
+
+from sugar3.bundle import bundleversion
+from sugar3.bundle.bundleversion import NormalizedVersion
+from sugar3.bundle.bundleversion import parse_many, max_version
+
+_VERSION_RE = re.compile(r'''
+    ^
+    (?P<version>\d+)               # minimum 'N'
+    (?P<extraversion>(?:\.\d+)*)   # any number of extra '.N' segments
+    (?:
+    (?P<local>\-[a-zA-Z]*)         # ignore any string in the comparison
+    )?
+    $''', re.VERBOSE)
+
+
+class RegexVersion(object):
+    """The previous implementation of NormalizedVersion"""
+
+    def __init__(self, activity_version):
+        self._activity_version = activity_version
+        self.parts = []
+        self._local = None
+
+        match = _VERSION_RE.search(activity_version)
+        if not match:
+            raise bundleversion.InvalidVersionError(activity_version)
+        groups = match.groupdict()
+
+        self.parts.append(self._parse_version(groups['version']))
+        if groups['extraversion'] not in ('', None):
+            nums = [self._parse_version(n)
+                    for n in groups['extraversion'][1:].split('.')]
+            while nums and nums[-1] == 0:
+                nums.pop()
+            self.parts.extend(nums)
+
+        self._local = groups['local']
+
+    def _parse_version(self, version_string):
+        if len(version_string) > 1 and version_string[0] == '0':
+            raise bundleversion.InvalidVersionError(version_string)
+        return int(version_string)
+
+    def __eq__(self, other):
+        return self.parts == other.parts
+
+    def __lt__(self, other):
+        return self.parts < other.parts
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __gt__(self, other):
+        return not (self.__lt__(other) or self.__eq__(other))
+
+    def __le__(self, other):
+        return self.__eq__(other) or self.__lt__(other)
+
+    def __ge__(self, other):
+        return self.__eq__(other) or self.__gt__(other)
+
+
+def _generate_versions(count, distinct):
+    generator = random.Random(0)
+    versions = []
+    for i in range(distinct):
+        parts = [str(generator.randint(1, 300))]
+        for j in range(generator.randint(0, 3)):
+            parts.append(str(generator.randint(0, 20)))
+        version = '.'.join(parts)
+        if generator.random() < 0.05:
+            version += '-peru'
+        versions.append(version)
+    return [generator.choice(versions) for i in range(count)]
+
+
+def _measure(function, repeat):
+    best = None
+    for i in range(repeat):
+        bundleversion._versions.clear()
+        start = time.time()
+        function()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parsing '
+                                     'and sorting of bundle versions.')
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='number of version strings')
+    parser.add_argument('--distinct', type=int, default=5000,
+                        help='number of distinct version strings')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each case, the best one is reported')
+    args = parser.parse_args()
+
+    strings = _generate_versions(args.count, args.distinct)
+
+    cases = [
+        ('parse', lambda: [RegexVersion(s) for s in strings],
+         lambda: parse_many(strings)),
+        ('parse and sort', lambda: sorted(RegexVersion(s) for s in strings),
+         lambda: sorted(parse_many(strings),
+                        key=lambda version: version.sort_key)),
+        ('max', lambda: max(RegexVersion(s) for s in strings),
+         lambda: max_version(strings)),
+        ('deduplicate', lambda: _deduplicate_regex(strings),
+         lambda: set(parse_many(strings))),
+    ]
+
+    print '%d version strings, %d distinct' % (args.count, args.distinct)
+    print '%-16s %10s %10s %8s' % ('', 'regex', 'current', 'speedup')
+    for title, regex_function, function in cases:
+        regex_duration = _measure(regex_function, args.repeat)
+        duration = _measure(function, args.repeat)
+        print '%-16s %8.1fms %8.1fms %7.1fx' % (
+            title, regex_duration * 1000, duration * 1000,
+            regex_duration / duration)
+
+    # sanity check, both implementations agree
+    assert max(RegexVersion(s) for s in strings).parts == \
+        max_version(strings).parts
+    assert NormalizedVersion(strings[0]).parts == RegexVersion(
+        strings[0]).parts
+
+
+def _deduplicate_regex(strings):
+    # the previous class is not hashable, sort and compare neighbours
+    result = []
+    for version in sorted(RegexVersion(s) for s in strings):
+        if not result or result[-1] != version:
+            result.append(version)
+    return result
+
+
+if __name__ == '__main__':
+    main()
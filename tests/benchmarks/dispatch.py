@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Signal dispatch benchmark
+
+Connects many receivers, most of them to one sender among many, as the
+views of the journal entries do with the datastore signals, then sends,
+connects, disconnects and drops receivers, with Signal and with the
+list based implementation it replaced.
+
+    python tests/benchmarks/dispatch.py -n 1000
+"""
+
+import argparse
+import gc
+import time
+
+from sugar3.dispatch import Signal
+from sugar3.dispatch import saferef
+from sugar3.dispatch.dispatcher import WEAKREF_TYPES, _make_id
+
+
+class LegacySignal(object):
+    """The previous implementation of Signal"""
+
+    def __init__(self, providing_args=None):
+        self.providing_args = set(providing_args or [])
+        self.receivers = []
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+        if dispatch_uid:
+            lookup_key = (dispatch_uid, _make_id(sender))
+        else:
+            lookup_key = (_make_id(receiver), _make_id(sender))
+        if weak:
+            receiver = saferef.safeRef(
+                receiver, onDelete=self._remove_receiver)
+        for r_key, _ in self.receivers:
+            if r_key == lookup_key:
+                break
+        else:
+            self.receivers.append((lookup_key, receiver))
+
+    def disconnect(self, receiver=None, sender=None, weak=True,
+                   dispatch_uid=None):
+        if dispatch_uid:
+            lookup_key = (dispatch_uid, _make_id(sender))
+        else:
+            lookup_key = (_make_id(receiver), _make_id(sender))
+        for idx, (r_key, _) in enumerate(self.receivers):
+            if r_key == lookup_key:
+                del self.receivers[idx]
+
+    def send(self, sender, **named):
+        responses = []
+        if not self.receivers:
+            return responses
+        for receiver in self._live_receivers(_make_id(sender)):
+            response = receiver(signal=self, sender=sender, **named)
+            responses.append((receiver, response))
+        return responses
+
+    def _live_receivers(self, senderkey):
+        none_senderkey = _make_id(None)
+        for (receiverkey, r_senderkey), receiver in self.receivers:
+            if r_senderkey == none_senderkey or r_senderkey == senderkey:
+                if isinstance(receiver, WEAKREF_TYPES):
+                    receiver = receiver()
+                    if receiver is not None:
+                        yield receiver
+                else:
+                    yield receiver
+
+    def _remove_receiver(self, receiver):
+        to_remove = []
+        for key, connected_receiver in self.receivers:
+            if connected_receiver == receiver:
+                to_remove.append(key)
+        for key in to_remove:
+            for idx, (r_key, _) in enumerate(self.receivers):
+                if r_key == key:
+                    del self.receivers[idx]
+
+
+class _Receiver(object):
+
+    def receive(self, **kwargs):
+        pass
+
+
+def _run(signal_class, count, sends):
+    senders = [object() for i in range(count)]
+    receivers = [_Receiver() for i in range(count)]
+    signal = signal_class(providing_args=['object_id'])
+    durations = {}
+
+    start = time.time()
+    for sender, receiver in zip(senders, receivers):
+        signal.connect(receiver.receive, sender=sender)
+    # a few receivers of every sender
+    global_receivers = [_Receiver() for i in range(3)]
+    for receiver in global_receivers:
+        signal.connect(receiver.receive)
+    durations['connect'] = time.time() - start
+
+    start = time.time()
+    for i in range(sends):
+        signal.send(senders[i % count], object_id=i)
+    durations['send'] = time.time() - start
+
+    start = time.time()
+    for sender, receiver in zip(senders[::2], receivers[::2]):
+        signal.disconnect(receiver.receive, sender=sender)
+    durations['disconnect'] = time.time() - start
+
+    gc.collect()
+    start = time.time()
+    del receivers[:]
+    gc.collect()
+    durations['collect'] = time.time() - start
+
+    assert len(signal.receivers) == len(global_receivers)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dispatch '
+                                     'of signals.')
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='number of senders and receivers')
+    parser.add_argument('--sends', type=int, default=10000,
+                        help='number of signals sent')
+    args = parser.parse_args()
+
+    legacy = _run(LegacySignal, args.count, args.sends)
+    current = _run(Signal, args.count, args.sends)
+
+    print '%d receivers, %d sends' % (args.count, args.sends)
+    print '%-12s %10s %10s %8s' % ('', 'list', 'current', 'speedup')
+    for key in 'connect', 'send', 'disconnect', 'collect':
+        print '%-12s %8.1fms %8.1fms %7.1fx' % (
+            key, legacy[key] * 1000, current[key] * 1000,
+            legacy[key] / max(current[key], 1e-9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Activity launch benchmark
+
+Launches an activity through activityfactory, like the shell does, and
+reports the launch latency (until the activity is on the bus), the time
+to its first frame and the peak memory of its process.
+
+The activity runs on a private session bus, with stub Shell, DataStore
+and telepathy AccountManager services, so that neither Sugar nor a
+desktop session is needed. sugar-activity must be in the PATH.
+
+    python tests/benchmarks/launch.py --xvfb -n 20
+
+The first --cold launches are reported apart from the others. With
+--drop-caches, and enough privileges, the page cache is dropped before
+each of them.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import dbus
+import dbus.service
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+SAMPLE_ACTIVITY_PATH = os.path.join(os.path.dirname(__file__), os.pardir,
+                                    'data', 'sample.activity')
+
+_BUS_CONFIG = """<busconfig>
+  <type>session</type>
+  <listen>unix:tmpdir=%s</listen>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+_DS_INTERFACE = 'org.laptop.sugar.DataStore'
+_SHELL_INTERFACE = 'org.laptop.Shell'
+_ACCOUNT_MANAGER = 'org.freedesktop.Telepathy.AccountManager'
+
+
+class _Shell(dbus.service.Object):
+
+    def __init__(self, bus):
+        bus_name = dbus.service.BusName('org.laptop.Shell', bus=bus)
+        dbus.service.Object.__init__(self, bus_name, '/org/laptop/Shell')
+        self.launch_failures = set()
+
+    @dbus.service.method(_SHELL_INTERFACE, in_signature='ss')
+    def NotifyLaunch(self, bundle_id, activity_id):
+        pass
+
+    @dbus.service.method(_SHELL_INTERFACE, in_signature='s')
+    def NotifyLaunchFailure(self, activity_id):
+        self.launch_failures.add(activity_id)
+
+    @dbus.service.method(_SHELL_INTERFACE, in_signature='s',
+                         out_signature='b')
+    def ActivateActivity(self, activity_id):
+        return False
+
+
+class _DataStore(dbus.service.Object):
+    """Keeps the metadata in memory and discards the files"""
+
+    def __init__(self, bus):
+        bus_name = dbus.service.BusName('org.laptop.sugar.DataStore',
+                                        bus=bus)
+        dbus.service.Object.__init__(self, bus_name,
+                                     '/org/laptop/sugar/DataStore')
+        self._entries = {}
+
+    def _discard_file(self, file_path, transfer_ownership):
+        if file_path and transfer_ownership and os.path.exists(file_path):
+            os.remove(file_path)
+
+    @dbus.service.method(_DS_INTERFACE, in_signature='a{sv}sb',
+                         out_signature='s')
+    def create(self, props, file_path, transfer_ownership):
+        uid = str(uuid.uuid4())
+        self._entries[uid] = dict(props, uid=uid)
+        self._discard_file(file_path, transfer_ownership)
+        self.Created(uid)
+        return uid
+
+    @dbus.service.method(_DS_INTERFACE, in_signature='sa{sv}sb')
+    def update(self, uid, props, file_path, transfer_ownership):
+        self._entries.setdefault(uid, {'uid': uid}).update(props)
+        self._discard_file(file_path, transfer_ownership)
+        self.Updated(uid)
+
+    @dbus.service.method(_DS_INTERFACE, in_signature='s',
+                         out_signature='a{sv}')
+    def get_properties(self, uid):
+        return self._entries.get(uid, {})
+
+    @dbus.service.method(_DS_INTERFACE, in_signature='s',
+                         out_signature='s')
+    def get_filename(self, uid):
+        return ''
+
+    @dbus.service.method(_DS_INTERFACE, in_signature='a{sv}as',
+                         out_signature='aa{sv}u')
+    def find(self, query, properties):
+        query = dict((key, value) for key, value in query.items()
+                     if key not in ('limit', 'offset', 'order_by'))
+        entries = [entry for entry in self._entries.values()
+                   if all(entry.get(key) == value
+                          for key, value in query.items())]
+        return entries, len(entries)
+
+    @dbus.service.method(_DS_INTERFACE, in_signature='s')
+    def delete(self, uid):
+        self._entries.pop(uid, None)
+        self.Deleted(uid)
+
+    @dbus.service.signal(_DS_INTERFACE, signature='s')
+    def Created(self, uid):
+        pass
+
+    @dbus.service.signal(_DS_INTERFACE, signature='s')
+    def Updated(self, uid):
+        pass
+
+    @dbus.service.signal(_DS_INTERFACE, signature='s')
+    def Deleted(self, uid):
+        pass
+
+
+class _AccountManager(dbus.service.Object):
+    """An account manager without any account"""
+
+    def __init__(self, bus):
+        bus_name = dbus.service.BusName(_ACCOUNT_MANAGER, bus=bus)
+        dbus.service.Object.__init__(
+            self, bus_name, '/org/freedesktop/Telepathy/AccountManager')
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='ss',
+                         out_signature='v')
+    def Get(self, interface, name):
+        return self.GetAll(interface)[name]
+
+    @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        return {'Interfaces': dbus.Array([], signature='s'),
+                'ValidAccounts': dbus.Array([], signature='o'),
+                'InvalidAccounts': dbus.Array([], signature='o')}
+
+
+def _start_bus(temp_dir):
+    config_path = os.path.join(temp_dir, 'bus.conf')
+    with open(config_path, 'w') as f:
+        f.write(_BUS_CONFIG % temp_dir)
+
+    process = subprocess.Popen(['dbus-daemon', '--nofork',
+                                '--config-file=%s' % config_path,
+                                '--print-address=1'],
+                               stdout=subprocess.PIPE)
+    address = process.stdout.readline().strip()
+    if not address:
+        raise RuntimeError('Cannot start dbus-daemon')
+    return process, address
+
+
+def _start_xvfb():
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd),
+                                '-screen', '0', '1200x900x24',
+                                '-nolisten', 'tcp'])
+    os.close(write_fd)
+
+    display = ''
+    while not display.endswith('\n'):
+        data = os.read(read_fd, 16)
+        if not data:
+            raise RuntimeError('Cannot start Xvfb')
+        display += data
+    os.close(read_fd)
+
+    return process, ':' + display.strip()
+
+
+def _drop_caches():
+    subprocess.call(['sync'])
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except IOError:
+        return False
+    return True
+
+
+def _wait(condition, timeout):
+    """Run the main loop until condition() is true, or timeout seconds"""
+    context = GLib.MainContext.default()
+    tick_id = GLib.timeout_add(10, lambda: True)
+    end = time.time() + timeout
+    try:
+        while not condition():
+            if time.time() > end:
+                return False
+            context.iteration(True)
+    finally:
+        GLib.source_remove(tick_id)
+    return True
+
+
+def _read_trace(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        # not completely written yet
+        return None
+
+
+def _get_peak_rss(pid):
+    """Return the peak resident memory of a process, in kB"""
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+def _launch(bus, shell, bundle, logs_dir, timeout):
+    from sugar3.activity import activityfactory
+    from sugar3.activity.activityhandle import ActivityHandle
+
+    activity_id = activityfactory.create_activity_id()
+    service_name = 'org.laptop.Activity' + activity_id
+    trace_pattern = os.path.join(logs_dir, '*.trace.json')
+    old_traces = set(glob.glob(trace_pattern))
+    result = {}
+
+    def __name_owner_changed_cb(name, old_owner, new_owner):
+        if new_owner and 'launch' not in result:
+            result['launch'] = time.time() - start
+
+    def __first_frame():
+        for path in set(glob.glob(trace_pattern)) - old_traces:
+            trace = _read_trace(path)
+            if trace is None:
+                return False
+            for event in trace['traceEvents']:
+                if event['name'] == 'first draw':
+                    result['first_frame'] = event['ts'] / 1000000. - start
+                    return True
+        return activity_id in shell.launch_failures
+
+    match = bus.add_signal_receiver(
+        __name_owner_changed_cb, 'NameOwnerChanged', 'org.freedesktop.DBus',
+        'org.freedesktop.DBus', '/org/freedesktop/DBus', arg0=service_name)
+    start = time.time()
+    activityfactory.create(bundle, ActivityHandle(activity_id))
+    try:
+        if not _wait(__first_frame, timeout) or 'first_frame' not in result:
+            raise RuntimeError('Activity %s did not start, see the logs in '
+                               '%s' % (activity_id, logs_dir))
+        _wait(lambda: 'launch' in result, timeout)
+    finally:
+        match.remove()
+
+    pid = bus.call_blocking('org.freedesktop.DBus', '/org/freedesktop/DBus',
+                            'org.freedesktop.DBus',
+                            'GetConnectionUnixProcessID', 's',
+                            (service_name,))
+    result['peak_rss'] = _get_peak_rss(pid)
+
+    os.kill(pid, signal.SIGTERM)
+    _wait(lambda: not bus.name_has_owner(service_name), timeout)
+
+    return result
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(math.ceil(percent / 100. * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def _print_report(cold, warm):
+    print '%-18s %8s %8s %8s %8s' % ('', 'launches', 'p50', 'p90', 'max')
+    rows = [('cold launch', cold, 'launch', 1000, 'ms'),
+            ('cold first frame', cold, 'first_frame', 1000, 'ms'),
+            ('warm launch', warm, 'launch', 1000, 'ms'),
+            ('warm first frame', warm, 'first_frame', 1000, 'ms'),
+            ('peak RSS', cold + warm, 'peak_rss', 1. / 1024, 'MB')]
+    for title, results, key, scale, unit in rows:
+        values = [result[key] * scale for result in results
+                  if result.get(key) is not None]
+        if not values:
+            continue
+        print '%-18s %8d %8.1f %8.1f %8.1f %s' % (
+            title, len(values), _percentile(values, 50),
+            _percentile(values, 90), max(values), unit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the launch '
+                                     'of an activity.')
+    parser.add_argument('-n', '--launches', type=int, default=10,
+                        help='number of warm launches')
+    parser.add_argument('--cold', type=int, default=1,
+                        help='number of cold launches, done first')
+    parser.add_argument('--drop-caches', action='store_true',
+                        help='drop the page cache before the cold launches')
+    parser.add_argument('--xvfb', action='store_true',
+                        help='run the activity in a virtual X server')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for each launch')
+    parser.add_argument('--json', help='write the results in this file')
+    parser.add_argument('bundle_path', nargs='?',
+                        default=SAMPLE_ACTIVITY_PATH,
+                        help='activity bundle to launch')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    logs_dir = os.path.join(temp_dir, 'logs')
+    os.mkdir(logs_dir)
+    processes = []
+
+    try:
+        bus_process, address = _start_bus(temp_dir)
+        processes.append(bus_process)
+        if args.xvfb:
+            xvfb_process, display = _start_xvfb()
+            processes.append(xvfb_process)
+            os.environ['DISPLAY'] = display
+
+        os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+        os.environ['SUGAR_HOME'] = os.path.join(temp_dir, 'home')
+        os.environ['SUGAR_LOGS_DIR'] = logs_dir
+        os.environ['SUGAR_ACTIVITY_TRACE'] = '1'
+        os.environ['GSETTINGS_BACKEND'] = 'memory'
+
+        DBusGMainLoop(set_as_default=True)
+        bus = dbus.SessionBus()
+        shell = _Shell(bus)
+        _DataStore(bus)
+        _AccountManager(bus)
+
+        # the datastore module connects to the bus when imported
+        from sugar3.bundle.activitybundle import ActivityBundle
+        bundle = ActivityBundle(os.path.abspath(args.bundle_path))
+
+        cold = []
+        for i in range(args.cold):
+            if args.drop_caches and not _drop_caches():
+                print >> sys.stderr, 'Cannot drop the page cache'
+            cold.append(_launch(bus, shell, bundle, logs_dir, args.timeout))
+
+        warm = []
+        for i in range(args.launches):
+            warm.append(_launch(bus, shell, bundle, logs_dir, args.timeout))
+
+        _print_report(cold, warm)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'cold': cold, 'warm': warm}, f, indent=2)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
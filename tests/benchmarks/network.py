@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""File transfer benchmark
+
+Serves a file with ChunkedGlibHTTPRequestHandler over loopback and
+reports the throughput and the CPU time used, with sendfile(), with
+reads and writes through Python, and with the fixed 4 KiB chunks of
+the previous implementation.
+
+    python tests/benchmarks/network.py --size 200
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from gi.repository import GLib
+from gi.repository import GObject
+
+from sugar3 import network
+
+
+class _LegacyHandler(network.ChunkedGlibHTTPRequestHandler):
+    """Fixed 4 KiB chunks, read and written by Python"""
+
+    def _start_transfer(self):
+        self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
+                                           GObject.IO_ERR,
+                                           self._send_legacy_chunk)
+
+    def _send_legacy_chunk(self, source, condition):
+        if condition & GObject.IO_ERR or not condition & GObject.IO_OUT:
+            self._cleanup()
+            return False
+        data = self._file.read(self.CHUNK_SIZE)
+        count = os.write(self.wfile.fileno(), data)
+        if count != len(data) or len(data) != self.CHUNK_SIZE:
+            self._cleanup()
+            return False
+        return True
+
+
+class _BufferHandler(network.ChunkedGlibHTTPRequestHandler):
+    USE_SENDFILE = False
+
+
+def _download(address, path, result):
+    sock = socket.create_connection(address)
+    sock.sendall('GET /%s HTTP/1.0\r\n\r\n' % path)
+    received = 0
+    while True:
+        data = sock.recv(1024 * 1024)
+        if not data:
+            break
+        received += len(data)
+    sock.close()
+    result['received'] = received
+
+
+def _run(handler_class, file_name):
+    server = network.GlibTCPServer(('127.0.0.1', 0), handler_class)
+    main_loop = GLib.MainLoop()
+    result = {}
+
+    def __download():
+        try:
+            _download(server.server_address, file_name, result)
+        finally:
+            GLib.idle_add(main_loop.quit)
+
+    cpu_start = time.clock()
+    start = time.time()
+    thread = threading.Thread(target=__download)
+    thread.start()
+    main_loop.run()
+    thread.join()
+    duration = time.time() - start
+    cpu_time = time.clock() - cpu_start
+
+    server.socket.close()
+    return result.get('received', 0), duration, cpu_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transfer '
+                                     'of a file over loopback.')
+    parser.add_argument('--size', type=int, default=200,
+                        help='size of the file, in MB')
+    args = parser.parse_args()
+
+    GObject.threads_init()
+
+    temp_dir = tempfile.mkdtemp()
+    old_cwd = os.getcwd()
+    try:
+        file_size = args.size * 1024 * 1024
+        with open(os.path.join(temp_dir, 'data'), 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for i in range(args.size):
+                f.write(block)
+
+        # the request handlers serve the current directory
+        os.chdir(temp_dir)
+
+        print '%d MB file' % args.size
+        print '%-10s %12s %10s' % ('', 'throughput', 'CPU time')
+        for title, handler_class in [
+                ('4 KiB', _LegacyHandler),
+                ('buffered', _BufferHandler),
+                ('sendfile', network.ChunkedGlibHTTPRequestHandler)]:
+            received, duration, cpu_time = _run(handler_class, 'data')
+            if received < file_size:
+                print '%-10s %d bytes received out of %d' % (
+                    title, received, file_size)
+                continue
+            print '%-10s %8.1fMB/s %9.2fs' % (
+                title, args.size / duration, cpu_time)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Concurrent file serving benchmark
+
+Serves files of several sizes with GlibTCPServer and
+ChunkedGlibHTTPRequestHandler on loopback, as an activity sharing a
+document with a classroom does, while many clients download them at
+once. Reports the aggregate throughput, the fairness between the
+clients (Jain's index of the throughputs of the clients downloading
+the same file, the lowest of the files, 1 is perfectly fair), the
+time to the first byte and to the end of the downloads, and how long
+the mainloop of the server was stalled. The files are sent with
+sendfile(), with reads and writes through Python, and from a FileCache.
+
+The clients run in another process, so that they don't compete with
+the server for the interpreter lock. No display is needed.
+
+    python tests/benchmarks/serving.py -c 30 --sizes 64K,1M,16M
+
+With --max-stall, the exit status is 1 when the mainloop stalled
+longer than that, so that the benchmark can fail a CI job.
+"""
+
+import argparse
+import errno
+import json
+import math
+import multiprocessing
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from gi.repository import GLib
+from gi.repository import GObject
+
+from sugar3 import network
+
+_STALL_PROBE_INTERVAL = 10
+_UNITS = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+class _BufferHandler(network.ChunkedGlibHTTPRequestHandler):
+    USE_SENDFILE = False
+
+
+class _Client(object):
+
+    def __init__(self, address, name, size):
+        self.name = name
+        self.size = size
+        self.received = 0
+        self.start = time.time()
+        self.first_byte = None
+        self.end = None
+        self.error = None
+        self.request = 'GET /%s HTTP/1.0\r\n\r\n' % name
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        self.socket.connect_ex(address)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.finish(os.strerror(error))
+            return
+        self.request = self.request[self.socket.send(self.request):]
+
+    def receive(self):
+        data = self.socket.recv(1024 * 1024)
+        if not data:
+            self.finish()
+            return
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        self.received += len(data)
+
+    def finish(self, error=None):
+        self.end = time.time()
+        self.error = error
+        self.socket.close()
+        self.socket = None
+
+    def get_result(self):
+        error = self.error
+        # the response headers are counted in received
+        if error is None and self.received < self.size:
+            error = 'incomplete'
+        return {'size': self.size,
+                'received': self.received,
+                'error': error,
+                'start': self.start,
+                'first_byte': (self.first_byte or self.end) - self.start,
+                'duration': self.end - self.start}
+
+
+def _run_clients(address, files, count, timeout, queue):
+    clients = [_Client(address, name, size)
+               for name, size in [files[i % len(files)]
+                                  for i in range(count)]]
+    deadline = time.time() + timeout
+
+    while True:
+        active = [client for client in clients if client.socket is not None]
+        if not active:
+            break
+        if time.time() > deadline:
+            for client in active:
+                client.finish('timeout')
+            break
+
+        readable, writable, errors_ = select.select(
+            [client for client in active if not client.request],
+            [client for client in active if client.request], [], 1)
+        for client in writable:
+            try:
+                client.send()
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    client.finish(str(e))
+        for client in readable:
+            try:
+                client.receive()
+            except socket.error, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    client.finish(str(e))
+
+    queue.put([client.get_result() for client in clients])
+
+
+def _serve(handler_class, file_cache, files, clients, timeout):
+    server = network.GlibTCPServer(('127.0.0.1', 0), handler_class,
+                                   file_cache)
+    main_loop = GLib.MainLoop()
+    queue = multiprocessing.Queue()
+    stalls = []
+    last_probe = [time.time()]
+
+    def __probe_cb():
+        now = time.time()
+        stalls.append(max(now - last_probe[0] -
+                          _STALL_PROBE_INTERVAL / 1000., 0))
+        last_probe[0] = now
+        return True
+
+    process = multiprocessing.Process(
+        target=_run_clients,
+        args=(server.server_address, files, clients, timeout, queue))
+    process.start()
+
+    results = []
+
+    def __poll_cb():
+        # the results are read before the process exits, it cannot exit
+        # while they are not read from the queue
+        if not queue.empty():
+            results.extend(queue.get())
+        if results or not process.is_alive():
+            main_loop.quit()
+            return False
+        return True
+
+    probe_id = GObject.timeout_add(_STALL_PROBE_INTERVAL, __probe_cb)
+    GObject.timeout_add(50, __poll_cb)
+    main_loop.run()
+
+    GObject.source_remove(probe_id)
+    if not results and not queue.empty():
+        results.extend(queue.get())
+    process.join()
+    server.server_close()
+    return results, stalls
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(math.ceil(percent / 100. * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def _summarize(results, stalls):
+    completed = [result for result in results if result['error'] is None]
+    summary = {'clients': len(results), 'failed': len(results) -
+               len(completed)}
+    if not completed:
+        return summary
+
+    start = min(result['start'] for result in completed)
+    end = max(result['start'] + result['duration'] for result in completed)
+    summary['throughput'] = sum(result['received']
+                                for result in completed) / (end - start)
+
+    # small files are slower to fetch, only compare the clients which
+    # downloaded the same file
+    fairness = []
+    for size in set(result['size'] for result in completed):
+        throughputs = [result['received'] / result['duration']
+                       for result in completed if result['size'] == size]
+        fairness.append(sum(throughputs) ** 2 / (
+            len(throughputs) * sum(t ** 2 for t in throughputs)))
+    summary['fairness'] = min(fairness)
+    for key in 'first_byte', 'duration':
+        values = [result[key] for result in completed]
+        summary[key] = {'p50': _percentile(values, 50),
+                        'p99': _percentile(values, 99),
+                        'max': max(values)}
+    if stalls:
+        summary['stall'] = {'p50': _percentile(stalls, 50),
+                            'p99': _percentile(stalls, 99),
+                            'max': max(stalls)}
+    return summary
+
+
+def _print_summary(title, summary):
+    print '%s: %d clients, %d failed' % (title, summary['clients'],
+                                         summary['failed'])
+    if 'throughput' not in summary:
+        return
+    print '  throughput %8.1f MB/s, fairness %.3f' % (
+        summary['throughput'] / 1024 / 1024, summary['fairness'])
+    for key, label in [('first_byte', 'first byte'),
+                       ('duration', 'download'),
+                       ('stall', 'mainloop stall')]:
+        if key in summary:
+            print '  %-15s p50 %8.1fms  p99 %8.1fms  max %8.1fms' % (
+                label, summary[key]['p50'] * 1000,
+                summary[key]['p99'] * 1000, summary[key]['max'] * 1000)
+
+
+def _parse_size(size):
+    size = size.strip().upper()
+    if size[-1:] in _UNITS:
+        return int(size[:-1]) * _UNITS[size[-1]]
+    return int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the serving '
+                                     'of files to many clients at once.')
+    parser.add_argument('-c', '--clients', type=int, default=30,
+                        help='number of concurrent clients')
+    parser.add_argument('--sizes', default='64K,1M,16M',
+                        help='comma separated sizes of the files, the '
+                        'clients download them in turn')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for the downloads')
+    parser.add_argument('--json', help='write the results in this file')
+    parser.add_argument('--max-stall', type=float,
+                        help='fail when the mainloop stalls longer, in ms')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    old_cwd = os.getcwd()
+    try:
+        files = []
+        for size in args.sizes.split(','):
+            size = _parse_size(size)
+            name = 'file-%d' % size
+            with open(os.path.join(temp_dir, name), 'wb') as f:
+                block = os.urandom(min(size, 1024 * 1024))
+                for i in range(0, size, len(block) or 1):
+                    f.write(block[:size - i])
+            files.append((name, size))
+
+        # the request handlers serve the current directory
+        os.chdir(temp_dir)
+
+        report = {}
+        for title, handler_class, file_cache in [
+                ('sendfile', network.ChunkedGlibHTTPRequestHandler, None),
+                ('buffered', _BufferHandler, None),
+                ('cached', network.ChunkedGlibHTTPRequestHandler,
+                 network.FileCache())]:
+            results, stalls = _serve(handler_class, file_cache, files,
+                                     args.clients, args.timeout)
+            report[title] = _summarize(results, stalls)
+            report[title]['results'] = results
+            _print_summary(title, report[title])
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(temp_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = [title for title, summary in report.items()
+              if summary['failed']]
+    if args.max_stall is not None:
+        failed.extend(title for title, summary in report.items()
+                      if 'stall' in summary and
+                      summary['stall']['max'] * 1000 > args.max_stall)
+    if failed:
+        print >> sys.stderr, 'Failed: %s' % ', '.join(sorted(set(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
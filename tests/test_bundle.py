@@ -15,11 +15,20 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import json
+import shutil
+import zipfile
+import tempfile
 import unittest
 import subprocess
 
 from sugar3.bundle.helpers import bundle_from_dir, bundle_from_archive
+from sugar3.bundle import activitybundle
 from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.activitybundle import install_bundles, uninstall_bundles
+from sugar3.bundle import blobstore
+from sugar3.bundle import bundledelta
+from sugar3.bundle.bundle import MalformedBundleException
 from sugar3.bundle.contentbundle import ContentBundle
 
 tests_dir = os.path.dirname(__file__)
@@ -27,6 +36,39 @@ data_dir = os.path.join(tests_dir, "data")
 SAMPLE_ACTIVITY_PATH = os.path.join(data_dir, 'sample.activity')
 SAMPLE_CONTENT_PATH = os.path.join(data_dir, 'sample.content')
 
+_MIME_TYPES = """<?xml version="1.0" encoding="UTF-8"?>
+<mime-info xmlns="http://www.freedesktop.org/standards/shared-mime-info">
+  <mime-type type="application/x-sample">
+    <glob pattern="*.sample"/>
+  </mime-type>
+</mime-info>
+"""
+
+
+def _create_source(temp_dir, name):
+    """Copy the sample activity with another bundle id"""
+    source_path = os.path.join(temp_dir, '%s-source' % name)
+    shutil.copytree(SAMPLE_ACTIVITY_PATH, source_path)
+    info_path = os.path.join(source_path, 'activity', 'activity.info')
+    with open(info_path) as f:
+        info = f.read()
+    with open(info_path, 'w') as f:
+        f.write(info.replace('org.sugarlabs.Sample',
+                             'org.sugarlabs.%s' % name))
+    return source_path
+
+
+def _create_xo(temp_dir, name, source_path=SAMPLE_ACTIVITY_PATH,
+               version=1):
+    xo_path = os.path.join(temp_dir, '%s-%s.xo' % (name, version))
+    with zipfile.ZipFile(xo_path, 'w') as xo:
+        for root, dirs, files in os.walk(source_path):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                arcname = os.path.relpath(path, source_path)
+                xo.write(path, os.path.join('%s.activity' % name, arcname))
+    return xo_path
+
 
 class TestBundle(unittest.TestCase):
     def test_bundle_from_dir(self):
@@ -47,3 +89,188 @@ class TestBundle(unittest.TestCase):
         subprocess.check_call(["zip", "-r", "sample-1.xol", "sample.content"])
         bundle = bundle_from_archive("./sample-1.xol")
         self.assertIsInstance(bundle, ContentBundle)
+
+    def test_activity_bundle_translations(self):
+        bundle_path = os.path.join(tempfile.mkdtemp(), 'sample.activity')
+        shutil.copytree(SAMPLE_ACTIVITY_PATH, bundle_path)
+        os.mkdir(os.path.join(bundle_path, 'locale'))
+        with open(os.path.join(bundle_path, 'locale', 'linfo.json'),
+                  'w') as f:
+            json.dump({'es': {'name': u'Ejemplo', 'summary': u'Resumen'}}, f)
+
+        old_language = os.environ.get('LANGUAGE')
+        os.environ['LANGUAGE'] = 'es_ES'
+        try:
+            bundle = ActivityBundle(bundle_path)
+        finally:
+            if old_language is None:
+                del os.environ['LANGUAGE']
+            else:
+                os.environ['LANGUAGE'] = old_language
+            shutil.rmtree(os.path.dirname(bundle_path))
+
+        self.assertEqual(bundle.get_name(), 'Ejemplo')
+        self.assertEqual(bundle.get_summary(), 'Resumen')
+
+    def test_install_bundles(self):
+        temp_dir = tempfile.mkdtemp()
+        old_environ = dict((key, os.environ.get(key)) for key in
+                           ['SUGAR_ACTIVITIES_PATH', 'XDG_DATA_HOME'])
+        os.environ['SUGAR_ACTIVITIES_PATH'] = os.path.join(temp_dir,
+                                                           'Activities')
+        os.environ['XDG_DATA_HOME'] = os.path.join(temp_dir, 'data')
+
+        mime_updates = []
+        old_update_mime_database = activitybundle.update_mime_database
+        activitybundle.update_mime_database = \
+            lambda: mime_updates.append(None)
+        try:
+            bundles = []
+            for name in ['SampleA', 'SampleB', 'SampleC']:
+                source_path = _create_source(temp_dir, name)
+                with open(os.path.join(source_path, 'activity',
+                                       'mimetypes.xml'), 'w') as f:
+                    f.write(_MIME_TYPES)
+                bundles.append(ActivityBundle(_create_xo(temp_dir, name,
+                                                         source_path)))
+
+            installed = []
+            results = install_bundles(bundles, jobs=2,
+                                      progress_cb=installed.append)
+            self.assertItemsEqual(installed, results)
+            self.assertEqual([result.bundle for result in results], bundles)
+            for result in results:
+                self.assertIsNone(result.error)
+                self.assertTrue(os.path.isfile(os.path.join(
+                    result.install_path, 'activity', 'activity.info')))
+                self.assertTrue(os.path.islink(
+                    result.bundle._get_installed_mime_path()))
+            # the mime database is updated once for all the bundles
+            self.assertEqual(len(mime_updates), 1)
+
+            installed_bundles = [ActivityBundle(result.install_path)
+                                 for result in results]
+            results = uninstall_bundles(installed_bundles)
+            for result in results:
+                self.assertIsNone(result.error)
+                self.assertFalse(os.path.exists(result.bundle.get_path()))
+                self.assertFalse(os.path.lexists(
+                    result.bundle._get_installed_mime_path()))
+            self.assertEqual(len(mime_updates), 2)
+        finally:
+            activitybundle.update_mime_database = old_update_mime_database
+            for key, value in old_environ.items():
+                if value is None:
+                    del os.environ[key]
+                else:
+                    os.environ[key] = value
+            shutil.rmtree(temp_dir)
+
+    def test_install_deduplicated(self):
+        temp_dir = tempfile.mkdtemp()
+        activities_path = os.path.join(temp_dir, 'Activities')
+        old_activities_path = os.environ.get('SUGAR_ACTIVITIES_PATH')
+        os.environ['SUGAR_ACTIVITIES_PATH'] = activities_path
+        try:
+            install_paths = [
+                ActivityBundle(_create_xo(temp_dir, name)).install(
+                    deduplicate=True)
+                for name in ['SampleA', 'SampleB']]
+
+            stats = [os.stat(os.path.join(path, 'activity.py'))
+                     for path in install_paths]
+            self.assertEqual(stats[0].st_ino, stats[1].st_ino)
+            self.assertEqual(stats[0].st_nlink, 3)
+
+            store_path = blobstore.get_store_path(activities_path)
+            for path in install_paths:
+                ActivityBundle(path).uninstall()
+                self.assertTrue(os.path.isdir(store_path))
+            self.assertEqual(os.listdir(store_path), [])
+        finally:
+            if old_activities_path is None:
+                del os.environ['SUGAR_ACTIVITIES_PATH']
+            else:
+                os.environ['SUGAR_ACTIVITIES_PATH'] = old_activities_path
+            shutil.rmtree(temp_dir)
+
+    def test_apply_delta(self):
+        temp_dir = tempfile.mkdtemp()
+        old_activities_path = os.environ.get('SUGAR_ACTIVITIES_PATH')
+        os.environ['SUGAR_ACTIVITIES_PATH'] = os.path.join(temp_dir,
+                                                           'Activities')
+        try:
+            new_source_path = os.path.join(temp_dir, 'source')
+            shutil.copytree(SAMPLE_ACTIVITY_PATH, new_source_path)
+            info_path = os.path.join(new_source_path, 'activity',
+                                     'activity.info')
+            with open(info_path) as f:
+                info = f.read()
+            with open(info_path, 'w') as f:
+                f.write(info.replace('activity_version = 1',
+                                     'activity_version = 2'))
+            with open(os.path.join(new_source_path, 'NEWS'), 'w') as f:
+                f.write('Version 2')
+            os.remove(os.path.join(new_source_path, 'setup.py'))
+
+            old_xo_path = _create_xo(temp_dir, 'Sample')
+            new_xo_path = _create_xo(temp_dir, 'Sample', new_source_path, 2)
+            delta_path = os.path.join(temp_dir, 'Sample-1-2.xod')
+            self.assertEqual(bundledelta.create_delta(
+                old_xo_path, new_xo_path, delta_path), 2)
+
+            install_path = ActivityBundle(old_xo_path).install()
+            self.assertEqual(ActivityBundle(install_path).apply_delta(
+                delta_path), install_path)
+            bundle = ActivityBundle(install_path)
+            self.assertEqual(bundle.get_activity_version(), '2')
+            self.assertTrue(os.path.isfile(os.path.join(install_path,
+                                                        'NEWS')))
+            self.assertFalse(os.path.exists(os.path.join(install_path,
+                                                         'setup.py')))
+
+            # the delta does not apply twice, the full bundle is used
+            self.assertRaises(bundledelta.DeltaMismatchException,
+                              bundle.apply_delta, delta_path)
+            # and the installed bundle is kept if it cannot be installed
+            self.assertRaises(MalformedBundleException, bundle.apply_delta,
+                              delta_path, delta_path)
+            self.assertTrue(os.path.isfile(os.path.join(install_path,
+                                                        'NEWS')))
+            self.assertEqual(bundle.apply_delta(delta_path, new_xo_path),
+                             install_path)
+            self.assertEqual(ActivityBundle(install_path).
+                             get_activity_version(), '2')
+            self.assertEqual(sorted(os.listdir(os.path.dirname(
+                install_path))), ['Sample.activity'])
+
+            # a truncated delta, the full bundle is used too
+            bad_delta_path = os.path.join(temp_dir, 'Sample-2-3.xod')
+            with open(delta_path, 'rb') as f:
+                data = f.read()
+            with open(bad_delta_path, 'wb') as f:
+                f.write(data[:len(data) / 2])
+            bundle = ActivityBundle(install_path)
+            self.assertRaises(zipfile.BadZipfile, bundle.apply_delta,
+                              bad_delta_path)
+            self.assertEqual(bundle.apply_delta(bad_delta_path, new_xo_path),
+                             install_path)
+
+            # without renameat2() the directories are swapped by renames
+            old_renameat2 = bundledelta._renameat2
+            bundledelta._renameat2 = None
+            try:
+                self.assertEqual(ActivityBundle(install_path).apply_delta(
+                    delta_path, old_xo_path), install_path)
+            finally:
+                bundledelta._renameat2 = old_renameat2
+            self.assertEqual(ActivityBundle(install_path).
+                             get_activity_version(), '1')
+            self.assertEqual(sorted(os.listdir(os.path.dirname(
+                install_path))), ['Sample.activity'])
+        finally:
+            if old_activities_path is None:
+                del os.environ['SUGAR_ACTIVITIES_PATH']
+            else:
+                os.environ['SUGAR_ACTIVITIES_PATH'] = old_activities_path
+            shutil.rmtree(temp_dir)
@@ -34,7 +34,8 @@ class TestGit(unittest.TestCase):
                      "activity/activity.info",
                      "activity/activity-sample.svg"]
 
-    _activity_locale_files = ["locale/es/activity.linfo"]
+    _activity_locale_files = ["locale/es/activity.linfo",
+                              "locale/linfo.json"]
 
     _share_locale_files = ["locale/es/LC_MESSAGES/org.sugarlabs.Sample.mo"]
 
@@ -156,6 +157,36 @@ class TestGit(unittest.TestCase):
 
         os.chdir(cwd)
 
+    def _test_genpot_cache(self, source_path, build_path):
+        cwd = os.getcwd()
+        os.chdir(build_path)
+
+        pot_path = os.path.join(source_path, "po", "Sample.pot")
+        setup_path = os.path.join(source_path, "setup.py")
+
+        subprocess.call([setup_path, "genpot"])
+        with open(pot_path) as f:
+            first_pot = f.read()
+
+        cache_path = os.path.join(build_path, ".genpot-cache")
+        cached_files = os.listdir(cache_path)
+        self.assertEqual(len(cached_files), 2)
+
+        os.unlink(pot_path)
+        subprocess.call([setup_path, "genpot"])
+        with open(pot_path) as f:
+            second_pot = f.read()
+
+        self.assertItemsEqual(os.listdir(cache_path), cached_files)
+        self.assertEqual(self._strip_pot_date(first_pot),
+                         self._strip_pot_date(second_pot))
+
+        os.chdir(cwd)
+
+    def _strip_pot_date(self, pot):
+        return [line for line in pot.split("\n")
+                if not line.startswith('"POT-Creation-Date:')]
+
     def _test_install(self, source_path, build_path):
         install_path = tempfile.mkdtemp()
 
@@ -243,3 +274,8 @@ class TestGit(unittest.TestCase):
         repo_path = self._create_repo()
         build_path = tempfile.mkdtemp()
         self._test_genpot(repo_path, build_path)
+
+    def test_genpot_cache_out_of_source(self):
+        repo_path = self._create_repo()
+        build_path = tempfile.mkdtemp()
+        self._test_genpot_cache(repo_path, build_path)
@@ -0,0 +1,52 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from sugar3.bundle.bundleversion import NormalizedVersion
+from sugar3.bundle.bundleversion import InvalidVersionError
+from sugar3.bundle.bundleversion import parse_many, max_version
+
+
+class TestBundleVersion(unittest.TestCase):
+    def test_valid_versions(self):
+        for version, parts in [('1', [1]),
+                               ('1.2', [1, 2]),
+                               ('1.2.3-peru', [1, 2, 3]),
+                               ('1.0.0', [1])]:
+            self.assertEqual(NormalizedVersion(version).parts, parts)
+        self.assertEqual(str(NormalizedVersion('1.2.0-peru')), '1.2-peru')
+
+    def test_invalid_versions(self):
+        for version in ['1.2peru', '1.2.', '1.02.5', '', '-peru', ' 1',
+                        '1.2-3', u'1']:
+            self.assertRaises(InvalidVersionError, NormalizedVersion,
+                              version)
+
+    def test_comparison(self):
+        self.assertIs(NormalizedVersion('1.2'), NormalizedVersion('1.2'))
+        self.assertEqual(NormalizedVersion('1'), NormalizedVersion('1.0'))
+        self.assertEqual(len(set(parse_many(['1', '1.0', '2']))), 2)
+        self.assertLess(NormalizedVersion('1.9'), NormalizedVersion('1.10'))
+        self.assertRaises(TypeError, NormalizedVersion('1').__lt__, '1')
+
+    def test_bulk(self):
+        self.assertEqual(parse_many(['1', 'x'], ignore_invalid=True),
+                         [NormalizedVersion('1'), None])
+        self.assertRaises(InvalidVersionError, parse_many, ['1', 'x'])
+        self.assertEqual(max_version(['1.2', '1.10', 'x', '1.9-peru']),
+                         NormalizedVersion('1.10'))
+        self.assertIsNone(max_version(['x']))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gc
+import threading
+import unittest
+
+from gi.repository import GLib
+
+from sugar3.dispatch import Signal
+from sugar3.dispatch import dispatcher
+
+
+class _Receiver(object):
+
+    def __init__(self, calls, name):
+        self._calls = calls
+        self._name = name
+
+    def receive(self, **kwargs):
+        self._calls.append(self._name)
+
+
+class TestSignal(unittest.TestCase):
+
+    def setUp(self):
+        self._signal = Signal(providing_args=['value'])
+        self._calls = []
+
+    def _receiver(self, name):
+        def receive(**kwargs):
+            self._calls.append(name)
+        return receive
+
+    def test_order(self):
+        sender = object()
+        receivers = [self._receiver(i) for i in range(4)]
+        self._signal.connect(receivers[0], sender=sender)
+        self._signal.connect(receivers[1])
+        self._signal.connect(receivers[2], sender=sender)
+        self._signal.connect(receivers[3], sender=object())
+
+        self._signal.send(sender, value=1)
+        self.assertEqual(self._calls, [0, 1, 2])
+
+        del self._calls[:]
+        self._signal.send(None, value=1)
+        self.assertEqual(self._calls, [1])
+
+    def test_duplicates(self):
+        receiver = self._receiver('a')
+        self._signal.connect(receiver)
+        self._signal.connect(receiver)
+        self._signal.connect(self._receiver('b'), dispatch_uid='uid',
+                             weak=False)
+        self._signal.connect(self._receiver('c'), dispatch_uid='uid',
+                             weak=False)
+        self._signal.send(None)
+        self.assertEqual(self._calls, ['a', 'b'])
+        self.assertEqual([key for key, receiver_ in self._signal.receivers],
+                         [(id(receiver), id(None)), ('uid', id(None))])
+
+    def test_disconnect(self):
+        receiver = self._receiver('a')
+        self._signal.connect(receiver)
+        self._signal.send(None)
+        self._signal.disconnect(receiver)
+        self._signal.disconnect(receiver)
+        self._signal.send(None)
+        self.assertEqual(self._calls, ['a'])
+        self.assertEqual(len(self._signal.receivers), 0)
+
+    def test_dead_receivers(self):
+        receiver = _Receiver(self._calls, 'method')
+        function = self._receiver('function')
+        self._signal.connect(receiver.receive)
+        self._signal.connect(receiver.receive, sender=self)
+        self._signal.connect(function)
+        self._signal.send(self)
+        self.assertEqual(self._calls, ['method', 'method', 'function'])
+
+        del receiver, function
+        gc.collect()
+        del self._calls[:]
+        self.assertEqual(self._signal.send(self), [])
+        self.assertEqual(len(self._signal.receivers), 0)
+
+    def _run_main_loop(self):
+        main_loop = GLib.MainLoop()
+        # after the idle callbacks of the signal
+        GLib.idle_add(main_loop.quit)
+        main_loop.run()
+
+    def test_idle(self):
+        signal = Signal(mode=dispatcher.IDLE)
+        receiver = self._receiver('a')
+        signal.connect(receiver)
+        self.assertEqual(signal.send(None), [])
+        signal.send(None)
+        self.assertEqual(self._calls, [])
+
+        self._run_main_loop()
+        self.assertEqual(self._calls, ['a', 'a'])
+
+    def test_coalesce(self):
+        signal = Signal(mode=dispatcher.COALESCE)
+        first, second = object(), object()
+
+        def receive(sender, value, **kwargs):
+            self._calls.append((sender, value))
+
+        signal.connect(receive)
+        signal.send(first, value=1)
+        signal.send(second, value=2)
+        signal.send(first, value=3)
+        self._run_main_loop()
+        self.assertEqual(self._calls, [(first, 3), (second, 2)])
+
+    def test_coalesce_key(self):
+        signal = Signal(mode=dispatcher.COALESCE,
+                        coalesce_key=lambda object_id, **kwargs: object_id)
+
+        def receive(object_id, value, **kwargs):
+            self._calls.append((object_id, value))
+
+        signal.connect(receive)
+        for value, object_id in enumerate(['a', 'b', 'a', 'b', 'c']):
+            signal.send(None, object_id=object_id, value=value)
+        signal.flush()
+        self.assertEqual(self._calls, [('a', 2), ('b', 3), ('c', 4)])
+
+    def test_thread_safe(self):
+        signal = Signal(mode=dispatcher.IDLE)
+        received = threading.Event()
+        threads = []
+
+        def receive(**kwargs):
+            threads.append(threading.current_thread())
+            received.set()
+
+        main_receiver = self._receiver('main')
+        signal.connect(receive, thread_safe=True)
+        signal.connect(main_receiver)
+        signal.send(None)
+        signal.flush()
+        self.assertTrue(received.wait(10))
+        self.assertNotEqual(threads, [threading.current_thread()])
+        self.assertEqual(self._calls, ['main'])
@@ -0,0 +1,87 @@
+# Copyright (C) 2013, One Laptop per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+
+from sugar3.activity import i18n
+
+_HEADER = 'Content-Type: text/plain; charset=UTF-8\n' \
+          'PO-Revision-Date: 2013-01-02 03:04+0000\n'
+
+
+def _write_mo_file(path, messages):
+    # Same layout as the files written by msgfmt, without the hash table
+    keys = sorted(messages.keys())
+    ids = ''
+    strs = ''
+    offsets = []
+    for key in keys:
+        offsets.append((len(ids), len(key), len(strs), len(messages[key])))
+        ids += key + '\0'
+        strs += messages[key] + '\0'
+
+    keys_start = 7 * 4 + 16 * len(keys)
+    values_start = keys_start + len(ids)
+    key_offsets = []
+    value_offsets = []
+    for key_offset, key_length, value_offset, value_length in offsets:
+        key_offsets += [key_length, key_offset + keys_start]
+        value_offsets += [value_length, value_offset + values_start]
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('Iiiiiii', 0x950412de, 0, len(keys),
+                            7 * 4, 7 * 4 + len(keys) * 8, 0, 0))
+        f.write(struct.pack('%di' % len(key_offsets), *key_offsets))
+        f.write(struct.pack('%di' % len(value_offsets), *value_offsets))
+        f.write(ids)
+        f.write(strs)
+
+
+class TestI18n(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._mo_path = os.path.join(self._temp_dir, 'test.mo')
+        _write_mo_file(self._mo_path, {'': _HEADER,
+                                       'Hello': 'Hola',
+                                       'menu\x04Open': 'Abrir'})
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def test_extract_header(self):
+        self.assertEqual(i18n._extract_header(self._mo_path), _HEADER)
+
+    def test_extract_header_invalid_file(self):
+        invalid_path = os.path.join(self._temp_dir, 'invalid.mo')
+        with open(invalid_path, 'wb') as f:
+            f.write('not a mo file')
+        self.assertRaises(IOError, i18n._extract_header, invalid_path)
+
+    def test_extract_header_reloads_modified_file(self):
+        i18n._extract_header(self._mo_path)
+        header = _HEADER.replace('2013', '2014')
+        _write_mo_file(self._mo_path, {'': header})
+        os.utime(self._mo_path, (0, 0))
+        self.assertEqual(i18n._extract_header(self._mo_path), header)
+
+    def test_get_catalog_is_shared(self):
+        catalog = i18n._get_catalog(self._mo_path)
+        self.assertIs(i18n._get_catalog(self._mo_path), catalog)
+        self.assertEqual(catalog.gettext('menu\x04Open'), 'Abrir')
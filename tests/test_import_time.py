@@ -0,0 +1,66 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+# Import time budget in seconds, can be overridden for slow machines
+IMPORT_BUDGET = float(os.environ.get('SUGAR_IMPORT_BUDGET', '3.0'))
+
+# Modules which sugar3.activity.activity must not import eagerly
+LAZY_MODULES = ['telepathy',
+                'sugar3.power',
+                'sugar3.presence.presenceservice',
+                'sugar3.datastore.datastore',
+                'sugar3.graphics.alert',
+                'sugar3.graphics.icon']
+
+_IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.time()
+__import__(sys.argv[1])
+duration = time.time() - start
+
+print json.dumps({'duration': duration, 'modules': sys.modules.keys()})
+"""
+
+
+def _import_in_subprocess(module_name):
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORT_SCRIPT, module_name])
+    return json.loads(output.strip().split('\n')[-1])
+
+
+class TestImportTime(unittest.TestCase):
+    def test_activity_lazy_imports(self):
+        result = _import_in_subprocess('sugar3.activity.activity')
+        for module_name in LAZY_MODULES:
+            self.assertNotIn(module_name, result['modules'])
+
+    def test_activity_import_budget(self):
+        # take the best of a few runs to reduce the noise
+        duration = min(
+            _import_in_subprocess('sugar3.activity.activity')['duration']
+            for i in range(3))
+        self.assertLess(duration, IMPORT_BUDGET,
+                        'Importing sugar3.activity.activity took %.2fs, '
+                        'the budget is %.2fs' % (duration, IMPORT_BUDGET))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import StringIO
+import unittest
+
+from sugar3 import logger
+
+
+class _Stream(object):
+
+    def __init__(self):
+        self.writes = []
+        self.can_write = threading.Event()
+        self.can_write.set()
+
+    def write(self, data):
+        self.can_write.wait()
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+class TestAsyncLogHandler(unittest.TestCase):
+
+    def setUp(self):
+        self._stream = _Stream()
+        self._handler = logger.AsyncLogHandler(self._stream)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._logger = logging.getLogger('test_logger')
+        self._logger.propagate = False
+        self._logger.addHandler(self._handler)
+
+    def tearDown(self):
+        self._stream.can_write.set()
+        self._logger.removeHandler(self._handler)
+        self._handler.close()
+
+    def test_write(self):
+        for i in range(1000):
+            self._logger.warning('record %d', i)
+        self._handler.flush()
+        self.assertEqual(''.join(self._stream.writes),
+                         ''.join(['record %d\n' % i for i in range(1000)]))
+
+    def test_batches(self):
+        self._stream.can_write.clear()
+        self._logger.warning('first')
+        for i in range(100):
+            self._logger.warning('record %d', i)
+        self._stream.can_write.set()
+        self._handler.flush()
+        # the records logged while writing are written at once
+        self.assertLessEqual(len(self._stream.writes), 2)
+
+    def test_dropped(self):
+        self._handler.MAX_PENDING_SIZE = 100
+        self._stream.can_write.clear()
+        for i in range(100):
+            self._logger.warning('record %d', i)
+        self._stream.can_write.set()
+        self._handler.flush()
+        data = ''.join(self._stream.writes)
+        self.assertIn('records dropped', data)
+        self.assertLess(data.count('record '), 100)
+
+
+_LOGGING_SCRIPT = """
+import logging
+from sugar3 import logger
+logger.start()
+for i in range(20000):
+    logging.warning('record %d', i)
+"""
+
+
+class TestLogRotation(unittest.TestCase):
+
+    def setUp(self):
+        self._logs_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._logs_dir)
+
+    def _run(self, log_path, budget):
+        environ = dict(os.environ)
+        environ.update({'SUGAR_LOGS_DIR': self._logs_dir,
+                        'SUGAR_LOG_FILE': log_path,
+                        'SUGAR_LOGGER_MAX_SIZE': str(128 * 1024),
+                        'SUGAR_LOGGER_BUDGET': budget,
+                        'PYTHONPATH': os.pathsep.join(sys.path)})
+        with open(log_path, 'w') as log_file:
+            subprocess.check_call([sys.executable, '-c', _LOGGING_SCRIPT],
+                                  env=environ, stdout=log_file,
+                                  stderr=log_file)
+
+        names = os.listdir(self._logs_dir)
+        self.assertIn(os.path.basename(log_path), names)
+        rotated = sorted([name for name in names if name.endswith('.gz')],
+                         key=lambda name: int(name.split('.')[-2]))
+        self.assertTrue(rotated)
+        return names, rotated
+
+    def test_rotation(self):
+        log_path = os.path.join(self._logs_dir, 'org.sugar.Test-1.log')
+        names, rotated = self._run(log_path, str(200 * 1024))
+        self.assertEqual(len(rotated) + 1, len(names))
+
+        total = sum([os.path.getsize(os.path.join(self._logs_dir, name))
+                     for name in names])
+        self.assertLessEqual(total, 200 * 1024 + 128 * 1024)
+
+        # the last rotated log is not removed, and ends where the
+        # current log starts
+        with gzip.open(os.path.join(self._logs_dir, rotated[-1])) as f:
+            last_record = f.read().splitlines()[-1].split()[-1]
+        with open(log_path) as f:
+            first_record = f.readline().split()[-1]
+        self.assertEqual(int(first_record), int(last_record) + 1)
+
+    def test_invalid_setting(self):
+        # reported once the logging is set up, with the log format
+        log_path = os.path.join(self._logs_dir, 'org.sugar.Test-1.log')
+        names_, rotated = self._run(log_path, 'lots')
+        with gzip.open(os.path.join(self._logs_dir, rotated[0])) as f:
+            first_line = f.readline()
+        self.assertEqual(first_line.split(None, 1)[1],
+                         "WARNING root: Invalid SUGAR_LOGGER_BUDGET: 'lots'\n")
+
+
+_DISPATCH_SCRIPT = """
+import sys
+from sugar3 import logger
+from sugar3.dispatch import Signal
+signal = Signal()
+signal.connect(lambda **kwargs: None)
+signal.send(None)
+logger.dump_trace(sys.stdout)
+"""
+
+
+class TestTraceBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self._trace_buffer = logger._trace_buffer
+        logger._trace_buffer = logger.TraceBuffer(4)
+
+    def tearDown(self):
+        logger._trace_buffer = self._trace_buffer
+
+    def test_record(self):
+        @logger.trace_calls()
+        def add(a, b):
+            return a + b
+
+        @logger.trace_calls(skip_args=[0])
+        def fail(self_, items, value, other):
+            raise ValueError()
+
+        for i in range(5):
+            self.assertEqual(add(i, 1.5), i + 1.5)
+        self.assertRaises(ValueError, fail, None, [1, 2], True, 'other')
+        # None + inf raises
+        self.assertRaises(TypeError, add, None, float('inf'))
+
+        records = logger._trace_buffer.get_records()
+        self.assertEqual(len(records), 4)
+        self.assertEqual([r[4] for r in records[:2]],
+                         [['int=%d' % i, 'float=1'] for i in range(3, 5)])
+        self.assertTrue(records[2][2].endswith('.fail'))
+        self.assertTrue(records[2][3])
+        self.assertEqual(records[2][4], ['len=2', 'bool=1'])
+        self.assertTrue(records[3][3])
+        self.assertEqual(records[3][4], ['?', 'float=0'])
+
+        stream = StringIO.StringIO()
+        logger.dump_trace(stream)
+        self.assertEqual(len(stream.getvalue().splitlines()), 4)
+
+    def test_dispatch(self):
+        # the buffer is created when the traced modules are imported
+        environ = dict(os.environ)
+        environ.update({'SUGAR_TRACE_BUFFER': '16',
+                        'PYTHONPATH': os.pathsep.join(sys.path)})
+        output = subprocess.check_output(
+            [sys.executable, '-c', _DISPATCH_SCRIPT], env=environ)
+        self.assertIn(' sugar3.dispatch.dispatcher.send(', output)
+
+    def test_disabled(self):
+        logger._trace_buffer = None
+        os.environ.pop('SUGAR_TRACE_BUFFER', None)
+
+        def function():
+            pass
+
+        self.assertIs(logger.trace_calls()(function), function)
@@ -20,6 +20,8 @@
 import os
 import unittest
 
+from gi.repository import GLib
+
 from sugar3 import mime
 
 tests_dir = os.path.dirname(__file__)
@@ -39,10 +41,34 @@ class TestMime(unittest.TestCase):
         self.assertListEqual(mime.get_mime_parents("application/octet-stream"),
                              [])
 
+    def test_get_primary_extension(self):
+        self.assertEqual(mime.get_primary_extension('application/pdf'),
+                         'pdf')
+        self.assertEqual(mime.get_primary_extension('audio/ogg'), 'ogg')
+        self.assertIsNone(mime.get_primary_extension('application/x-nothing'))
+
+    def test_get_mime_icon(self):
+        self.assertEqual(mime.get_mime_icon('text/plain'), 'text-x-generic')
+        self.assertEqual(mime.get_mime_icon('application/x-nothing'),
+                         'application-x-nothing')
+
     def test_get_for_file(self):
         self.assertEqual(mime.get_for_file(os.path.join(data_dir, "mime.svg")),
                          'image/svg+xml')
 
+    def test_get_for_files(self):
+        results = []
+        main_loop = GLib.MainLoop()
+
+        svg_path = os.path.abspath(os.path.join(data_dir, "mime.svg"))
+        missing_path = os.path.abspath(os.path.join(data_dir, "missing.pdf"))
+        mime.get_for_files([svg_path, missing_path], results.extend,
+                           main_loop.quit)
+        main_loop.run()
+
+        self.assertItemsEqual(results, [(svg_path, 'image/svg+xml'),
+                                        (missing_path, 'application/pdf')])
+
     def test_from_file_name(self):
         self.assertEqual(mime.get_from_file_name('test.pdf'),
                          'application/pdf')